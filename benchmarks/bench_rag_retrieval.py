@@ -0,0 +1,333 @@
+"""
+Micro-benchmarks for the document RAG retrieval path.
+
+Run from the repository root:
+    python -m benchmarks.bench_rag_retrieval [benchmark ...] [--chunks N]
+"""
+
+import argparse
+import glob
+import heapq
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from rag_utils.ann_index import (KMEANS_SAMPLES_PER_LIST, IVFIndex, _assign, default_list_count, default_probe_count,
+                                 train_centroids)
+from rag_utils.chunk_store import ChunkStore, compile_pack
+from rag_utils.html_sanitizer import reference_sanitize_html, sanitize_html
+from rag_utils.parallel_scoring import get_worker_count, score_chunks, shutdown_pool
+from rag_utils.ranking import select_top_k
+from rag_utils.term_matcher import TermMatcher, reference_relevance
+from rag_utils.vector_index import VectorIndex, embed_query, relevance, update_rows
+
+
+# recall@k the default probe count must reach against exact search
+RECALL_TARGET = 0.95
+
+
+def _probe_counts(n_lists):
+    """Powers of two up to n_lists, plus the default probe count"""
+    return sorted({n_probe for n_probe in (1, 2, 4, 8, 16, 32, 64, 128, 256, 512) if n_probe <= n_lists} |
+                  {default_probe_count(n_lists)})
+
+
+def _check_recall(recall_by_probe, n_lists):
+    n_probe = default_probe_count(n_lists)
+    recall = recall_by_probe[n_probe]
+    print(f"default n_probe {n_probe} of {n_lists} lists: recall@k {recall:.3f} (target {RECALL_TARGET})")
+    assert recall >= RECALL_TARGET, f"recall@k {recall:.3f} at the default n_probe is below {RECALL_TARGET}"
+
+
+def _best_of(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_top_k_selection():
+    """Bounded-heap top-k against sorting every match"""
+    print("== top-k selection ==")
+    rng = random.Random(7)
+
+    print(f"{'matches':>10} {'k':>5} {'heap ms':>10} {'sort ms':>10} {'heap pushes':>12}")
+    for num_matches in (10_000, 100_000, 1_000_000):
+        scored = [(i, rng.random()) for i in range(num_matches)]
+        for k in (5, 50, 500):
+            heap_time = _best_of(lambda: select_top_k(scored, k))
+            sort_time = _best_of(lambda: sorted(scored, key=lambda pair: pair[1], reverse=True)[:k])
+            # heap operations, the part of selection that depends on k: ~k * ln(n / k) for random order
+            pushes = _count_heap_updates(scored, k)
+            print(f"{num_matches:>10} {k:>5} {heap_time * 1000:>10.2f} {sort_time * 1000:>10.2f} {pushes:>12}")
+
+
+def _count_heap_updates(scored, k):
+    updates = 0
+    threshold = []
+    for _, score in scored:
+        if len(threshold) < k:
+            heapq.heappush(threshold, score)
+            updates += 1
+        elif score > threshold[0]:
+            heapq.heapreplace(threshold, score)
+            updates += 1
+    return updates
+
+
+def synthetic_corpus(num_chunks, num_queries, seed=7):
+    """
+    Topic-structured synthetic chunks and questions.
+
+    Each chunk mixes words from one of num_chunks / 100 topics with Zipf-distributed
+    background words; each question is a few words from one topic.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f"term{i}" for i in range(20_000)])
+    num_topics = max(num_chunks // 100, 10)
+    topic_words = rng.integers(len(vocabulary), size=(num_topics, 50))
+    background = np.minimum(rng.zipf(1.3, size=(num_chunks, 60)), len(vocabulary)) - 1
+    chunk_topics = rng.integers(num_topics, size=num_chunks)
+
+    chunks = []
+    for i, topic in enumerate(chunk_topics):
+        words = np.concatenate((rng.choice(topic_words[topic], 90), background[i]))
+        chunks.append(" ".join(vocabulary[words]))
+    questions = [" ".join(vocabulary[rng.choice(topic_words[topic], 4, replace=False)])
+                 for topic in rng.integers(num_topics, size=num_queries)]
+    return chunks, questions
+
+
+def bench_ann_recall(num_chunks=50_000, num_queries=200, k=10):
+    """IVF recall@k and latency against exact vector search for increasing probe counts; fails below RECALL_TARGET at the default"""
+    print(f"== ANN recall vs exact search ({num_chunks} chunks, k={k}) ==")
+    chunks, questions = synthetic_corpus(num_chunks, num_queries)
+
+    start = time.perf_counter()
+    exact = VectorIndex.build(chunks)
+    print(f"embedded chunks in {time.perf_counter() - start:.1f}s ({exact.matrix.nbytes / 1e6:.0f}MB)")
+    start = time.perf_counter()
+    ann = IVFIndex.from_vector_index(exact)
+    print(f"built {ann.n_lists} lists in {time.perf_counter() - start:.1f}s")
+    queries = [exact.embed_query([question]) for question in questions]
+
+    def timed(search):
+        latencies, results = [], []
+        for query in queries:
+            start = time.perf_counter()
+            results.append({doc_id for doc_id, _ in search(query)})
+            latencies.append(time.perf_counter() - start)
+        return results, np.array(latencies) * 1000
+
+    truth, exact_ms = timed(lambda query: exact.search_vector(query, k))
+    print(f"{'n_probe':>8} {'recall@k':>9} {'mean ms':>8} {'p95 ms':>8}")
+    print(f"{'exact':>8} {1.0:>9.3f} {exact_ms.mean():>8.2f} {np.percentile(exact_ms, 95):>8.2f}")
+    recall_by_probe = {}
+    for n_probe in _probe_counts(ann.n_lists):
+        found, ann_ms = timed(lambda query: ann.search_vector(query, k, n_probe=n_probe))
+        recall = recall_by_probe[n_probe] = np.mean([len(f & t) / max(len(t), 1) for f, t in zip(found, truth)])
+        print(f"{n_probe:>8} {recall:>9.3f} {ann_ms.mean():>8.2f} {np.percentile(ann_ms, 95):>8.2f}")
+    _check_recall(recall_by_probe, ann.n_lists)
+
+
+def iter_synthetic_batches(num_chunks, num_queries, batch_size=50_000, seed=7):
+    """
+    synthetic_corpus in batches, for corpora too large to hold as Python strings.
+
+    Returns:
+        (questions, generator of chunk text lists)
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f"term{i}" for i in range(20_000)])
+    num_topics = max(num_chunks // 100, 10)
+    topic_words = rng.integers(len(vocabulary), size=(num_topics, 50))
+    questions = [" ".join(vocabulary[rng.choice(topic_words[topic], 4, replace=False)])
+                 for topic in rng.integers(num_topics, size=num_queries)]
+
+    def batches():
+        for start in range(0, num_chunks, batch_size):
+            size = min(batch_size, num_chunks - start)
+            background = np.minimum(rng.zipf(1.3, size=(size, 60)), len(vocabulary)) - 1
+            yield [" ".join(vocabulary[np.concatenate((rng.choice(topic_words[topic], 90), background[i]))])
+                   for i, topic in enumerate(rng.integers(num_topics, size=size))]
+    return questions, batches()
+
+
+def _rss_mb():
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("VmRSS:")) / 1024
+
+
+def bench_ann_scale(num_chunks=1_000_000, num_queries=50, k=10, work_dir=None):
+    """
+    Load time, memory and query latency of a memory-mapped IVF index at pack scale
+    (run with --chunks 1000000).
+
+    A float32 matrix of a million chunks does not fit next to the build on a small machine,
+    so the index is built in a stream: centroids and idf come from a k-means sample, the
+    remaining chunks are embedded and assigned batch by batch into an on-disk float16 file,
+    which is then reordered by list. Recall is against exact search over the same vectors and
+    must reach RECALL_TARGET at the default n_probe.
+    """
+    print(f"== memory-mapped IVF at scale ({num_chunks} chunks, k={k}) ==")
+    work_dir = work_dir or tempfile.mkdtemp(prefix="ivf_scale_")
+    n_lists = default_list_count(num_chunks)
+    # the first batch is the k-means sample
+    questions, batches = iter_synthetic_batches(num_chunks, num_queries,
+                                                batch_size=max(50_000, n_lists * KMEANS_SAMPLES_PER_LIST))
+
+    start = time.perf_counter()
+    first = next(batches)
+    sample = VectorIndex.build(first[:n_lists * KMEANS_SAMPLES_PER_LIST])
+    centroids = train_centroids(sample.matrix, n_lists)
+    dimensions = sample.matrix.shape[1]
+    staged = np.lib.format.open_memmap(os.path.join(work_dir, "staged.npy"), mode="w+",
+                                       dtype=np.float16, shape=(num_chunks, dimensions))
+    assignments = np.empty(num_chunks, dtype=np.int32)
+    position = 0
+    for batch in itertools.chain([first], batches):
+        rows = update_rows(np.empty((0, dimensions), dtype=np.float32), np.full(len(batch), -1), batch,
+                           sample.vectorizer, sample.idf)
+        staged[position:position + len(batch)] = rows
+        assignments[position:position + len(batch)] = _assign(rows, centroids)
+        position += len(batch)
+    print(f"embedded and assigned in {time.perf_counter() - start:.0f}s")
+
+    start = time.perf_counter()
+    index = IVFIndex._from_assignments(centroids, assignments, lambda doc_ids: staged[doc_ids], sample.idf, None, "bench")
+    path = os.path.join(work_dir, "pack.json.ivf.npz")
+    index.save(path)
+    del index, staged
+    os.remove(os.path.join(work_dir, "staged.npy"))
+    print(f"reordered and saved in {time.perf_counter() - start:.0f}s "
+          f"({os.path.getsize(glob.glob(path + '.*.vectors.npy')[0]) / 1e9:.2f}GB of float16 vectors)")
+
+    rss_before = _rss_mb()
+    start = time.perf_counter()
+    index = IVFIndex.load(path)
+    print(f"load: {(time.perf_counter() - start) * 1000:.0f}ms, RSS +{_rss_mb() - rss_before:.0f}MB")
+    queries = [embed_query(index.vectorizer, index.idf, [question]) for question in questions]
+
+    truth = [([], []) for _ in queries]
+    for offset in range(0, len(index), 16384):
+        rows = index.list_vectors[offset:offset + 16384].astype(np.float32)
+        for query, (scores, ids) in zip(queries, truth):
+            scores.extend(relevance(rows, query).tolist())
+            ids.extend(index.list_doc_ids[offset:offset + len(rows)].tolist())
+            top = np.argsort(scores)[-k:]
+            scores[:], ids[:] = [scores[i] for i in top], [ids[i] for i in top]
+    truth = [set(ids) for _, ids in truth]
+
+    print(f"{'n_probe':>8} {'recall@k':>9} {'first ms':>9} {'mean ms':>8} {'p95 ms':>8} {'RSS MB':>7}")
+    recall_by_probe = {}
+    for n_probe in _probe_counts(index.n_lists):
+        latencies, found = [], []
+        for query in queries:
+            start = time.perf_counter()
+            found.append({doc_id for doc_id, _ in index.search_vector(query, k, n_probe=n_probe)})
+            latencies.append((time.perf_counter() - start) * 1000)
+        recall = recall_by_probe[n_probe] = np.mean([len(f & t) / max(len(t), 1) for f, t in zip(found, truth)])
+        print(f"{n_probe:>8} {recall:>9.3f} {latencies[0]:>9.1f} {np.mean(latencies):>8.1f} "
+              f"{np.percentile(latencies, 95):>8.1f} {_rss_mb():>7.0f}")
+    _check_recall(recall_by_probe, index.n_lists)
+
+
+def bench_parallel_scoring(num_chunks=50_000, num_queries=5, k=10, workers=None):
+    """
+    Serial keyword scan of a chunk store against the sharded process-pool scan.
+
+    Set RAG_PARALLEL_MIN_CHUNKS only on hosts where sharded is faster at that store size.
+    """
+    from document_rag_explorer import calculate_simple_relevance
+
+    workers = workers or get_worker_count()
+    print(f"== sharded keyword scoring ({num_chunks} chunks, {workers} workers) ==")
+    chunks, questions = synthetic_corpus(num_chunks, num_queries)
+    work_dir = tempfile.mkdtemp(prefix="scan_scale_")
+    pack_file = os.path.join(work_dir, "pack.json")
+    with open(pack_file, "w", encoding="utf-8") as f:
+        json.dump([{"File": "synthetic.pdf", "Chunks": [{"Text": chunk, "Page": page} for page, chunk in enumerate(chunks)]}], f)
+    store = ChunkStore.open(compile_pack(pack_file, os.path.join(work_dir, "pack.chunkstore"), dedupe=False))
+
+    def scan(**kwargs):
+        return [score_chunks(calculate_simple_relevance, store, [question], 0.2, k, workers=workers, **kwargs)
+                for question in questions]
+
+    scan(min_chunks=0)  # start the pool and map the store in the workers outside the timing
+    serial_time = _best_of(lambda: scan(min_chunks=num_chunks + 1), repeat=2)
+    parallel_time = _best_of(lambda: scan(min_chunks=0), repeat=2)
+    assert scan(min_chunks=0) == scan(min_chunks=num_chunks + 1)
+    shutdown_pool()
+    print(f"serial {serial_time / num_queries * 1000:.1f} ms/query, "
+          f"sharded {parallel_time / num_queries * 1000:.1f} ms/query ({serial_time / parallel_time:.2f}x)")
+
+
+def bench_term_matching(num_chunks=50_000, num_queries=5):
+    """Per-pattern in/count keyword scoring against TermMatcher"""
+    print(f"== keyword term matching ({num_chunks} chunks) ==")
+    chunks, questions = synthetic_corpus(num_chunks, num_queries * 8)
+    words = " ".join(questions).split()
+
+    print(f"{'patterns':>9} {'per-pattern ms':>15} {'matcher ms':>11}")
+    for num_terms in (1, 4, 8, 16):
+        # question-like phrases of two words, as a question plus num_terms - 1 topics
+        queries = [[" ".join(words[(q * 16 + t) * 2:(q * 16 + t) * 2 + 2]) for t in range(num_terms)]
+                   for q in range(num_queries)]
+
+        def run(scorer_for):
+            results = []
+            for query in queries:
+                scorer = scorer_for(query)
+                results.append([scorer(chunk) for chunk in chunks])
+            return results
+
+        per_pattern = lambda: run(lambda query: lambda chunk: reference_relevance(chunk, query))
+        matcher = lambda: run(lambda query: TermMatcher(query).score)
+        assert per_pattern() == matcher()
+        times = [_best_of(fn, repeat=2) / num_queries * 1000 for fn in (per_pattern, matcher)]
+        patterns = np.mean([len(TermMatcher(query).patterns) for query in queries])
+        print(f"{patterns:>9.0f} {times[0]:>15.1f} {times[1]:>11.1f}")
+
+
+def bench_html_sanitizer(payload_bytes=1 << 20):
+    """Original multi-pass force_ascii_replace cleanup against sanitize_html on answer-sized HTML"""
+    print(f"== HTML sanitizer ({payload_bytes >> 10}KB payloads) ==")
+    paragraphs = {
+        "plain": "<p>Seville will reach 45C on Thursday, a new monthly record.<sup>[1]</sup></p>\n",
+        "entities": "<p>Paris &amp; Lyon: \"heat\" warnings \u2013 it's 40C\u2026 see &#39;advisory&#39; & notes</p>\n",
+        "controls": "<p>Wind\x01 speed\x02 \u2014 140 km/h & rising\x00</p>\n",
+    }
+    print(f"{'payload':>9} {'multi-pass ms':>14} {'sanitize ms':>15}")
+    for name, paragraph in paragraphs.items():
+        payload = paragraph * (payload_bytes // len(paragraph.encode("utf-8")))
+        assert sanitize_html(payload) == reference_sanitize_html(payload)
+        multi_pass = _best_of(lambda: reference_sanitize_html(payload))
+        sanitized = _best_of(lambda: sanitize_html(payload))
+        print(f"{name:>9} {multi_pass * 1000:>14.1f} {sanitized * 1000:>15.1f} ({multi_pass / sanitized:.1f}x)")
+
+
+BENCHMARKS = {
+    "top_k": lambda args: bench_top_k_selection(),
+    "ann": lambda args: bench_ann_recall(num_chunks=args.chunks),
+    "ann_scale": lambda args: bench_ann_scale(num_chunks=args.chunks),
+    "parallel": lambda args: bench_parallel_scoring(num_chunks=args.chunks, workers=args.workers),
+    "terms": lambda args: bench_term_matching(num_chunks=args.chunks),
+    "sanitize": lambda args: bench_html_sanitizer(),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", choices=[[]] + list(BENCHMARKS), default=[])
+    parser.add_argument("--chunks", type=int, default=50_000, help="corpus size for corpus-scale benchmarks")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for the sharded scan (default: cores)")
+    args = parser.parse_args()
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](args)
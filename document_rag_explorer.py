@@ -11,16 +11,60 @@ import json
 import os
 import glob
 import traceback
-from jinja2 import Template
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import base64
 import io
 from PIL import Image
 import logging
 import re
 import html
+import threading
+import time
+
+from rag_utils.ann_index import load_or_build_ann_index
+from rag_utils.bm25_index import load_or_build_index
+from rag_utils.chunk_store import STORE_EXTENSION, ChunkStore, get_store_path, open_compiled_pack, read_store_checksum
+from rag_utils.compact_html import (main_response as compact_main_response, references_list as compact_references_list,
+                                     response_tab as compact_response_tab, sources_table as compact_sources_table,
+                                     sources_tab as compact_sources_tab)
+from rag_utils.completion_cache import get_completion_cache
+from rag_utils.context_packing import CHARS_PER_TOKEN, pack_context
+from rag_utils.dedup import dedup_enabled, dedupe_sources
+from rag_utils.federation import FederatedIndex, FederatedPack, FederatedTableIndex
+from rag_utils.file_routing import DEFAULT_TOP_FILES, FileRouter, TwoLevelIndex, read_file_profiles
+from rag_utils.html_sanitizer import sanitize_html
+from rag_utils.local_llm import BACKEND_ENV as LLM_BACKEND_ENV, LATENCY_ENV as LOCAL_LLM_LATENCY_ENV, LocalLLM
+from rag_utils.pack_cache import get_cached_pack, get_cached_path
+from rag_utils.pack_stream import iter_pack_sources
+from rag_utils.parallel_scoring import score_chunks
+from rag_utils.passages import DEFAULT_CONTEXT_CHARS, compile_term_pattern, extract_passage
+from rag_utils.ranking import search_batch
+from rag_utils.result_cache import ResultCache, make_result_key
+from rag_utils.stage_timing import StageRecorder
+from rag_utils.table_index import load_or_build_table_index
+from rag_utils.template_rendering import BYTECODE_CACHE_ENV, TemplateRenderer
+from rag_utils.term_matcher import get_term_matcher
+from rag_utils.vector_index import load_or_build_vector_index
 
 logger = logging.getLogger(__name__)
 
+# retrieval over-fetches this many candidates per requested source for the context packer
+CANDIDATE_POOL_FACTOR = 4
+
+# pack.json files at least this large are streamed into a chunk store instead of loaded as a list
+STREAMING_PACK_BYTES = 64 * 1024 * 1024
+
+# Rendered answers per (question, parameters, pack version), shared by invocations in this process
+RESULT_CACHE = ResultCache()
+
+# concurrent LLM calls in answer_questions and map-reduce generation
+MAX_CONCURRENT_LLM_CALLS = 4
+# sources per fact-extraction call in map-reduce generation
+MAP_GROUP_SIZE = 3
+
+PARTIAL_ANSWER_NOTE = ("<p><em>The full answer took longer than allowed, so these are the most relevant passages "
+                       "from the documents instead.</em></p>")
+
 @skill(
     name="Document RAG Explorer",
     description="Retrieves and analyzes relevant documents from knowledge base to answer user questions",
@@ -51,9 +95,70 @@ logger = logging.getLogger(__name__)
         ),
         SkillParameter(
             name="max_characters",
-            description="Maximum characters to include from sources",
+            description="Maximum characters to include from sources (budget of max_characters / 4 tokens when max_context_tokens is empty)",
             default_value=3000
         ),
+        SkillParameter(
+            name="max_context_tokens",
+            description="Token budget for source text sent to the LLM; when empty (the default), max_characters / 4 is used"
+        ),
+        SkillParameter(
+            name="passage_context",
+            description="Characters of context kept around each question-term hit when cutting chunks down to passages for the LLM (0 sends whole chunks)",
+            default_value=DEFAULT_CONTEXT_CHARS
+        ),
+        SkillParameter(
+            name="retrieval_method",
+            parameter_type="code",
+            description="How chunks are ranked: bm25 (keyword index), vector (exact search over offline hashed TF-IDF vectors), ann (approximate vector search for very large packs) or scan (phrase matching over every chunk, spread across processes for large packs)",
+            constrained_values=["bm25", "vector", "ann", "scan"],
+            default_value="bm25"
+        ),
+        SkillParameter(
+            name="top_files",
+            description="Rank files by their pack.json Description and Summary first and only score the chunks of this many best-matching files (0 scores every chunk)",
+            default_value=DEFAULT_TOP_FILES
+        ),
+        SkillParameter(
+            name="max_latency_ms",
+            description="Deadline in milliseconds for the whole answer; if the LLM has not answered by then, the most relevant passages are shown instead, marked as partial (0 waits for the LLM)",
+            default_value=0
+        ),
+        SkillParameter(
+            name="table_lookup",
+            parameter_type="code",
+            description="Answer direct lookups (an entity plus a column, e.g. the forecast high in Dubai) from the parsed markdown tables, sending only the matching rows to the LLM (enabled), or always retrieve whole chunks (disabled)",
+            constrained_values=["enabled", "disabled"],
+            default_value="enabled"
+        ),
+        SkillParameter(
+            name="search_scope",
+            parameter_type="code",
+            description="Search only the skill's pack.json (pack) or every knowledge pack found in the bundle, data/ and Skill Resources folders (all_packs)",
+            constrained_values=["pack", "all_packs"],
+            default_value="pack"
+        ),
+        SkillParameter(
+            name="generation_mode",
+            parameter_type="code",
+            description="How the answer is written: single (one prompt with every source) or map_reduce (concurrent fact extraction over groups of sources, then one short synthesis call; faster for large max_sources)",
+            constrained_values=["single", "map_reduce"],
+            default_value="single"
+        ),
+        SkillParameter(
+            name="html_mode",
+            parameter_type="code",
+            description="How the response and sources tabs are rendered: standard (inline-styled cards) or compact (one shared style block and class-based markup; much smaller output)",
+            constrained_values=["standard", "compact"],
+            default_value="standard"
+        ),
+        SkillParameter(
+            name="llm_cache",
+            parameter_type="code",
+            description="Reuse cached answers and LLM completions for identical questions and prompts (enabled), or always search and call the LLM without reading or writing either cache (disabled)",
+            constrained_values=["enabled", "disabled"],
+            default_value="enabled"
+        ),
         SkillParameter(
             name="max_prompt",
             parameter_type="prompt",
@@ -77,13 +182,23 @@ logger = logging.getLogger(__name__)
 def document_rag_explorer(parameters: SkillInput):
     """Main skill function for document RAG exploration"""
     
+    start_time = time.monotonic()
     # Get parameters
     user_question = parameters.arguments.user_question
     base_url = parameters.arguments.base_url
     max_sources = parameters.arguments.max_sources or 5
     match_threshold = parameters.arguments.match_threshold or 0.2
     max_characters = parameters.arguments.max_characters or 3000
+    max_context_tokens = parameters.arguments.max_context_tokens
+    passage_context = parameters.arguments.passage_context
     max_prompt = parameters.arguments.max_prompt
+    retrieval_method = parameters.arguments.retrieval_method or "bm25"
+    search_scope = parameters.arguments.search_scope or "pack"
+    top_files = parameters.arguments.top_files or 0
+    use_table_lookup = (parameters.arguments.table_lookup or "enabled") != "disabled"
+    use_llm_cache = (parameters.arguments.llm_cache or "enabled") != "disabled"
+    generation_mode = parameters.arguments.generation_mode or "single"
+    compact = (parameters.arguments.html_mode or "standard") == "compact"
     
     # Initialize empty topics list (globals not available in SkillInput)
     list_of_topics = []
@@ -93,12 +208,25 @@ def document_rag_explorer(parameters: SkillInput):
     sources_html = ""
     title = "Document Analysis"
     response_data = None
+    cache_key = None
+    cached_result = None
+    # only successful renders and genuine "no results" answers are cached, never errors
+    cacheable = False
+    # per-stage timings of this invocation, appended to $RAG_STAGE_TIMINGS_PATH when set
+    recorder = StageRecorder(question=user_question, search_scope=search_scope, retrieval_method=retrieval_method,
+                             generation_mode=generation_mode, html_mode="compact" if compact else "standard")
     
     try:
-        # Load document sources from pack.json
-        loaded_sources = load_document_sources()
+        max_latency_ms = parse_latency_ms(parameters.arguments.max_latency_ms)
+        
+        # Load document sources from pack.json (cached per process until the file changes)
+        with recorder.span("load_document_sources") as span:
+            pack = load_document_pack(search_scope)
+            loaded_sources = pack.sources if pack else []
+            span["chunks"] = len(loaded_sources)
         
         if not loaded_sources:
+            recorder.write()
             return SkillOutput(
                 final_prompt="No document sources found. Please ensure pack.json is available.",
                 narrative=None,
@@ -106,94 +234,182 @@ def document_rag_explorer(parameters: SkillInput):
                 export_data=[]
             )
         
-        # Find matching documents
-        docs = find_matching_documents(
-            user_question=user_question,
-            topics=list_of_topics,
-            loaded_sources=loaded_sources,
+        # Same question, parameters and pack version as an earlier run: reuse its rendered HTML,
+        # unless caching was switched off for this run (then the answer is not stored either)
+        cache_key = make_result_key(
+            user_question,
+            pack.checksum,
             base_url=base_url,
             max_sources=max_sources,
             match_threshold=match_threshold,
-            max_characters=max_characters
+            max_characters=max_characters,
+            max_context_tokens=max_context_tokens,
+            passage_context=passage_context,
+            retrieval_method=retrieval_method,
+            top_files=top_files,
+            table_lookup=use_table_lookup,
+            search_scope=search_scope,
+            generation_mode=generation_mode,
+            compact=compact
         )
+        cached_result = RESULT_CACHE.get(cache_key) if use_llm_cache else None
+        recorder.attributes["result_cache_hit"] = cached_result is not None
+        logger.info(f"DEBUG: Result cache {'hit' if cached_result else 'miss'}, stats: {RESULT_CACHE.stats()}")
         
-        if not docs:
-            # No results found
-            no_results_html = """
-            <div style="text-align: center; padding: 40px; color: #666;">
-                <h2>No relevant documents found</h2>
-                <p>No documents in the knowledge base matched your question with sufficient relevance.</p>
-                <p>Try rephrasing your question or using different keywords.</p>
-            </div>
-            """
-            main_html = no_results_html
-            sources_html = "<p>No sources available</p>"
-            title = "No Results Found"
-        else:
-            # Generate response from documents
-            response_data = generate_rag_response(user_question, docs)
+        if cached_result is None:
+            # Retrieval index over the chunks, persisted next to pack.json between invocations
+            with recorder.span("retrieval_index"):
+                index = get_retrieval_index(pack, retrieval_method, top_files)
+                table_index = get_table_index(pack) if use_table_lookup else None
+        
+            # Find matching documents
+            with recorder.span("find_matching_documents") as span:
+                docs = find_matching_documents(
+                    user_question=user_question,
+                    topics=list_of_topics,
+                    loaded_sources=loaded_sources,
+                    base_url=base_url,
+                    max_sources=max_sources,
+                    match_threshold=match_threshold,
+                    max_characters=max_characters,
+                    index=index,
+                    max_tokens=max_context_tokens,
+                    passage_context=passage_context,
+                    table_index=table_index,
+                    stats=span
+                )
+                span["matches"] = len(docs)
+        
+            if not docs:
+                # No results found
+                no_results_html = """
+                <div style="text-align: center; padding: 40px; color: #666;">
+                    <h2>No relevant documents found</h2>
+                    <p>No documents in the knowledge base matched your question with sufficient relevance.</p>
+                    <p>Try rephrasing your question or using different keywords.</p>
+                </div>
+                """
+                main_html = no_results_html
+                sources_html = "<p>No sources available</p>"
+                title = "No Results Found"
+                cacheable = True
+            else:
+                # Generate response from documents, within what is left of max_latency_ms
+                timeout = max(0.0, start_time + max_latency_ms / 1000 - time.monotonic()) if max_latency_ms else None
+                with recorder.span("generate_rag_response", sources=len(docs)) as span:
+                    response_data = generate_rag_response(user_question, docs, use_llm_cache=use_llm_cache,
+                                                          generation_mode=generation_mode, timeout=timeout)
+                    span["prompt_chars"] = len(response_data['raw_prompt']) if response_data else 0
+                    span["partial"] = bool(response_data and response_data['partial'])
             
-            # Create main response HTML (without sources section)
-            if response_data:
-                try:
-                    main_html = force_ascii_replace(
-                        Template(main_response_template).render(
-                            title=response_data['title'],
-                            content=response_data['content']
-                        )
-                    )
-                    logger.info(f"DEBUG: Generated main HTML, length: {len(main_html)}")
-                    
-                    # Create separate sources HTML
-                    sources_html = force_ascii_replace(
-                        Template(sources_template).render(
-                            references=response_data['references']
-                        )
-                    )
-                    logger.info(f"DEBUG: Generated sources HTML, length: {len(sources_html)}")
+                # Create main response HTML (without sources section)
+                if response_data and compact:
+                    with recorder.span("render_html") as span:
+                        main_html = compact_main_response(response_data['title'], response_data['content'])
+                        sources_html = compact_sources_table(response_data['references'])
+                        span["html_chars"] = len(main_html) + len(sources_html)
+                    logger.info(f"DEBUG: Generated compact HTML, lengths: {len(main_html)} main, {len(sources_html)} sources")
                     title = response_data['title']
-                except Exception as e:
-                    logger.error(f"DEBUG: Error rendering HTML templates: {str(e)}")
-                    import traceback
-                    logger.error(f"DEBUG: Template error traceback: {traceback.format_exc()}")
-                    main_html = f"<p>Error rendering content: {str(e)}</p>"
-                    sources_html = "<p>Error rendering sources</p>"
-                    title = "Template Error"
-            else:
-                main_html = "<p>Error generating response from documents.</p>"
-                sources_html = "<p>Error loading sources</p>"
-                title = "Error"
+                    cacheable = True
+                elif response_data:
+                    try:
+                        with recorder.span("render_html") as span:
+                            main_html = force_ascii_replace(
+                                TEMPLATES.render(
+                                    "main_response",
+                                    title=response_data['title'],
+                                    content=response_data['content']
+                                )
+                            )
+                            logger.info(f"DEBUG: Generated main HTML, length: {len(main_html)}")
+                    
+                            # Create separate sources HTML
+                            sources_html = force_ascii_replace(
+                                TEMPLATES.render(
+                                    "sources",
+                                    references=response_data['references']
+                                )
+                            )
+                            logger.info(f"DEBUG: Generated sources HTML, length: {len(sources_html)}")
+                            span["html_chars"] = len(main_html) + len(sources_html)
+                        logger.info(f"DEBUG: Template render stats: {TEMPLATES.stats()}")
+                        title = response_data['title']
+                        cacheable = True
+                    except Exception as e:
+                        logger.error(f"DEBUG: Error rendering HTML templates: {str(e)}")
+                        import traceback
+                        logger.error(f"DEBUG: Template error traceback: {traceback.format_exc()}")
+                        main_html = f"<p>Error rendering content: {str(e)}</p>"
+                        sources_html = "<p>Error rendering sources</p>"
+                        title = "Template Error"
+                else:
+                    main_html = "<p>Error generating response from documents.</p>"
+                    sources_html = "<p>Error loading sources</p>"
+                    title = "Error"
+    
+        if response_data and response_data['partial']:
+            # a deadline fallback is never cached, so the next ask gets the full answer
+            recorder.attributes["partial"] = True
+            cacheable = False
+        if response_data and response_data['llm_failed']:
+            # nor is the fallback for a failed LLM call, which is an error page
+            recorder.attributes["llm_failed"] = True
+            cacheable = False
     
     except Exception as e:
         logger.error(f"Error in document RAG: {str(e)}")
         main_html = f"<p>Error processing request: {str(e)}</p>"
         sources_html = "<p>Error loading sources</p>"
         title = "Error"
+        cacheable = False
     
-    # Create content variables for wire_layout like price variance does
-    # Prepare content for response tab
-    references_content = ""
-    if response_data and response_data.get('references'):
-        references_content = f"""
-        <hr style="margin: 20px 0;">
-        <h3>References</h3>
-        {create_references_list(response_data['references'])}
+    if cached_result is not None:
+        title = cached_result["title"]
+        main_html = cached_result["main_html"]
+        sources_html = cached_result["sources_html"]
+        references_content = cached_result["references_content"]
+        response_content = cached_result["response_content"]
+        sources_content = cached_result["sources_content"]
+    elif compact:
+        references = response_data.get('references') if response_data else None
+        references_content = compact_references_list(references) if references else ""
+        response_content = compact_response_tab(main_html, references_content)
+        sources_content = compact_sources_tab(sources_html)
+    else:
+        # Create content variables for wire_layout like price variance does
+        # Prepare content for response tab
+        references_content = ""
+        if response_data and response_data.get('references'):
+            references_content = f"""
+            <hr style="margin: 20px 0;">
+            <h3>References</h3>
+            {create_references_list(response_data['references'])}
+            """
+    
+        response_content = f"""
+        <div style="padding: 20px;">
+            {main_html}
+            {references_content}
+        </div>
         """
     
-    response_content = f"""
-    <div style="padding: 20px;">
-        {main_html}
-        {references_content}
-    </div>
-    """
+        # Prepare content for sources tab
+        sources_content = f"""
+        <div style="padding: 20px;">
+            <h2>Document Sources</h2>
+            {create_sources_table(response_data['references']) if response_data and response_data.get('references') else sources_html}
+        </div>
+        """
     
-    # Prepare content for sources tab
-    sources_content = f"""
-    <div style="padding: 20px;">
-        <h2>Document Sources</h2>
-        {create_sources_table(response_data['references']) if response_data and response_data.get('references') else sources_html}
-    </div>
-    """
+    if cached_result is None and cacheable and use_llm_cache:
+        RESULT_CACHE.put(cache_key, {
+            "title": title,
+            "main_html": main_html,
+            "sources_html": sources_html,
+            "references_content": references_content,
+            "response_content": response_content,
+            "sources_content": sources_content
+        })
     
     # Create visualizations using wire_layout like price variance
     visualizations = []
@@ -210,7 +426,8 @@ def document_rag_explorer(parameters: SkillInput):
         response_layout_json = json.loads(parameters.arguments.response_layout)
         logger.info(f"DEBUG: Response layout parsed successfully")
         
-        rendered_response = wire_layout(response_layout_json, response_vars)
+        with recorder.span("wire_layout", tab="response", content_chars=len(response_content)):
+            rendered_response = wire_layout(response_layout_json, response_vars)
         logger.info(f"DEBUG: Response layout rendered successfully, type: {type(rendered_response)}")
         
         visualizations.append(SkillVisualization(title=title, layout=rendered_response))
@@ -226,7 +443,8 @@ def document_rag_explorer(parameters: SkillInput):
         sources_layout_json = json.loads(parameters.arguments.sources_layout)
         logger.info(f"DEBUG: Sources layout parsed successfully")
         
-        rendered_sources = wire_layout(sources_layout_json, sources_vars)
+        with recorder.span("wire_layout", tab="sources", content_chars=len(sources_content)):
+            rendered_sources = wire_layout(sources_layout_json, sources_vars)
         logger.info(f"DEBUG: Sources layout rendered successfully, type: {type(rendered_sources)}")
         
         visualizations.append(SkillVisualization(title="Sources", layout=rendered_sources))
@@ -252,6 +470,9 @@ def document_rag_explorer(parameters: SkillInput):
         ]
         logger.info(f"DEBUG: Fallback visualizations created: {len(visualizations)}")
     
+    recorder.write()
+    logger.info(f"DEBUG: Stage timings: {recorder.record()}")
+    
     # Return skill output with final_prompt for insights and narrative=None like other skills
     return SkillOutput(
         final_prompt=max_prompt,
@@ -306,6 +527,7 @@ def create_sources_table(references):
                     <a href='{ref.get('url', '#')}' target='_blank' style='color: #0066cc; text-decoration: none;'>
                         {ref.get('src', ref.get('text', 'Document'))}
                     </a>
+                    {create_duplicates_note(ref.get('duplicates'))}
                 </td>
                 <td style='padding: 12px;'>{ref.get('page', '?')}</td>
                 <td style='padding: 12px;'>{match_score}</td>
@@ -315,88 +537,188 @@ def create_sources_table(references):
     html_parts.append("</tbody></table>")
     return ''.join(html_parts)
 
-def load_document_sources():
-    """Load document sources from pack.json bundled with the skill"""
-    loaded_sources = []
-    
+def create_duplicates_note(duplicates):
+    """Note listing the other places a near-duplicate page appears, empty when there are none"""
+    if not duplicates:
+        return ""
+    places = ", ".join(f"{duplicate['file_name']} page {duplicate['chunk_index']}" for duplicate in duplicates)
+    return f"<div style='font-size: 12px; color: #666;'>Also in: {html.escape(places)}</div>"
+
+def find_pack_in(directory):
+    """Compiled chunk store or pack.json in directory; a store is preferred unless pack.json is newer"""
+    pack_file = os.path.join(directory, "pack.json")
+    store_file = get_store_path(pack_file)
+    if os.path.exists(store_file):
+        if not os.path.exists(pack_file) or os.path.getmtime(store_file) >= os.path.getmtime(pack_file):
+            return store_file
+        logger.warning(f"DEBUG: Ignoring chunk store older than pack.json: {store_file}")
+    return pack_file if os.path.exists(pack_file) else None
+
+def get_skill_resources_dir():
+    """Skill Resources workspace directory, or None when the environment does not identify the skill"""
     try:
-        # First, try to load pack.json from the same directory as this skill file
-        skill_dir = os.path.dirname(os.path.abspath(__file__))
-        pack_file = os.path.join(skill_dir, "pack.json")
-        
-        logger.info(f"DEBUG: Looking for pack.json in skill directory: {pack_file}")
+        from ar_paths import ARTIFACTS_PATH
+        logger.info(f"DEBUG: Successfully imported ARTIFACTS_PATH: {ARTIFACTS_PATH}")
+    except ImportError as e:
+        logger.info(f"DEBUG: Could not import ar_paths, using environment variable: {e}")
+        ARTIFACTS_PATH = os.environ.get('AR_DATA_BASE_PATH', '/artifacts')
+    
+    # Get environment variables for path construction
+    tenant = os.environ.get('AR_TENANT_ID', 'maxstaging')
+    copilot = os.environ.get('AR_COPILOT_ID', '')
+    skill_id = os.environ.get('AR_COPILOT_SKILL_ID', '')
+    
+    if not (copilot and skill_id):
+        return None
+    return os.path.join(
+        ARTIFACTS_PATH,
+        tenant,
+        "skill_workspaces",
+        copilot,
+        skill_id
+    )
+
+def resolve_pack_file():
+    """Locate the knowledge pack: skill bundle, then data/, then Skill Resources. Returns None if not found"""
+    # First, try to load pack.json from the same directory as this skill file
+    skill_dir = os.path.dirname(os.path.abspath(__file__))
+    
+    logger.info(f"DEBUG: Looking for pack.json in skill directory: {skill_dir}")
+    pack_file = find_pack_in(skill_dir)
+    
+    # Check if pack.json exists in the skill directory
+    if not pack_file:
+        # Try looking in a 'data' subdirectory
+        pack_file = find_pack_in(os.path.join(skill_dir, "data"))
         
-        # Check if pack.json exists in the skill directory
-        if not os.path.exists(pack_file):
-            # Try looking in a 'data' subdirectory
-            data_dir = os.path.join(skill_dir, "data")
-            pack_file_data = os.path.join(data_dir, "pack.json")
+        if pack_file:
+            logger.info(f"DEBUG: Found pack in data directory: {pack_file}")
+        else:
+            # Fallback: try the old Skill Resources path if environment variables are available
+            logger.info(f"DEBUG: pack.json not found in skill bundle, trying Skill Resources as fallback")
+            resource_dir = get_skill_resources_dir()
             
-            if os.path.exists(pack_file_data):
-                pack_file = pack_file_data
-                logger.info(f"DEBUG: Found pack.json in data directory: {pack_file}")
-            else:
-                # Fallback: try the old Skill Resources path if environment variables are available
-                logger.info(f"DEBUG: pack.json not found in skill bundle, trying Skill Resources as fallback")
-                
-                try:
-                    from ar_paths import ARTIFACTS_PATH
-                    logger.info(f"DEBUG: Successfully imported ARTIFACTS_PATH: {ARTIFACTS_PATH}")
-                except ImportError as e:
-                    logger.info(f"DEBUG: Could not import ar_paths, using environment variable: {e}")
-                    ARTIFACTS_PATH = os.environ.get('AR_DATA_BASE_PATH', '/artifacts')
-                
-                # Get environment variables for path construction
-                tenant = os.environ.get('AR_TENANT_ID', 'maxstaging')
-                copilot = os.environ.get('AR_COPILOT_ID', '')
-                skill_id = os.environ.get('AR_COPILOT_SKILL_ID', '')
-                
-                if copilot and skill_id:
-                    resource_path = os.path.join(
-                        ARTIFACTS_PATH,
-                        tenant,
-                        "skill_workspaces",
-                        copilot,
-                        skill_id,
-                        "pack.json"
-                    )
-                    if os.path.exists(resource_path):
-                        pack_file = resource_path
-                        logger.info(f"DEBUG: Found pack.json in Skill Resources: {pack_file}")
-                    else:
-                        pack_file = None
-                        logger.warning(f"DEBUG: No pack.json found in bundle or Skill Resources")
+            if resource_dir:
+                pack_file = find_pack_in(resource_dir)
+                if pack_file:
+                    logger.info(f"DEBUG: Found pack in Skill Resources: {pack_file}")
                 else:
-                    pack_file = None
-                    logger.warning(f"DEBUG: No pack.json found and missing environment variables for Skill Resources")
-        else:
-            logger.info(f"DEBUG: Found pack.json in skill bundle: {pack_file}")
+                    logger.warning(f"DEBUG: No pack.json found in bundle or Skill Resources")
+            else:
+                logger.warning(f"DEBUG: No pack.json found and missing environment variables for Skill Resources")
+    else:
+        logger.info(f"DEBUG: Found pack in skill bundle: {pack_file}")
+    
+    return pack_file
+
+def resolve_pack_files():
+    """Every knowledge pack for federated search: the bundle, data/ and its subdirectories, then Skill Resources and its subdirectories"""
+    skill_dir = os.path.dirname(os.path.abspath(__file__))
+    directories = [skill_dir]
+    for root in (os.path.join(skill_dir, "data"), get_skill_resources_dir()):
+        if root and os.path.isdir(root):
+            directories.append(root)
+            directories.extend(sorted(glob.glob(os.path.join(root, "*", ""))))
+    
+    pack_files = []
+    for directory in directories:
+        pack_file = find_pack_in(directory)
+        if pack_file and os.path.abspath(pack_file) not in pack_files:
+            pack_files.append(os.path.abspath(pack_file))
+    logger.info(f"DEBUG: Found {len(pack_files)} packs for federated search: {pack_files}")
+    return pack_files
+
+def _get_env_key():
+    return tuple(os.environ.get(name, '') for name in ('AR_DATA_BASE_PATH', 'AR_TENANT_ID', 'AR_COPILOT_ID', 'AR_COPILOT_SKILL_ID'))
+
+def get_pack_file():
+    """resolve_pack_file() memoized for the current Skill Resources environment"""
+    return get_cached_path(_get_env_key(), resolve_pack_file)
+
+def load_document_pack(search_scope="pack"):
+    """Cached pack for the resolved pack.json (every discovered pack for "all_packs"), or None if no pack is found"""
+    if search_scope == "all_packs":
+        # discovery is cheap next to a query and must notice newly added packs, so it is not memoized
+        packs = [pack for pack in (load_pack(pack_file) for pack_file in resolve_pack_files()) if pack.sources]
+        return FederatedPack(packs) if packs else None
+    pack_file = get_pack_file()
+    if not pack_file:
+        logger.warning("pack.json not found in any expected locations")
+        return None
+    return load_pack(pack_file)
+
+def load_pack(pack_file):
+    """Cached pack for one pack.json or compiled chunk store"""
+    if pack_file.endswith(STORE_EXTENSION):
+        return get_cached_pack(pack_file, ChunkStore.open, checksum=read_store_checksum)
+    if os.path.getsize(pack_file) >= STREAMING_PACK_BYTES:
+        # Too large to hold as Python strings: stream it into a memory-mapped chunk store
+        return get_cached_pack(pack_file, open_compiled_pack)
+    return get_cached_pack(pack_file, load_document_sources)
+
+def get_retrieval_index(pack, retrieval_method="bm25", top_files=0):
+    """
+    BM25, vector or ANN index for a cached pack, built once per pack version; None for a full scan.
+    
+    With top_files, the index first narrows each question to the chunks of its top_files best
+    files by Description and Summary.
+    """
+    if isinstance(pack, FederatedPack):
+        if retrieval_method == "scan" and not top_files:
+            return None
+        # one index per pack, each persisted and invalidated on its own
+        return FederatedIndex([get_retrieval_index(member, retrieval_method, top_files) for member in pack.packs], pack.sources)
+    chunk_index = get_chunk_index(pack, retrieval_method)
+    if not top_files:
+        return chunk_index
+    router = pack.get_derived("files", lambda: FileRouter.build(pack.sources, get_file_profiles(pack.path)))
+    return TwoLevelIndex(router, chunk_index, pack.sources, top_files, scorer=calculate_simple_relevance)
+
+def get_table_index(pack):
+    """Markdown table facts of a cached pack, built once per pack version"""
+    if isinstance(pack, FederatedPack):
+        return FederatedTableIndex([get_table_index(member) for member in pack.packs], pack.sources)
+    return pack.get_derived("tables", lambda: load_or_build_table_index(pack.path, pack.sources))
+
+def get_file_profiles(pack_file):
+    """Per-file Description and Summary text from pack.json; compiled stores read the pack.json they came from"""
+    if pack_file.endswith(STORE_EXTENSION):
+        pack_file = os.path.splitext(pack_file)[0] + ".json"
+    if not os.path.exists(pack_file):
+        logger.warning(f"DEBUG: No pack.json with file summaries at {pack_file}, ranking files by name only")
+        return {}
+    return read_file_profiles(pack_file)
+
+def get_chunk_index(pack, retrieval_method):
+    """Chunk-level index for retrieval_method, or None for a full scan"""
+    if retrieval_method == "scan":
+        return None
+    if retrieval_method == "vector":
+        return pack.get_derived("vector", lambda: load_or_build_vector_index(pack.path, pack.sources))
+    if retrieval_method == "ann":
+        return pack.get_derived("ann", lambda: load_or_build_ann_index(pack.path, pack.sources))
+    return pack.get_derived("bm25", lambda: load_or_build_index(pack.path, pack.sources))
+
+def load_document_sources(pack_file=None):
+    """Load document sources from pack.json bundled with the skill"""
+    loaded_sources = []
+    
+    try:
+        if pack_file is None:
+            pack_file = resolve_pack_file()
         
         if pack_file and os.path.exists(pack_file):
             logger.info(f"Loading documents from: {pack_file}")
-            with open(pack_file, 'r', encoding='utf-8') as f:
-                resource_contents = json.load(f)
-                logger.info(f"DEBUG: Loaded JSON structure type: {type(resource_contents)}")
-                
-                # Handle different pack.json formats
-                if isinstance(resource_contents, list):
-                    logger.info(f"DEBUG: Processing {len(resource_contents)} files from pack.json")
-                    # Format: [{"File": "doc.pdf", "Chunks": [{"Text": "...", "Page": 1}]}]
-                    for processed_file in resource_contents:
-                        file_name = processed_file.get("File", "unknown_file")
-                        chunks = processed_file.get("Chunks", [])
-                        logger.info(f"DEBUG: Processing file '{file_name}' with {len(chunks)} chunks")
-                        for chunk in chunks:
-                            res = {
-                                "file_name": file_name,
-                                "text": chunk.get("Text", ""),
-                                "description": str(chunk.get("Text", ""))[:200] + "..." if len(str(chunk.get("Text", ""))) > 200 else str(chunk.get("Text", "")),
-                                "chunk_index": chunk.get("Page", 1),
-                                "citation": file_name
-                            }
-                            loaded_sources.append(res)
+            if pack_file.endswith(STORE_EXTENSION):
+                loaded_sources = list(ChunkStore.open(pack_file))
+            else:
+                # Format: [{"File": "doc.pdf", "Chunks": [{"Text": "...", "Page": 1}]}], parsed one file at a time.
+                # Near-duplicate pages are folded into one chunk that keeps all their citations,
+                # unless RAG_DEDUP=off.
+                if dedup_enabled():
+                    loaded_sources = dedupe_sources(iter_pack_sources(pack_file))
                 else:
-                    logger.warning(f"Unexpected pack.json format - expected array of files, got: {type(resource_contents)}")
+                    loaded_sources = [dict(source, duplicates=[]) for source in iter_pack_sources(pack_file)]
         else:
             logger.warning("pack.json not found in any expected locations")
             
@@ -408,18 +730,28 @@ def load_document_sources():
     logger.info(f"Loaded {len(loaded_sources)} document chunks from pack.json")
     return loaded_sources
 
-def find_matching_documents(user_question, topics, loaded_sources, base_url, max_sources, match_threshold, max_characters):
-    """Find documents matching the user question using embedding-based semantic matching"""
+def find_matching_documents(user_question, topics, loaded_sources, base_url, max_sources, match_threshold, max_characters, index=None, max_tokens=None, passage_context=None, table_index=None, top_ids=None, stats=None):
+    """Find documents matching the user question using embedding-based semantic matching
+    
+    When an index over loaded_sources is given (BM25 or vector), its search() ranks the
+    chunks; otherwise every chunk goes through calculate_simple_relevance, sharded across
+    a process pool for large packs. With passage_context, each candidate also gets a
+    'passage': the text within passage_context characters of a query-term hit. When a
+    table_index answers the question as a direct lookup, the chunks holding the matching
+    table rows are the candidates instead and their passage is just those rows. top_ids skips
+    ranking with precomputed (doc_id, score) candidates, e.g. from a batch search. The candidates
+    are then packed into max_tokens of passage (or chunk) text, max_characters / CHARS_PER_TOKEN
+    when not given, best-scoring set first. A stats dict, when given, receives 'candidates' (chunks
+    the index, scan or table lookup returned above the threshold, before packing) and, for a scan,
+    'scored' (every chunk, as each one is scored).
+    """
     logger.info("DEBUG: Starting embedding-based document matching")
     
     try:
-        import os
-        
         logger.info(f"DEBUG: Matching against {len(loaded_sources)} document sources")
         
         # Simple text-based matching since sp_tools is not available
         matches = []
-        chars_so_far = 0
         
         # Combine all search terms
         search_terms = []
@@ -429,25 +761,47 @@ def find_matching_documents(user_question, topics, loaded_sources, base_url, max
         
         logger.info(f"DEBUG: Searching for {len(search_terms)} search terms")
         
-        # Score each document source
-        for source in loaded_sources:
-            if len(matches) >= int(max_sources) or chars_so_far >= int(max_characters):
-                break
-            
-            # Calculate relevance score
-            score = calculate_simple_relevance(source['text'], search_terms)
+        # Global top-k over every candidate above the threshold, independent of file order.
+        # Sources are only looked up for the candidates so compiled stores decode just those texts.
+        threshold = float(match_threshold)
+        num_candidates = int(max_sources) * CANDIDATE_POOL_FACTOR
+        table_hits = table_index.lookup(search_terms, threshold, num_candidates) if table_index is not None else []
+        if table_hits:
+            # Direct lookup: the matching table rows are the whole context
+            candidates = [(dict(loaded_sources[doc_id], passage=facts), score) for doc_id, score, facts in table_hits]
+            logger.info(f"DEBUG: Answering from {len(candidates)} chunks of table facts")
+        else:
+            if top_ids is not None:
+                logger.info(f"DEBUG: Using {len(top_ids)} precomputed chunks")
+            elif index is not None:
+                top_ids = index.search(search_terms, num_candidates, threshold)
+                logger.info(f"DEBUG: {type(index).__name__} returned {len(top_ids)} chunks")
+            else:
+                top_ids = score_chunks(calculate_simple_relevance, loaded_sources, search_terms, threshold, num_candidates)
+                if stats is not None:
+                    stats["scored"] = len(loaded_sources)
+            candidates = [(loaded_sources[doc_id], score) for doc_id, score in top_ids]
             
-            if score >= float(match_threshold):
-                source_copy = source.copy()
-                source_copy['match_score'] = score
-                source_copy['url'] = f"{base_url.rstrip('/')}/{source_copy['file_name']}#page={source_copy['chunk_index']}"
-                matches.append(source_copy)
-                chars_so_far += len(source_copy['text'])
-                logger.info(f"DEBUG: Added match with score {score}: {source_copy['file_name']} page {source_copy['chunk_index']}")
-        
-        # Sort by relevance score (descending)
-        matches.sort(key=lambda x: x['match_score'], reverse=True)
-        matches = matches[:int(max_sources)]
+            # Cut candidates down to the windows around query-term hits; only passages reach the prompt
+            if passage_context:
+                term_pattern = compile_term_pattern(search_terms)
+                candidates = [(dict(source, passage=extract_passage(source['text'], term_pattern, int(passage_context))), score)
+                              for source, score in candidates]
+        
+        if stats is not None:
+            stats["candidates"] = len(candidates)
+        
+        # Most relevant non-duplicate set of chunks that fits the prompt token budget
+        token_budget = int(max_tokens) if max_tokens else int(max_characters) // CHARS_PER_TOKEN
+        top_sources = pack_context(candidates, token_budget, int(max_sources))
+        logger.info(f"DEBUG: Packed {len(top_sources)} of {len(candidates)} candidates into {token_budget} tokens")
+        
+        for source, score in top_sources:
+            source_copy = source.copy()
+            source_copy['match_score'] = score
+            source_copy['url'] = f"{base_url.rstrip('/')}/{source_copy['file_name']}#page={source_copy['chunk_index']}"
+            matches.append(source_copy)
+            logger.info(f"DEBUG: Added match with score {score}: {source_copy['file_name']} page {source_copy['chunk_index']}")
         
         logger.info(f"DEBUG: Final matches: {len(matches)}")
         return [SimpleNamespace(**match) for match in matches]
@@ -459,65 +813,136 @@ def find_matching_documents(user_question, topics, loaded_sources, base_url, max
         raise e
 
 def calculate_simple_relevance(text, search_terms):
-    """Calculate simple relevance score (placeholder for embedding similarity)"""
-    text_lower = text.lower()
-    score = 0.0
-    
-    logger.info(f"DEBUG: Calculating relevance for text snippet: '{text_lower[:100]}...'")
-    logger.info(f"DEBUG: Search terms: {search_terms}")
-    
-    for term in search_terms:
-        if term and term.lower() in text_lower:
-            # Count occurrences and normalize - give higher score for exact matches
-            occurrences = text_lower.count(term.lower())
-            term_score = min(occurrences * 0.4, 1.0)  # Higher score for exact phrase matches
-            score += term_score
-            logger.info(f"DEBUG: Found exact match '{term}' {occurrences} times, added {term_score} to score")
-        else:
-            # Check for partial matches
-            term_words = term.lower().split()
-            for word in term_words:
-                if len(word) > 3 and word in text_lower:  # Only check words longer than 3 chars
-                    occurrences = text_lower.count(word)
-                    if occurrences > 0:
-                        # Generic scoring based on word length and frequency
-                        base_score = 0.2 if len(word) > 6 else 0.15  # Longer words get slightly higher base score
-                        term_score = min(occurrences * base_score, 0.5)
-                        score += term_score
-                        logger.info(f"DEBUG: Found partial match '{word}' {occurrences} times, added {term_score} to score")
-    
-    final_score = min(score, 1.0)
-    logger.info(f"DEBUG: Final relevance score: {final_score}")
-    return final_score
-
-def generate_rag_response(user_question, docs):
-    """Generate response using LLM with document context"""
-    if not docs:
-        return None
+    """Calculate simple relevance score (placeholder for embedding similarity)
+    
+    Phrase matches add 0.4 per occurrence (capped at 1.0); when a phrase is absent, each of
+    its words longer than 3 characters adds 0.15-0.2 per occurrence (capped at 0.5). All
+    patterns are counted in one pass by a matcher compiled once per query.
+    """
+    return get_term_matcher(tuple(search_terms)).score(text)
+
+def get_llm_backend():
+    """Name of the LLM backend get_llm_client() returns, "local" or "platform"; completion cache entries are keyed by it"""
+    return "local" if os.environ.get(LLM_BACKEND_ENV) == "local" else "platform"
+
+def get_llm_client():
+    """ArUtils like other skills use, or the offline LocalLLM when RAG_LLM_BACKEND=local"""
+    if get_llm_backend() == "local":
+        return LocalLLM(latency_seconds=float(os.environ.get(LOCAL_LLM_LATENCY_ENV) or 0))
+    from ar_analytics import ArUtils
+    return ArUtils()
+
+def parse_latency_ms(value):
+    """Whole milliseconds of a max_latency_ms value ("1500", "1500.0", 1500); 0 (no deadline) if it is not a number"""
+    try:
+        return max(0, int(float(value or 0)))
+    except (TypeError, ValueError, OverflowError):
+        logger.warning(f"DEBUG: Ignoring max_latency_ms={value!r}, answering without a deadline")
+        return 0
+
+def run_with_timeout(function, timeout):
+    """function() on a daemon worker thread, raising TimeoutError if it takes longer than timeout seconds
+    
+    A call that times out is abandoned, not cancelled: it finishes in the background, so an
+    LLM completion still lands in the completion cache for the next ask.
+    """
+    future = Future()
+    
+    def run():
+        try:
+            future.set_result(function())
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=run, name="rag-llm", daemon=True).start()
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        raise TimeoutError(f"no LLM response within {timeout * 1000:.0f}ms")
+
+def call_llm(prompt, use_llm_cache=True):
+    """LLM completion for prompt, looked up in the on-disk completion cache first unless use_llm_cache is False"""
+    completion_cache = get_completion_cache() if use_llm_cache else None
+    backend = get_llm_backend()
+    llm_response = completion_cache.get(prompt, backend) if completion_cache is not None else None
     
-    # Build facts from documents for LLM prompt
+    if llm_response is not None:
+        logger.info("DEBUG: Using cached LLM completion")
+        return llm_response
+    logger.info("DEBUG: Making LLM call with ArUtils")
+    llm_response = get_llm_client().get_llm_response(prompt)
+    if completion_cache is not None and llm_response:
+        completion_cache.put(prompt, llm_response, backend)
+    return llm_response
+
+def format_source_facts(docs, start=1):
+    """Prompt block for docs, numbered from start"""
     facts = []
-    for i, doc in enumerate(docs):
-        facts.append(f"====== Source {i+1} ====")
+    for i, doc in enumerate(docs, start):
+        facts.append(f"====== Source {i} ====")
         facts.append(f"File and page: {doc.file_name} page {doc.chunk_index}")
         facts.append(f"Description: {doc.description}")
         facts.append(f"Citation: {doc.url}")
-        facts.append(f"Content: {doc.text}")
+        facts.append(f"Content: {getattr(doc, 'passage', doc.text)}")
         facts.append("")
+    return "\n".join(facts)
+
+def generate_map_reduce_response(user_question, docs, use_llm_cache=True, group_size=MAP_GROUP_SIZE):
+    """Map-reduce generation for wide retrievals
+    
+    Sources are split into groups of group_size and a fact-extraction call runs for every
+    group concurrently, keeping the global source numbers. One short synthesis call then
+    answers from the extracted facts, so latency follows the slowest group instead of the
+    total prompt size.
+    
+    Returns:
+        (synthesis prompt, LLM response)
+    """
+    groups = [(start, docs[start:start + group_size]) for start in range(0, len(docs), group_size)]
+    
+    def extract(group):
+        start, group_docs = group
+        prompt = TEMPLATES.render("fact_extraction_prompt", user_query=user_question, facts=format_source_facts(group_docs, start + 1))
+        return call_llm(prompt, use_llm_cache)
+    
+    with ThreadPoolExecutor(max_workers=min(len(groups), MAX_CONCURRENT_LLM_CALLS), thread_name_prefix="rag-map") as executor:
+        extractions = list(executor.map(extract, groups))
+    
+    fact_lines = [line.strip() for extraction in extractions for line in (extraction or "").splitlines()
+                  if line.strip().startswith("- ")]
+    logger.info(f"DEBUG: Extracted {len(fact_lines)} facts from {len(groups)} source groups")
+    synthesis = TEMPLATES.render("synthesis_prompt", user_query=user_question, facts="\n".join(fact_lines) or "NONE")
+    return synthesis, call_llm(synthesis, use_llm_cache)
+
+def generate_rag_response(user_question, docs, use_llm_cache=True, generation_mode="single", timeout=None):
+    """Generate response using LLM with document context
+    
+    Completions are looked up in the on-disk completion cache by the rendered prompt first
+    unless use_llm_cache is False. generation_mode "map_reduce" extracts facts from groups of
+    sources concurrently before one synthesis call (see generate_map_reduce_response).
+    With a timeout (seconds), the LLM work runs on a worker thread; when it does not finish in
+    time the response is the fallback built from the documents' passages, with 'partial' set.
+    When the LLM call fails the same fallback is returned with 'llm_failed' set.
+    """
+    if not docs:
+        return None
     
     # Create the prompt for the LLM
-    prompt_template = Template(narrative_prompt)
-    full_prompt = prompt_template.render(
+    full_prompt = TEMPLATES.render(
+        "narrative_prompt",
         user_query=user_question,
-        facts="\n".join(facts)
+        facts=format_source_facts(docs)
     )
     
+    def complete():
+        if generation_mode == "map_reduce" and len(docs) > MAP_GROUP_SIZE:
+            return generate_map_reduce_response(user_question, docs, use_llm_cache)
+        return full_prompt, call_llm(full_prompt, use_llm_cache)
+    
+    partial = False
+    llm_failed = False
     try:
-        # Use ArUtils for LLM calls like other skills do
-        logger.info("DEBUG: Making LLM call with ArUtils")
-        from ar_analytics import ArUtils
-        ar_utils = ArUtils()
-        llm_response = ar_utils.get_llm_response(full_prompt)
+        full_prompt, llm_response = complete() if timeout is None else run_with_timeout(complete, timeout)
         
         logger.info(f"DEBUG: Got LLM response: {llm_response[:100]}...")
         
@@ -536,12 +961,16 @@ def generate_rag_response(user_question, docs):
         logger.info(f"DEBUG: Parsed content: {content[:100]}...")
         
     except Exception as e:
-        logger.error(f"DEBUG: ArUtils LLM call failed: {e}")
+        # Past the deadline the same fallback is returned, marked as partial
+        partial = isinstance(e, TimeoutError)
+        llm_failed = not partial
+        logger.error(f"DEBUG: ArUtils LLM call {'timed out' if partial else 'failed'}: {e}")
         # Fallback to a structured response
         title = f"Analysis: {user_question}"
-        content = f"<p>Based on the available documents, here's what I found regarding: <strong>{user_question}</strong></p>"
+        content = PARTIAL_ANSWER_NOTE if partial else ""
+        content += f"<p>Based on the available documents, here's what I found regarding: <strong>{user_question}</strong></p>"
         for i, doc in enumerate(docs):
-            doc_text = str(doc.text) if doc.text else ""
+            doc_text = str(getattr(doc, 'passage', doc.text) or "")
             clean_text = doc_text.replace(f"START OF PAGE: {doc.chunk_index}", "").strip()
             clean_text = clean_text.replace(f"END OF PAGE: {doc.chunk_index}", "").strip()
             if clean_text and len(clean_text) > 20:
@@ -562,40 +991,99 @@ def generate_rag_response(user_question, docs):
             'page': doc.chunk_index,
             'text': f"Document: {doc.file_name}",
             'preview': preview_text,
-            'thumbnail': ""  # Would be populated with actual thumbnail if available
+            'thumbnail': "",  # Would be populated with actual thumbnail if available
+            'duplicates': getattr(doc, 'duplicates', [])  # Same page elsewhere in the pack
         }
         references.append(ref)
-        
-        return {
-            'title': title,
-            'content': content,
-            'references': references,
-            'raw_prompt': full_prompt  # For debugging
-        }
+    
+    return {
+        'title': title,
+        'content': content,
+        'references': references,
+        'partial': partial,  # LLM deadline passed, content is the passage fallback
+        'llm_failed': llm_failed,  # LLM call raised, content is the passage fallback
+        'raw_prompt': full_prompt  # For debugging
+    }
 
-def force_ascii_replace(html_string):
-    """Clean HTML string for safe rendering"""
-    # Remove null characters
-    cleaned = html_string.replace('\u0000', '')
+def answer_questions(questions, base_url="", max_sources=5, match_threshold=0.2, max_characters=3000,
+                     max_context_tokens=None, passage_context=DEFAULT_CONTEXT_CHARS, retrieval_method="bm25",
+                     top_files=0, table_lookup=True, search_scope="pack", use_llm_cache=True,
+                     generation_mode="single", max_concurrent_llm_calls=MAX_CONCURRENT_LLM_CALLS, max_latency_ms=None):
+    """Answer a batch of questions against one pack, for evaluation and cache pre-warming jobs
     
-    # Escape special characters, but preserve existing HTML entities
-    cleaned = re.sub(r'&(?!amp;|lt;|gt;|quot;|apos;|#\d+;|#x[0-9a-fA-F]+;)', '&amp;', cleaned)
+    The pack and its indexes are loaded once and all questions are ranked in one batch
+    (shared postings for BM25, one matrix product for vectors). The per-question LLM calls
+    then run concurrently, at most max_concurrent_llm_calls at a time, each given up after
+    max_latency_ms in favour of the passage fallback.
     
-    # Replace problematic characters with HTML entities
-    cleaned = cleaned.replace('"', '&quot;')
-    cleaned = cleaned.replace("'", '&#39;')
-    cleaned = cleaned.replace('–', '&ndash;')
-    cleaned = cleaned.replace('—', '&mdash;')
-    cleaned = cleaned.replace('…', '&hellip;')
+    Returns:
+        one dict per question, in order: question, title, content, references (as built by
+        generate_rag_response), sources (file_name, page, score, url), partial (True when the
+        content is the passage fallback after max_latency_ms) and error (None, or why the
+        question could not be answered)
+    """
+    results = [{'question': question, 'title': None, 'content': None, 'references': [], 'sources': [], 'partial': False,
+                'error': None} for question in questions]
+    pack = load_document_pack(search_scope)
+    loaded_sources = pack.sources if pack else []
+    if not loaded_sources:
+        for result in results:
+            result['error'] = "No document sources found"
+        return results
+    
+    index = get_retrieval_index(pack, retrieval_method, top_files)
+    table_index = get_table_index(pack) if table_lookup else None
+    queries = [[question] for question in questions]
+    num_candidates = int(max_sources) * CANDIDATE_POOL_FACTOR
+    max_latency_ms = parse_latency_ms(max_latency_ms)
+    if index is not None:
+        rankings = search_batch(index, queries, num_candidates, float(match_threshold))
+    else:
+        rankings = [score_chunks(calculate_simple_relevance, loaded_sources, search_terms, float(match_threshold), num_candidates)
+                    for search_terms in queries]
+    logger.info(f"DEBUG: Ranked {len(questions)} questions against {len(loaded_sources)} chunks")
     
-    # Convert curly quotes to straight quotes
-    cleaned = cleaned.replace('"', '"').replace('"', '"')
-    cleaned = cleaned.replace(''', "'").replace(''', "'")
+    def answer(position):
+        question = questions[position]
+        result = results[position]
+        try:
+            docs = find_matching_documents(
+                user_question=question,
+                topics=[],
+                loaded_sources=loaded_sources,
+                base_url=base_url,
+                max_sources=max_sources,
+                match_threshold=match_threshold,
+                max_characters=max_characters,
+                max_tokens=max_context_tokens,
+                passage_context=passage_context,
+                table_index=table_index,
+                top_ids=rankings[position]
+            )
+            if not docs:
+                result['error'] = "No relevant documents found"
+                return
+            result['sources'] = [{'file_name': doc.file_name, 'page': doc.chunk_index, 'score': doc.match_score, 'url': doc.url}
+                                 for doc in docs]
+            response = generate_rag_response(question, docs, use_llm_cache=use_llm_cache, generation_mode=generation_mode,
+                                             timeout=max_latency_ms / 1000 if max_latency_ms else None)
+            result.update(title=response['title'], content=response['content'], references=response['references'],
+                          partial=response['partial'])
+        except Exception as e:
+            logger.error(f"ERROR: Batch question failed: {question}: {e}")
+            result['error'] = str(e)
     
-    # Remove any remaining control characters
-    cleaned = ''.join(ch for ch in cleaned if ord(ch) >= 32 or ch in '\n\r\t')
+    with ThreadPoolExecutor(max_workers=max(1, int(max_concurrent_llm_calls)), thread_name_prefix="rag-batch") as executor:
+        list(executor.map(answer, range(len(questions))))
+    return results
+
+def force_ascii_replace(html_string):
+    """Clean HTML string for safe rendering
     
-    return cleaned
+    Escapes bare ampersands, turns quotes and dashes into entities and drops control
+    characters, skipping the passes with nothing to do (see rag_utils.html_sanitizer).
+    """
+    return sanitize_html(html_string)
 
 # HTML Templates
 
@@ -636,6 +1124,29 @@ Answer this question: {{user_query}}
 
 {{facts}}"""
 
+# Map step of map-reduce generation: one call per group of sources
+fact_extraction_prompt = """
+Extract the facts from the sources below that help answer the user's question. Write one fact per line, starting with "- " and ending with the number of the source it came from in square brackets, like:
+- Clouds scatter all colors of light equally [2]
+
+Keep numbers, names and units exactly as written. Only use the sources provided. If no source is relevant, reply with NONE.
+
+Question: {{user_query}}
+
+### Sources
+{{facts}}"""
+
+# Reduce step of map-reduce generation: answer from the extracted facts
+synthesis_prompt = """
+Answer the user's question from the facts below by writing a short headline between <title> tags then detail the supporting info for that answer in HTML between <content> tags. Each fact ends with its source number in square brackets; cite it as <sup>[source number]</sup> using exactly that number.
+
+Base your answer solely on the provided facts, avoiding assumptions.
+
+Answer this question: {{user_query}}
+
+### Facts
+{{facts}}"""
+
 # Main response template (simplified for skill framework)
 main_response_template = """
 <div style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif; line-height: 1.6; color: #2d3748; max-width: 100%; margin: 0 auto;">
@@ -719,6 +1230,19 @@ sources_template = """
     }
 </style>"""
 
+# Every prompt and HTML template, compiled once per process (and cached on disk when
+# RAG_TEMPLATE_CACHE_DIR is set)
+TEMPLATES = TemplateRenderer(
+    {
+        "narrative_prompt": narrative_prompt,
+        "fact_extraction_prompt": fact_extraction_prompt,
+        "synthesis_prompt": synthesis_prompt,
+        "main_response": main_response_template,
+        "sources": sources_template,
+    },
+    bytecode_cache_dir=os.environ.get(BYTECODE_CACHE_ENV)
+)
+
 if __name__ == '__main__':
     skill_input = document_rag_explorer.create_input(
         arguments={
@@ -0,0 +1,298 @@
+"""
+Approximate nearest-neighbour (IVF) index over chunk vectors.
+
+Chunk vectors from the vector index are clustered with spherical k-means into
+coarse lists. Vectors are stored reordered by list, so probing a list is a
+contiguous slice. A query scores the centroids, probes the n_probe closest lists
+and ranks only their members with the same relevance score as exact search.
+Query cost is then roughly (n_lists + n_probe * N / n_lists) * dims instead of
+N * dims. Raising n_probe trades latency for recall; n_probe == n_lists is exact. By
+default a fixed fraction of the lists is probed (default_probe_count): a fixed probe count
+would cover an ever smaller share of the index as packs grow.
+
+There are 4 * sqrt(N) lists rather than sqrt(N): with coarse lists, chunks on a topic that
+is only a small part of their list sit behind a diluted centroid, and the queries about it
+need most of the lists probed. Finer lists keep recall at a small probe share as N grows,
+at the cost of a longer k-means build.
+
+The reordered vectors are stored as float16 in a .npy file next to the index and
+memory-mapped on load, so a process only pages in the lists it probes instead of
+holding every vector (2 bytes per dimension on disk, nothing up front in RAM). Scoring
+only reads the columns where the (sparse) query is nonzero, converted to float32.
+
+See benchmarks/bench_rag_retrieval.py for recall against exact search, and "ann_scale"
+for latency and memory of a memory-mapped million-chunk index.
+"""
+
+import glob
+import logging
+import math
+import os
+import uuid
+
+import numpy as np
+
+from rag_utils.index_storage import load_or_build
+from rag_utils.vector_index import DEFAULT_DIMENSIONS, HashedVectorizer, VectorIndex, embed_query, relevance, top_k_scores, update_rows
+
+logger = logging.getLogger(__name__)
+
+IVF_FORMAT_VERSION = 4
+# storage type of the list vectors; scores are computed in float32
+VECTOR_DTYPE = np.float16
+# default probes: this share of the lists, but at least MIN_PROBES (see default_probe_count)
+PROBE_FRACTION = 0.125
+MIN_PROBES = 16
+# coarse lists per sqrt(N) chunks (see default_list_count)
+LISTS_PER_SQRT_N = 4
+KMEANS_ITERATIONS = 10
+# points per centroid used to train k-means, the rest are only assigned
+KMEANS_SAMPLES_PER_LIST = 32
+ASSIGN_BATCH_SIZE = 16384
+
+
+def default_list_count(num_docs):
+    """LISTS_PER_SQRT_N * sqrt(N) coarse lists; tiny packs get a single list, i.e. exact search"""
+    if num_docs < 1024:
+        return 1
+    return int(LISTS_PER_SQRT_N * math.sqrt(num_docs))
+
+
+def default_probe_count(n_lists):
+    """Lists probed per query when no n_probe is set: PROBE_FRACTION of n_lists, at least MIN_PROBES"""
+    return min(n_lists, max(MIN_PROBES, math.ceil(PROBE_FRACTION * n_lists)))
+
+
+def _assign(matrix, centroids):
+    """Closest centroid (by inner product) for every row, in batches to bound memory"""
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), ASSIGN_BATCH_SIZE):
+        batch = matrix[start:start + ASSIGN_BATCH_SIZE]
+        assignments[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(matrix, n_lists, iterations=KMEANS_ITERATIONS, seed=0):
+    """Spherical k-means on a sample of the rows; returns unit-norm centroids"""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(matrix), n_lists * KMEANS_SAMPLES_PER_LIST)
+    sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = _assign(sample, centroids)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=n_lists)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        nonempty = counts > 0
+        sums[nonempty] = np.add.reduceat(sample[order], starts[nonempty], axis=0)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # re-seed empty lists with random sample points
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        norms[empty] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+def _score_rows(rows, query):
+    """relevance() of stored float16 rows, reading only the query's nonzero columns"""
+    support = np.flatnonzero(query)
+    return relevance(rows[:, support].astype(np.float32), query[support])
+
+
+class IVFIndex:
+    """Inverted-file index; document ids are positions in the pack like the other indexes"""
+
+    def __init__(self, centroids, list_offsets, list_doc_ids, list_vectors, idf,
+                 n_probe=None, fingerprint=None):
+        # list_vectors may be a read-only memmap of the stored float16 vectors
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_doc_ids = list_doc_ids
+        self.list_vectors = list_vectors
+        self.idf = idf
+        # None probes default_probe_count(n_lists)
+        self.n_probe = n_probe
+        self.fingerprint = fingerprint
+        self.dimensions = list_vectors.shape[1]
+        self.vectorizer = HashedVectorizer(self.dimensions)
+        # row of each document in list_vectors, built on first restricted search or update
+        self._doc_rows = None
+
+    def __len__(self):
+        return len(self.list_doc_ids)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, texts, dimensions=DEFAULT_DIMENSIONS, n_lists=None, n_probe=None, fingerprint=None):
+        """Embed chunk texts and cluster them into n_lists inverted lists"""
+        vector_index = VectorIndex.build(texts, dimensions=dimensions)
+        return cls.from_vector_index(vector_index, n_lists=n_lists, n_probe=n_probe, fingerprint=fingerprint)
+
+    @classmethod
+    def from_vector_index(cls, vector_index, n_lists=None, n_probe=None, fingerprint=None):
+        """Cluster an existing VectorIndex's matrix"""
+        matrix = vector_index.matrix
+        n_lists = min(n_lists or default_list_count(len(matrix)), max(len(matrix), 1))
+        if n_lists > 1:
+            centroids = train_centroids(matrix, n_lists)
+            assignments = _assign(matrix, centroids)
+        else:
+            centroids = np.zeros((1, matrix.shape[1]), dtype=np.float32)
+            assignments = np.zeros(len(matrix), dtype=np.int32)
+
+        logger.info(f"Built IVF index: {len(matrix)} chunks in {n_lists} lists, probing {n_probe or default_probe_count(n_lists)}")
+        return cls._from_assignments(centroids, assignments, lambda doc_ids: matrix[doc_ids], vector_index.idf,
+                                     n_probe, fingerprint)
+
+    @classmethod
+    def _from_assignments(cls, centroids, assignments, gather, idf, n_probe, fingerprint):
+        """Index with document i in list assignments[i]; gather(doc_ids) returns those documents' vectors"""
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=len(centroids)))
+        # reorder in batches straight into float16, so the build never holds a second float32 copy
+        list_vectors = np.empty((len(order), centroids.shape[1]), dtype=VECTOR_DTYPE)
+        for start in range(0, len(order), ASSIGN_BATCH_SIZE):
+            list_vectors[start:start + ASSIGN_BATCH_SIZE] = gather(order[start:start + ASSIGN_BATCH_SIZE])
+        return cls(centroids, list_offsets, order.astype(np.int32), list_vectors,
+                   idf, n_probe=n_probe, fingerprint=fingerprint)
+
+    def update(self, old_positions, new_texts, fingerprint=None):
+        """
+        Index for a changed pack, keeping the trained centroids.
+
+        Unchanged chunks keep their lists and their stored float16 vectors, copied batch by batch
+        into the new list order; only new_texts are embedded and assigned to their closest
+        centroid (see VectorIndex.update for old_positions). No float32 copy of the whole index
+        is made.
+        """
+        old_positions = np.asarray(old_positions, dtype=np.int64)
+        reused = np.flatnonzero(old_positions >= 0)
+        new_ids = np.flatnonzero(old_positions < 0)
+        new_rows = update_rows(np.empty((0, self.dimensions), dtype=np.float32), np.full(len(new_ids), -1),
+                               new_texts, self.vectorizer, self.idf)
+
+        # where each document of the updated index comes from: a stored row (>= 0) or new_rows[-1 - source]
+        sources = np.empty(len(old_positions), dtype=np.int64)
+        sources[reused] = self._stored_rows()[old_positions[reused]]
+        sources[new_ids] = -1 - np.arange(len(new_ids))
+        row_lists = np.repeat(np.arange(self.n_lists, dtype=np.int32), np.diff(self.list_offsets))
+        assignments = np.empty(len(old_positions), dtype=np.int32)
+        assignments[reused] = row_lists[sources[reused]]
+        if len(new_ids):
+            assignments[new_ids] = _assign(new_rows, self.centroids)
+
+        def gather(doc_ids):
+            rows = sources[doc_ids]
+            stored = rows >= 0
+            vectors = np.empty((len(doc_ids), self.dimensions), dtype=VECTOR_DTYPE)
+            vectors[stored] = self.list_vectors[rows[stored]]
+            vectors[~stored] = new_rows[-1 - rows[~stored]]
+            return vectors
+
+        return self._from_assignments(self.centroids, assignments, gather, self.idf, self.n_probe, fingerprint)
+
+    def _stored_rows(self):
+        """Row of every document in list_vectors"""
+        if self._doc_rows is None:
+            self._doc_rows = np.argsort(self.list_doc_ids)
+        return self._doc_rows
+
+    def embed_query(self, search_terms):
+        """Normalized query vector, embedded exactly like the vector index does"""
+        return embed_query(self.vectorizer, self.idf, search_terms)
+
+    def search(self, search_terms, k, threshold=0.0, n_probe=None, doc_ids=None):
+        """Approximate top-k (doc_id, score) pairs scoring at least threshold, best first"""
+        return self.search_vector(self.embed_query(search_terms), k, threshold, n_probe=n_probe, doc_ids=doc_ids)
+
+    def search_vector(self, query, k, threshold=0.0, n_probe=None, doc_ids=None):
+        """
+        Approximate top-k for an already embedded query, probing n_probe lists.
+
+        With doc_ids (sorted), those documents are scored exactly instead; a pre-selected subset
+        is small enough that probing would only lose recall.
+        """
+        if not len(self) or not query.any():
+            return []
+        if doc_ids is not None:
+            return top_k_scores(_score_rows(self.list_vectors[self._stored_rows()[doc_ids]], query), k, threshold,
+                                doc_ids=doc_ids)
+        n_probe = min(n_probe or self.n_probe or default_probe_count(self.n_lists), self.n_lists)
+        if n_probe >= self.n_lists:
+            lists = np.arange(self.n_lists)
+        else:
+            lists = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+
+        # score each probed list in place (slices are views) rather than copying candidates together
+        slices = [slice(self.list_offsets[i], self.list_offsets[i + 1]) for i in np.sort(lists)]
+        scores = np.concatenate([_score_rows(self.list_vectors[s], query) for s in slices])
+        candidate_ids = np.concatenate([self.list_doc_ids[s] for s in slices])
+        return top_k_scores(scores, k, threshold, doc_ids=candidate_ids)
+
+    def save(self, path):
+        """
+        Persist the index as an uncompressed .npz file plus its float16 vectors in a
+        <path>.<generation>.vectors.npy file that the .npz names.
+
+        The vectors are written under a fresh name first and the .npz is replaced last, so a
+        save cut short leaves the previous .npz with its own, untouched vectors. Vector files no
+        longer named by the .npz are removed afterwards; processes that still map one keep
+        reading it until they reload.
+        """
+        vectors_file = vectors_path(path, uuid.uuid4().hex)
+        with open(f"{vectors_file}.tmp", "wb") as f:
+            np.save(f, np.asarray(self.list_vectors, dtype=VECTOR_DTYPE))
+        os.replace(f"{vectors_file}.tmp", vectors_file)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=np.array(IVF_FORMAT_VERSION),
+                vectors_file=np.array(os.path.basename(vectors_file)),
+                centroids=self.centroids,
+                list_offsets=self.list_offsets,
+                list_doc_ids=self.list_doc_ids,
+                dimensions=np.array(self.dimensions),
+                idf=self.idf,
+                n_probe=np.array(self.n_probe or 0),
+                fingerprint=np.array(self.fingerprint or ""),
+            )
+        os.replace(tmp_path, path)
+        for stale_file in glob.glob(vectors_path(glob.escape(path), "*")):
+            if stale_file != vectors_file:
+                try:
+                    os.remove(stale_file)
+                except OSError as e:
+                    logger.info(f"DEBUG: Could not remove old IVF vectors {stale_file}: {e}")
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save(), memory-mapping its vectors"""
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != IVF_FORMAT_VERSION:
+                raise ValueError(f"Unsupported IVF index version in {path}")
+            vectors_file = os.path.join(os.path.dirname(path), str(data["vectors_file"]))
+            list_vectors = np.load(vectors_file, mmap_mode="r")
+            if list_vectors.shape != (len(data["list_doc_ids"]), int(data["dimensions"])):
+                raise ValueError(f"IVF vectors in {vectors_file} do not match {path}")
+            return cls(data["centroids"], data["list_offsets"], data["list_doc_ids"], list_vectors,
+                       data["idf"], n_probe=int(data["n_probe"]) or None, fingerprint=str(data["fingerprint"]) or None)
+
+
+def vectors_path(path, generation):
+    """File holding one generation of the float16 list vectors of the index saved at path"""
+    return f"{path}.{generation}.vectors.npy"
+
+
+def load_or_build_ann_index(pack_file, loaded_sources, n_probe=None):
+    """IVF index for the chunks of pack_file, persisted next to it as <pack>.ivf.npz"""
+    index = load_or_build(IVFIndex, pack_file, loaded_sources, "ivf.npz", n_probe=n_probe)
+    index.n_probe = n_probe
+    return index
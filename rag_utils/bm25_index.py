@@ -0,0 +1,302 @@
+"""
+BM25 inverted index over knowledge pack chunks.
+
+Postings are stored in CSR form (one contiguous array of document ids and term
+frequencies, sliced per term) so a query only touches the postings of its own
+terms, and the whole index can be persisted next to pack.json with numpy.
+
+idf and length normalization are derived from the postings when an index is
+created, so an incrementally updated index scores exactly like a full rebuild.
+"""
+
+import logging
+import os
+import re
+
+import numpy as np
+
+from rag_utils.index_storage import load_or_build
+from rag_utils.ranking import select_top_k
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT_VERSION = 1
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+# Kept deliberately small - BM25's idf already discounts common words, this only
+# stops question boilerplate from diluting the normalized score.
+STOPWORDS = frozenset("""
+a about an and any are as at be been but by can could did do does for from had
+has have how i if in into is it its me my of on or our please should tell than
+that the their them there these they this those to was we were what when where
+which who why will with would you your
+""".split())
+
+
+def tokenize(text):
+    """Split text into lowercase word tokens"""
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def query_terms(search_terms):
+    """Unique, non-stopword tokens across all search terms, in first-seen order"""
+    terms = []
+    seen = set()
+    for search_term in search_terms:
+        for token in tokenize(search_term):
+            if token not in STOPWORDS and token not in seen:
+                seen.add(token)
+                terms.append(token)
+    return terms
+
+
+def _count_terms(texts, vocabulary):
+    """
+    Tokenize texts into (term id, doc id, tf) postings, adding unseen terms to vocabulary.
+
+    Returns:
+        term_ids, doc_ids, tfs and per-document token counts as numpy arrays; doc ids count
+        from 0 in the order of texts
+    """
+    term_ids = []
+    doc_ids = []
+    tfs = []
+    doc_lengths = []
+    for doc_id, text in enumerate(texts):
+        tokens = tokenize(text)
+        doc_lengths.append(len(tokens))
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            term_id = vocabulary.get(token)
+            if term_id is None:
+                term_id = vocabulary[token] = len(vocabulary)
+            term_ids.append(term_id)
+            doc_ids.append(doc_id)
+            tfs.append(tf)
+    return (np.asarray(term_ids, dtype=np.int64), np.asarray(doc_ids, dtype=np.int64),
+            np.asarray(tfs, dtype=np.int32), np.asarray(doc_lengths, dtype=np.int32))
+
+
+def _calibrate(coverage):
+    """
+    Map BM25 query coverage onto the legacy relevance scale, keeping the order.
+
+    coverage is the BM25 score over the sum of idf of the query terms found in the index: 1.0
+    for a chunk of average length that mentions each of them once, more for repeated mentions
+    or shorter chunks, less when terms are missing. 1 - exp(-coverage) puts that chunk at 0.63
+    and a chunk with about a third of the query's weight at 0.3, the default match_threshold,
+    much like the keyword scan scores them.
+    """
+    return -np.expm1(-coverage)
+
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of chunk texts; document ids are list positions"""
+
+    def __init__(self, vocabulary, term_offsets, postings_docs, postings_tfs, doc_lengths,
+                 k1=1.2, b=0.75, fingerprint=None):
+        self.vocabulary = vocabulary
+        self.term_offsets = term_offsets
+        self.postings_docs = postings_docs
+        self.postings_tfs = postings_tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.fingerprint = fingerprint
+
+        num_docs = len(doc_lengths)
+        self.avg_doc_length = float(doc_lengths.mean()) if num_docs else 0.0
+        doc_freqs = np.diff(term_offsets)
+        self.idf = np.log1p((num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        self.length_norm = k1 * (1 - b + b * doc_lengths / max(self.avg_doc_length, 1e-9))
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts, k1=1.2, b=0.75, fingerprint=None):
+        """Build an index from an iterable of chunk texts"""
+        vocabulary = {}
+        term_ids, doc_ids, tfs, doc_lengths = _count_terms(texts, vocabulary)
+        index = cls._from_triples(vocabulary, term_ids, doc_ids, tfs, doc_lengths, k1, b, fingerprint)
+        logger.info(f"Built BM25 index: {len(doc_lengths)} chunks, {len(vocabulary)} terms, {len(index.postings_docs)} postings")
+        return index
+
+    @classmethod
+    def _from_triples(cls, vocabulary, term_ids, doc_ids, tfs, doc_lengths, k1, b, fingerprint):
+        """CSR index from unordered (term, doc, tf) postings; terms left without postings are dropped"""
+        num_terms = len(vocabulary)
+        doc_freqs = np.bincount(term_ids, minlength=num_terms)
+        if num_terms and not doc_freqs.all():
+            live = doc_freqs > 0
+            new_term_ids = np.cumsum(live) - 1
+            terms = np.array(sorted(vocabulary, key=vocabulary.get), dtype=object)
+            vocabulary = {term: term_id for term_id, term in enumerate(terms[live].tolist())}
+            term_ids = new_term_ids[term_ids]
+            doc_freqs = doc_freqs[live]
+
+        # stable, so documents stay in order within a term; an update's postings are already
+        # grouped by term apart from the appended new ones, which timsort merges in linear time
+        order = np.argsort(term_ids, kind="stable")
+        term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum(doc_freqs)
+        return cls(vocabulary, term_offsets, doc_ids[order].astype(np.int32), tfs[order].astype(np.int32),
+                   np.asarray(doc_lengths, dtype=np.int32), k1=k1, b=b, fingerprint=fingerprint)
+
+    def update(self, old_positions, new_texts, fingerprint=None):
+        """
+        Index for a changed pack, reusing this index's postings for unchanged chunks.
+
+        Args:
+            old_positions: for every document of the new pack, its id in this index, or -1
+                where it must be indexed from new_texts (in order)
+            new_texts: texts of the -1 documents
+
+        Only new_texts are tokenized; the surviving postings are remapped with numpy.
+        """
+        old_positions = np.asarray(old_positions, dtype=np.int64)
+        new_ids = np.flatnonzero(old_positions < 0)
+        reused = np.flatnonzero(old_positions >= 0)
+
+        old_to_new = np.full(len(self), -1, dtype=np.int64)
+        old_to_new[old_positions[reused]] = reused
+        posting_terms = np.repeat(np.arange(len(self.vocabulary), dtype=np.int64), np.diff(self.term_offsets))
+        posting_docs = old_to_new[self.postings_docs]
+        keep = posting_docs >= 0
+
+        vocabulary = dict(self.vocabulary)
+        added_terms, added_docs, added_tfs, added_lengths = _count_terms(new_texts, vocabulary)
+        doc_lengths = np.zeros(len(old_positions), dtype=np.int32)
+        doc_lengths[reused] = self.doc_lengths[old_positions[reused]]
+        doc_lengths[new_ids] = added_lengths
+
+        return type(self)._from_triples(
+            vocabulary,
+            np.concatenate((posting_terms[keep], added_terms)),
+            np.concatenate((posting_docs[keep], new_ids[added_docs])),
+            np.concatenate((self.postings_tfs[keep], added_tfs)),
+            doc_lengths, self.k1, self.b, fingerprint,
+        )
+
+    def _term_scores(self, term_id):
+        """(doc ids, BM25 contributions) of one term's postings"""
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        docs = self.postings_docs[start:end]
+        tfs = self.postings_tfs[start:end]
+        return docs, self.idf[term_id] * tfs * (self.k1 + 1) / (tfs + self.length_norm[docs])
+
+    def score(self, search_terms, doc_ids=None, term_cache=None):
+        """
+        Score every chunk that contains at least one query term.
+
+        Args:
+            search_terms: list of query strings (question plus topics)
+            doc_ids: optional document ids to restrict scoring to
+            term_cache: optional dict of per-term postings scores shared between queries
+
+        Returns:
+            (doc_ids, scores) numpy arrays. Scores are calibrated to the [0, 1) scale of the
+            legacy relevance score (see _calibrate), so match_threshold means the same for both.
+        """
+        terms = query_terms(search_terms)
+        if not terms or not len(self):
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)
+
+        allowed = None
+        if doc_ids is not None:
+            allowed = np.zeros(len(self), dtype=bool)
+            allowed[doc_ids] = True
+        known_idf = 0.0
+        matched_docs = []
+        matched_scores = []
+
+        for term in terms:
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                # a word no chunk contains cannot tell chunks apart, so it does not dilute the score
+                continue
+            known_idf += self.idf[term_id]
+            if term_cache is None:
+                docs, term_scores = self._term_scores(term_id)
+            else:
+                if term_id not in term_cache:
+                    term_cache[term_id] = self._term_scores(term_id)
+                docs, term_scores = term_cache[term_id]
+            if allowed is not None:
+                keep = allowed[docs]
+                docs, term_scores = docs[keep], term_scores[keep]
+            matched_docs.append(docs)
+            matched_scores.append(term_scores)
+
+        if not matched_docs:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)
+
+        doc_ids, inverse = np.unique(np.concatenate(matched_docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(matched_scores))
+        return doc_ids, _calibrate(scores / known_idf)
+
+    def search(self, search_terms, k, threshold=0.0, doc_ids=None):
+        """Top-k (doc_id, score) pairs scoring at least threshold, best first, optionally among doc_ids only"""
+        doc_ids, scores = self.score(search_terms, doc_ids)
+        keep = scores >= threshold
+        return select_top_k(zip(doc_ids[keep].tolist(), scores[keep].tolist()), k)
+
+    def search_batch(self, queries, k, threshold=0.0):
+        """search() for a list of queries, traversing each distinct term's postings once for all of them"""
+        term_cache = {}
+        results = []
+        for search_terms in queries:
+            doc_ids, scores = self.score(search_terms, term_cache=term_cache)
+            keep = scores >= threshold
+            results.append(select_top_k(zip(doc_ids[keep].tolist(), scores[keep].tolist()), k))
+        return results
+
+    def save(self, path):
+        """Persist the index as an uncompressed .npz file"""
+        terms = np.array(sorted(self.vocabulary, key=self.vocabulary.get), dtype=str)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=np.array(INDEX_FORMAT_VERSION),
+                terms=terms,
+                term_offsets=self.term_offsets,
+                postings_docs=self.postings_docs,
+                postings_tfs=self.postings_tfs,
+                doc_lengths=self.doc_lengths,
+                params=np.array([self.k1, self.b]),
+                fingerprint=np.array(self.fingerprint or ""),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save()"""
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != INDEX_FORMAT_VERSION:
+                raise ValueError(f"Unsupported BM25 index version in {path}")
+            terms = data["terms"].tolist()
+            k1, b = data["params"].tolist()
+            return cls(
+                {term: term_id for term_id, term in enumerate(terms)},
+                data["term_offsets"],
+                data["postings_docs"],
+                data["postings_tfs"],
+                data["doc_lengths"],
+                k1=k1,
+                b=b,
+                fingerprint=str(data["fingerprint"]) or None,
+            )
+
+
+def load_or_build_index(pack_file, loaded_sources):
+    """
+    Return a BM25 index for the chunks of pack_file.
+
+    A persisted index is reused when its fingerprint matches the pack file, otherwise
+    the index is rebuilt from loaded_sources and saved for the next invocation.
+    """
+    return load_or_build(BM25Index, pack_file, loaded_sources, "bm25.npz")
@@ -0,0 +1,287 @@
+"""
+Compiled, memory-mapped chunk store for knowledge packs.
+
+pack.json is compiled offline into a single binary file:
+
+    header   magic, version, counts, section offsets, SHA-1 of the source pack.json
+    files    fixed-size records (name offset, name length) into the blob section
+    chunks   fixed-size records (file, page, description offset/length, text offset/length)
+    aliases  (chunk, file, page) of near-duplicate chunks folded into a kept chunk, by chunk
+    blobs    UTF-8 file names, descriptions and chunk texts
+
+Near-duplicate chunks are dropped while compiling (see rag_utils.dedup); only their
+citations are kept, as aliases of the representative chunk.
+
+The tables are read with numpy.frombuffer straight from the mmap, so opening a store
+does not copy or decode anything; a chunk's text is only decoded when that chunk is
+accessed. ChunkStore behaves like the list returned by load_document_sources.
+
+Compile with:
+    python -m rag_utils.chunk_store path/to/pack.json [path/to/pack.chunkstore]
+"""
+
+import logging
+import mmap
+import os
+import shutil
+import struct
+from array import array
+
+import numpy as np
+
+from rag_utils.dedup import NearDuplicateDetector, dedup_enabled, log_reduction
+from rag_utils.index_storage import get_index_path
+from rag_utils.pack_cache import file_checksum
+from rag_utils.pack_stream import iter_pack_files, make_description
+
+logger = logging.getLogger(__name__)
+
+STORE_MAGIC = b"RAGCHNK1"
+STORE_VERSION = 2
+STORE_EXTENSION = ".chunkstore"
+
+# magic, version, num_files, num_chunks, files offset, chunks offset, blobs offset, source sha1,
+# num_aliases, aliases offset
+HEADER_FORMAT = "<8sIIIQQQ20sIQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+FILE_DTYPE = np.dtype([("name_offset", "<u8"), ("name_length", "<u4")])
+CHUNK_DTYPE = np.dtype([
+    ("file", "<u4"),
+    ("page", "<i8"),
+    ("description_offset", "<u8"),
+    ("description_length", "<u4"),
+    ("text_offset", "<u8"),
+    ("text_length", "<u8"),
+])
+ALIAS_DTYPE = np.dtype([("chunk", "<u4"), ("file", "<u4"), ("page", "<i8")])
+
+
+def get_store_path(pack_file):
+    """Default compiled store location for a pack.json"""
+    return os.path.splitext(pack_file)[0] + STORE_EXTENSION
+
+
+def compile_pack(pack_file, store_path=None, dedupe=True):
+    """
+    Compile pack.json into a chunk store.
+
+    pack.json is read with the streaming parser and chunk texts are spooled to a temporary
+    blob file, so memory is bounded by one file's chunks plus the fixed-size chunk table.
+
+    Args:
+        pack_file: path to a pack.json in the [{"File": ..., "Chunks": [...]}] format
+        store_path: output path, defaults to get_store_path(pack_file)
+        dedupe: fold near-duplicate chunks into the first one seen, keeping only their citations
+
+    Returns:
+        the path of the written store
+    """
+    store_path = store_path or get_store_path(pack_file)
+    source_digest = bytes.fromhex(file_checksum(pack_file))
+
+    file_names = array("Q"), array("I")
+    chunk_columns = {name: array(code) for name, code in
+                     (("file", "I"), ("page", "q"), ("description_offset", "Q"), ("description_length", "I"),
+                      ("text_offset", "Q"), ("text_length", "Q"))}
+    aliases = array("I"), array("I"), array("q")
+    detector = NearDuplicateDetector() if dedupe else None
+    num_chunks = bytes_before = bytes_after = 0
+    blobs_path = f"{store_path}.blobs.tmp"
+    blob_size = 0
+
+    with open(blobs_path, "wb") as blobs:
+        def add_blob(value):
+            nonlocal blob_size
+            data = value.encode("utf-8")
+            offset = blob_size
+            blobs.write(data)
+            blob_size += len(data)
+            return offset, len(data)
+
+        for file_id, processed_file in enumerate(iter_pack_files(pack_file)):
+            name_offset, name_length = add_blob(processed_file.get("File", "unknown_file"))
+            file_names[0].append(name_offset)
+            file_names[1].append(name_length)
+            for chunk in processed_file.get("Chunks", []):
+                text = str(chunk.get("Text", ""))
+                page = chunk.get("Page", 1)
+                try:
+                    page = int(page)
+                except (TypeError, ValueError):
+                    raise ValueError(f"Chunk page must be an integer to compile a chunk store, got {page!r}")
+                num_chunks += 1
+                text_bytes = len(text.encode("utf-8"))
+                bytes_before += text_bytes
+                representative = detector.add(text) if detector else None
+                if representative is not None:
+                    for column, value in zip(aliases, (representative, file_id, page)):
+                        column.append(value)
+                    continue
+                bytes_after += text_bytes
+                description_offset, description_length = add_blob(make_description(text))
+                text_offset, text_length = add_blob(text)
+                for name, value in (("file", file_id), ("page", page),
+                                    ("description_offset", description_offset), ("description_length", description_length),
+                                    ("text_offset", text_offset), ("text_length", text_length)):
+                    chunk_columns[name].append(value)
+
+    files = np.empty(len(file_names[0]), dtype=FILE_DTYPE)
+    files["name_offset"] = np.frombuffer(file_names[0], dtype=np.uint64)
+    files["name_length"] = np.frombuffer(file_names[1], dtype=np.uint32)
+    chunks = np.empty(len(chunk_columns["file"]), dtype=CHUNK_DTYPE)
+    for name, column in chunk_columns.items():
+        chunks[name] = column
+    alias_table = np.empty(len(aliases[0]), dtype=ALIAS_DTYPE)
+    for name, column in zip(ALIAS_DTYPE.names, aliases):
+        alias_table[name] = column
+    alias_table = alias_table[np.argsort(alias_table["chunk"], kind="stable")]
+    files_offset = HEADER_SIZE
+    chunks_offset = files_offset + files.nbytes
+    aliases_offset = chunks_offset + chunks.nbytes
+    blobs_offset = aliases_offset + alias_table.nbytes
+
+    tmp_path = f"{store_path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(struct.pack(HEADER_FORMAT, STORE_MAGIC, STORE_VERSION, len(files), len(chunks),
+                                files_offset, chunks_offset, blobs_offset, source_digest,
+                                len(alias_table), aliases_offset))
+            f.write(files.tobytes())
+            f.write(chunks.tobytes())
+            f.write(alias_table.tobytes())
+            with open(blobs_path, "rb") as blobs:
+                shutil.copyfileobj(blobs, f)
+        os.replace(tmp_path, store_path)
+    finally:
+        os.remove(blobs_path)
+
+    logger.info(f"Compiled {len(chunks)} chunks from {len(files)} files into {store_path}")
+    if detector:
+        log_reduction(num_chunks, len(chunks), bytes_before, bytes_after)
+    return store_path
+
+
+def open_compiled_pack(pack_file):
+    """
+    Open a chunk store for a pack.json, compiling it next to the pack (or in the index cache
+    dir) first when it is missing or older than the pack. Used for packs too large to json.load.
+    Near duplicates are folded unless RAG_DEDUP is off when the store is compiled.
+    """
+    store_path = get_index_path(pack_file, STORE_EXTENSION.lstrip("."))
+    if os.path.exists(store_path) and os.path.getmtime(store_path) >= os.path.getmtime(pack_file):
+        try:
+            return ChunkStore.open(store_path)
+        except ValueError as e:
+            logger.info(f"DEBUG: Recompiling {store_path}: {e}")
+    logger.info(f"DEBUG: Streaming {pack_file} into chunk store {store_path}")
+    compile_pack(pack_file, store_path, dedupe=dedup_enabled())
+    return ChunkStore.open(store_path)
+
+
+def read_store_checksum(store_path):
+    """Hex SHA-1 of the pack.json a store was compiled from, read from the header only"""
+    with open(store_path, "rb") as f:
+        header = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+    if header[0] != STORE_MAGIC:
+        raise ValueError(f"{store_path} is not a chunk store")
+    return header[7].hex()
+
+
+class ChunkStore:
+    """Read-only, memory-mapped view of a compiled pack; indexable like the loaded_sources list"""
+
+    def __init__(self, store_path):
+        self.path = store_path
+        with open(store_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from("<8sI", self._mmap, 0)
+        if magic != STORE_MAGIC:
+            raise ValueError(f"{store_path} is not a chunk store")
+        if version != STORE_VERSION:
+            raise ValueError(f"Unsupported chunk store version {version} in {store_path}")
+        (_, _, num_files, num_chunks, files_offset, chunks_offset, blobs_offset, source_digest,
+         num_aliases, aliases_offset) = struct.unpack_from(HEADER_FORMAT, self._mmap, 0)
+
+        self.checksum = source_digest.hex()
+        self._files = np.frombuffer(self._mmap, dtype=FILE_DTYPE, count=num_files, offset=files_offset)
+        self._chunks = np.frombuffer(self._mmap, dtype=CHUNK_DTYPE, count=num_chunks, offset=chunks_offset)
+        self._aliases = np.frombuffer(self._mmap, dtype=ALIAS_DTYPE, count=num_aliases, offset=aliases_offset)
+        self._blobs_offset = blobs_offset
+        self._file_names = [None] * num_files
+
+    @classmethod
+    def open(cls, store_path):
+        return cls(store_path)
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def __getitem__(self, position):
+        record = self._chunks[position]
+        file_name = self.file_name(int(record["file"]))
+        return {
+            "file_name": file_name,
+            "text": self._decode(record["text_offset"], record["text_length"]),
+            "description": self._decode(record["description_offset"], record["description_length"]),
+            "chunk_index": int(record["page"]),
+            "citation": file_name,
+            "duplicates": self.duplicates(position)
+        }
+
+    def _decode(self, offset, length):
+        start = self._blobs_offset + int(offset)
+        return self._mmap[start:start + int(length)].decode("utf-8")
+
+    def file_name(self, file_id):
+        """File name for a file id, decoded once and kept"""
+        name = self._file_names[file_id]
+        if name is None:
+            record = self._files[file_id]
+            name = self._file_names[file_id] = self._decode(record["name_offset"], record["name_length"])
+        return name
+
+    def metadata(self, position):
+        """File name and page of a chunk without decoding its text"""
+        record = self._chunks[position]
+        return self.file_name(int(record["file"])), int(record["page"])
+
+    def duplicates(self, position):
+        """Citations of the near-duplicate chunks folded into this one while compiling"""
+        start, end = np.searchsorted(self._aliases["chunk"], [position, position + 1])
+        citations = []
+        for alias in self._aliases[start:end]:
+            file_name = self.file_name(int(alias["file"]))
+            citations.append({"file_name": file_name, "chunk_index": int(alias["page"]), "citation": file_name})
+        return citations
+
+    def text(self, position):
+        record = self._chunks[position]
+        return self._decode(record["text_offset"], record["text_length"])
+
+    def texts(self):
+        """Iterate chunk texts, decoding one at a time"""
+        for position in range(len(self)):
+            yield self.text(position)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile pack.json into a memory-mapped chunk store")
+    parser.add_argument("pack_file")
+    parser.add_argument("store_path", nargs="?")
+    parser.add_argument("--keep-duplicates", action="store_true", help="do not fold near-duplicate chunks")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    path = compile_pack(args.pack_file, args.store_path, dedupe=not args.keep_duplicates)
+
+    from rag_utils.bm25_index import load_or_build_index
+    store = ChunkStore.open(path)
+    load_or_build_index(path, store)
@@ -0,0 +1,95 @@
+"""
+Compact HTML for the response and sources tabs.
+
+The standard rendering repeats the same long style attributes on every reference, row
+and card, and the tabs are assembled from nested f-strings. The compact rendering puts
+those styles once in a style block at the top of each tab, uses short class names on the
+markup, and builds references and source rows with a single list of parts joined at the
+end. The visible structure (title, answer, numbered references, sources table with page,
+match score and duplicate notes) is the same. Text and URLs are escaped, unlike the
+standard templates.
+"""
+
+import html
+
+from rag_utils.html_sanitizer import sanitize_html
+
+# each tab carries one style block with only the rules its markup uses
+_BASE_STYLE = (
+    ".rag{font-family:-apple-system,BlinkMacSystemFont,'Segoe UI',Roboto,Arial,sans-serif;"
+    "line-height:1.6;color:#2d3748;padding:20px}"
+    ".rag a{color:#0066cc;text-decoration:none}"
+)
+RESPONSE_STYLE = (
+    "<style>" + _BASE_STYLE +
+    ".rag h1{font-size:28px;font-weight:700;color:#1a202c;margin:0 0 24px;line-height:1.2;"
+    "border-bottom:3px solid #3182ce;padding-bottom:12px;display:inline-block}"
+    ".rag .body{font-size:16px;line-height:1.8;color:#4a5568}"
+    ".rag p{margin:16px 0}"
+    ".rag sup{background:#3182ce;color:#fff;padding:2px 6px;border-radius:12px;font-size:11px;"
+    "font-weight:600;margin-left:4px}"
+    ".rag hr{margin:20px 0}"
+    ".rag li{margin-bottom:10px}"
+    "</style>"
+)
+SOURCES_STYLE = (
+    "<style>" + _BASE_STYLE +
+    ".rag table{width:100%;border-collapse:collapse;font-size:14px}"
+    ".rag th,.rag td{padding:12px;text-align:left;border-bottom:1px solid #dee2e6}"
+    ".rag th{font-weight:600;background:#f8f9fa;border-bottom-width:2px}"
+    ".rag tbody tr:nth-child(even){background:#f8f9fa}"
+    ".rag .dup{font-size:12px;color:#666}"
+    "</style>"
+)
+
+
+def _escape(value):
+    return html.escape(str(value))
+
+
+def references_list(references):
+    """Numbered, linked references as one <ol>"""
+    if not references:
+        return "<p>No references available</p>"
+    parts = ["<ol>"]
+    for ref in references:
+        parts.append(f"<li><a href='{_escape(ref.get('url', '#'))}' target='_blank'>"
+                     f"{_escape(ref.get('text', 'Document'))} (Page {_escape(ref.get('page', '?'))})</a></li>")
+    parts.append("</ol>")
+    return "".join(parts)
+
+
+def sources_table(references):
+    """Document, page and match score per reference; striping comes from the style block"""
+    if not references:
+        return "<p>No sources available</p>"
+    parts = ["<table><thead><tr><th>Document Name</th><th>Page</th><th>Match Score</th></tr></thead><tbody>"]
+    for ref in references:
+        parts.append(f"<tr><td><a href='{_escape(ref.get('url', '#'))}' target='_blank'>"
+                     f"{_escape(ref.get('src', ref.get('text', 'Document')))}</a>")
+        duplicates = ref.get('duplicates')
+        if duplicates:
+            places = ", ".join(f"{duplicate['file_name']} page {duplicate['chunk_index']}" for duplicate in duplicates)
+            parts.append(f"<div class='dup'>Also in: {_escape(places)}</div>")
+        parts.append(f"</td><td>{_escape(ref.get('page', '?'))}</td><td>{_escape(ref.get('match_score', '0.780000'))}</td></tr>")
+    parts.append("</tbody></table>")
+    return "".join(parts)
+
+
+def main_response(title, content):
+    """Answer title and body; the LLM's text is sanitized like the standard template output, the markup is not"""
+    return f"<h1>{sanitize_html(_escape(title))}</h1><div class='body'>{sanitize_html(content)}</div>"
+
+
+def response_tab(main_html, references_html=""):
+    """Response tab: style block, answer and (when there are any) the references list"""
+    parts = [RESPONSE_STYLE, "<div class='rag'>", main_html]
+    if references_html:
+        parts.extend(["<hr><h3>References</h3>", references_html])
+    parts.append("</div>")
+    return "".join(parts)
+
+
+def sources_tab(sources_html):
+    """Sources tab: style block and the sources table (or a message when there are none)"""
+    return "".join([SOURCES_STYLE, "<div class='rag'><h2>Document Sources</h2>", sources_html, "</div>"])
@@ -0,0 +1,140 @@
+"""
+Disk-backed cache of LLM completions.
+
+Completions are content-addressed by the SHA-256 of the LLM backend's name and the fully
+rendered prompt, so any change to the question, the retrieved chunks or the prompt template
+is a different key, and completions of one backend (e.g. the offline LocalLLM) are never
+served for another from the shared database.
+Entries live in a SQLite database (WAL mode) that survives restarts and is shared by
+every worker process on the host. Entries expire after a TTL, and the least recently
+used ones are deleted once the stored completions exceed a byte budget.
+
+Cache failures (locked or unwritable database) are logged and treated as misses; they
+never fail the skill.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+CACHE_PATH_ENV = "RAG_COMPLETION_CACHE_PATH"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT PRIMARY KEY,
+    completion TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+)
+"""
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def prompt_key(prompt, backend=""):
+    """Content address of a rendered prompt for an LLM backend"""
+    return hashlib.sha256(f"{backend}\x00{prompt}".encode("utf-8")).hexdigest()
+
+
+def get_default_cache_path():
+    """$RAG_COMPLETION_CACHE_PATH, or a database in the system temp dir"""
+    return os.environ.get(CACHE_PATH_ENV) or os.path.join(tempfile.gettempdir(), "rag_llm_cache", "completions.sqlite3")
+
+
+class CompletionCache:
+    """SQLite completion store with TTL and a least-recently-used size limit"""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS, clock=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(_SCHEMA)
+            connection.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+
+    @contextmanager
+    def _connect(self):
+        """Commit (or roll back) and close; a connection per operation is safe from any thread or process"""
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, prompt, backend=""):
+        """Cached completion of prompt by backend, or None on a miss, an expired entry or a cache error"""
+        key = prompt_key(prompt, backend)
+        now = self.clock()
+        try:
+            with self._connect() as connection:
+                row = connection.execute("SELECT completion, created FROM completions WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                if now - row[1] > self.ttl_seconds:
+                    connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                    return None
+                connection.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+                return row[0]
+        except sqlite3.Error as e:
+            logger.warning(f"DEBUG: Completion cache read failed, treating as miss: {e}")
+            return None
+
+    def put(self, prompt, completion, backend=""):
+        """Store backend's completion of prompt, then drop expired and least recently used entries"""
+        size = len(completion.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = self.clock()
+        try:
+            with self._connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                                   (prompt_key(prompt, backend), completion, size, now, now))
+                connection.execute("DELETE FROM completions WHERE created < ?", (now - self.ttl_seconds,))
+                total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+                if total > self.max_bytes:
+                    self._evict(connection, total - self.max_bytes)
+        except sqlite3.Error as e:
+            logger.warning(f"DEBUG: Completion cache write failed: {e}")
+
+    @staticmethod
+    def _evict(connection, excess):
+        keys = []
+        for key, size in connection.execute("SELECT key, size FROM completions ORDER BY accessed"):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany("DELETE FROM completions WHERE key = ?", keys)
+        logger.info(f"DEBUG: Evicted {len(keys)} completions from the cache")
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+
+def get_completion_cache(path=None):
+    """Shared CompletionCache for path (default: get_default_cache_path()), or None if it cannot be opened"""
+    path = path or get_default_cache_path()
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            try:
+                cache = _caches[path] = CompletionCache(path)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"DEBUG: Completion cache unavailable at {path}: {e}")
+        return cache
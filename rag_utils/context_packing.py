@@ -0,0 +1,96 @@
+"""
+Token-budgeted selection of retrieved chunks for the LLM prompt.
+
+Retrieval over-fetches candidates; pack_context then chooses the subset with the most
+total relevance that fits a token budget and a source count (a small knapsack). It runs
+the two classic greedy orders, by score and by score per token, and keeps the better
+result, so one oversized page can no longer push out several better-scoring smaller
+ones. Sizes count a candidate's extracted "passage" when it has one, since that is
+what the prompt carries. Candidates whose text is mostly contained in a better-scoring
+candidate are dropped first, so the budget is not spent twice on the same passage; a
+candidate with different numbers (another version of a table) is never a duplicate.
+"""
+
+import math
+
+from rag_utils.bm25_index import tokenize
+from rag_utils.dedup import numbers_key
+
+# rough characters per model token for English prose; no tokenizer ships with the skill
+CHARS_PER_TOKEN = 4
+SHINGLE_SIZE = 4
+# fraction of a chunk's shingles already present in a better chunk for it to count as a duplicate
+DUPLICATE_CONTAINMENT = 0.8
+
+
+def estimate_tokens(text):
+    """Approximate model tokens in text"""
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def _prompt_text(source):
+    return source.get("passage", source["text"])
+
+
+def _shingles(text):
+    words = tokenize(text)
+    if len(words) <= SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def drop_duplicates(candidates, containment=DUPLICATE_CONTAINMENT):
+    """Drop candidates (best first) whose text, numbers included, is mostly contained in a better-scoring kept candidate"""
+    kept = []
+    kept_shingles = []
+    for candidate in candidates:
+        text = _prompt_text(candidate[0])
+        shingles = _shingles(text)
+        key = numbers_key(text)
+        if any(key == other_key and len(shingles & other) >= containment * len(shingles)
+               for other, other_key in kept_shingles):
+            continue
+        kept.append(candidate)
+        kept_shingles.append((shingles, key))
+    return kept
+
+
+def _fill(order, sizes, token_budget, max_items):
+    chosen = []
+    used = 0
+    for position in order:
+        if len(chosen) == max_items:
+            break
+        if used + sizes[position] <= token_budget:
+            chosen.append(position)
+            used += sizes[position]
+    return chosen
+
+
+def pack_context(candidates, token_budget, max_items):
+    """
+    Choose (source, score) candidates maximizing total score within token_budget and max_items.
+
+    Args:
+        candidates: (source dict, score) pairs sorted by descending score
+        token_budget: maximum estimated tokens of chunk text
+        max_items: maximum number of chunks
+
+    Returns:
+        the chosen pairs, best score first. The best candidate is always returned, even when
+        it alone exceeds the budget, so a question with matches never ends up with no sources.
+    """
+    candidates = drop_duplicates(candidates)
+    if not candidates or max_items <= 0:
+        return []
+
+    sizes = [estimate_tokens(_prompt_text(source)) for source, _ in candidates]
+    scores = [score for _, score in candidates]
+    by_score = range(len(candidates))
+    by_density = sorted(by_score, key=lambda position: scores[position] / sizes[position], reverse=True)
+
+    chosen = max((_fill(by_score, sizes, token_budget, max_items), _fill(by_density, sizes, token_budget, max_items)),
+                 key=lambda positions: sum(scores[position] for position in positions))
+    if not chosen:
+        chosen = [0]
+    return [candidates[position] for position in sorted(chosen)]
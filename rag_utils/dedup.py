@@ -0,0 +1,159 @@
+"""
+Near-duplicate chunk detection for knowledge packs.
+
+Packs often carry the same page several times (e.g. a city table repeated across report
+versions). Each chunk gets a MinHash signature over its word 4-gram shingles; signatures
+are split into LSH bands, so only chunks that share a whole band are compared, and a
+candidate is a duplicate when the signatures agree on at least threshold of their slots
+(an estimate of shingle Jaccard similarity) and both contain the same numbers in the same
+order. Versioned pages that only change a few values (a revised forecast table) share
+almost all their shingles, but folding them would make the new values unreachable, so
+they are kept apart. Detection is streaming: each chunk is checked against the
+representatives kept so far, which lets compile_pack drop duplicates before their text is
+ever written.
+
+The first chunk of a cluster is its representative. It keeps pointers back to the
+citations of every duplicate it absorbed under "duplicates".
+
+Set RAG_DEDUP=off to load and compile packs with every chunk kept.
+"""
+
+import logging
+import os
+import re
+import zlib
+
+import numpy as np
+
+from rag_utils.bm25_index import tokenize
+from rag_utils.passages import strip_page_markers
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 0.8
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16
+SHINGLE_SIZE = 4
+
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+
+DEDUP_ENV = "RAG_DEDUP"
+
+
+def dedup_enabled():
+    """False when RAG_DEDUP switches near-duplicate folding off (0, off, false, no or disabled)"""
+    return os.environ.get(DEDUP_ENV, "").strip().lower() not in ("0", "off", "false", "no", "disabled")
+
+
+def _shingle_hashes(text):
+    words = tokenize(strip_page_markers(text))
+    if len(words) <= SHINGLE_SIZE:
+        shingles = [" ".join(words)]
+    else:
+        shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    return np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64)
+
+
+def numbers_key(text):
+    """Hash of the numbers in a chunk, in order; near duplicates must agree on it"""
+    return zlib.crc32("\x00".join(_NUMBER.findall(strip_page_markers(text))).encode("utf-8"))
+
+
+class NearDuplicateDetector:
+    """Streaming MinHash/LSH detector; add() returns the representative a chunk duplicates, if any"""
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, num_permutations=NUM_PERMUTATIONS, num_bands=NUM_BANDS, seed=1):
+        if num_permutations % num_bands:
+            raise ValueError("num_permutations must be a multiple of num_bands")
+        self.threshold = threshold
+        self.num_bands = num_bands
+        self.rows_per_band = num_permutations // num_bands
+        rng = np.random.default_rng(seed)
+        # multiply-shift hashing: (a * x + b) mod 2^64, top 32 bits; a must be odd
+        self._a = rng.integers(1, 1 << 63, size=num_permutations, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 1 << 63, size=num_permutations, dtype=np.uint64)
+        self._signatures = np.empty((1024, num_permutations), dtype=np.uint32)
+        self._numbers_keys = []
+        self._buckets = [{} for _ in range(num_bands)]
+        self.num_kept = 0
+
+    def signature(self, text):
+        """MinHash signature of a chunk text"""
+        hashes = _shingle_hashes(text)
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self._a) + self._b) >> np.uint64(32)
+        return (permuted & _MAX_HASH).min(axis=0).astype(np.uint32)
+
+    def add(self, text):
+        """
+        Register a chunk.
+
+        Returns:
+            the id (0, 1, ... in order of registration) of the kept chunk this one duplicates,
+            or None when the chunk is new and has itself been kept under id num_kept - 1
+        """
+        signature = self.signature(text)
+        numbers = numbers_key(text)
+        bands = signature.reshape(self.num_bands, self.rows_per_band)
+        band_keys = [band.tobytes() for band in bands]
+
+        checked = set()
+        for band_id, key in enumerate(band_keys):
+            for kept_id in self._buckets[band_id].get(key, ()):
+                if kept_id in checked:
+                    continue
+                checked.add(kept_id)
+                if (self._numbers_keys[kept_id] == numbers
+                        and np.mean(self._signatures[kept_id] == signature) >= self.threshold):
+                    return kept_id
+
+        kept_id = self.num_kept
+        if kept_id == len(self._signatures):
+            self._signatures = np.concatenate((self._signatures, np.empty_like(self._signatures)))
+        self._signatures[kept_id] = signature
+        self._numbers_keys.append(numbers)
+        for band_id, key in enumerate(band_keys):
+            self._buckets[band_id].setdefault(key, []).append(kept_id)
+        self.num_kept += 1
+        return None
+
+
+def citation_of(source):
+    """The pointer a representative keeps for a duplicate chunk it absorbed"""
+    return {"file_name": source["file_name"], "chunk_index": source["chunk_index"], "citation": source["citation"]}
+
+
+def log_reduction(num_chunks, num_kept, bytes_before, bytes_after):
+    """Report how much dedup shrank the pack"""
+    removed = num_chunks - num_kept
+    saved = 100.0 * (bytes_before - bytes_after) / bytes_before if bytes_before else 0.0
+    logger.info(f"DEBUG: Near-duplicate removal kept {num_kept} of {num_chunks} chunks "
+                f"({removed} removed, {saved:.1f}% of chunk text)")
+
+
+def dedupe_sources(sources, threshold=DEFAULT_THRESHOLD):
+    """
+    Keep the first chunk of every near-duplicate cluster.
+
+    Args:
+        sources: iterable of source records (the load_document_sources shape)
+
+    Returns:
+        list of kept records, each with a "duplicates" list of the citations it stands for
+    """
+    detector = NearDuplicateDetector(threshold)
+    kept = []
+    num_chunks = bytes_before = bytes_after = 0
+    for source in sources:
+        num_chunks += 1
+        text_bytes = len(str(source["text"]).encode("utf-8"))
+        bytes_before += text_bytes
+        representative = detector.add(str(source["text"]))
+        if representative is None:
+            kept.append(dict(source, duplicates=[]))
+            bytes_after += text_bytes
+        else:
+            kept[representative]["duplicates"].append(citation_of(source))
+    log_reduction(num_chunks, len(kept), bytes_before, bytes_after)
+    return kept
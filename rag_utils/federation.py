@@ -0,0 +1,122 @@
+"""
+Federated retrieval across several knowledge packs.
+
+Every pack keeps its own cached sources and persisted indexes, so packs are built,
+cached and invalidated independently. FederatedSources presents the packs as one
+indexable corpus (pack after pack), and FederatedIndex queries every pack's index
+concurrently and merges their top-k on the indexes' normalized [0, 1] relevance scores
+into global document ids, so find_matching_documents works unchanged on top of them.
+"""
+
+import bisect
+import hashlib
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from rag_utils.index_storage import iter_source_texts
+from rag_utils.ranking import search_batch, select_top_k
+
+logger = logging.getLogger(__name__)
+
+MAX_SEARCH_THREADS = 8
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_SEARCH_THREADS, thread_name_prefix="pack-search")
+        return _executor
+
+
+class FederatedSources:
+    """Read-only concatenation of several packs' sources; document ids run pack after pack"""
+
+    def __init__(self, members):
+        self.members = members
+        self.offsets = [0]
+        for sources in members:
+            self.offsets.append(self.offsets[-1] + len(sources))
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.members)
+
+    def locate(self, doc_id):
+        """(member number, document id within that member) of a global document id"""
+        if not 0 <= doc_id < len(self):
+            raise IndexError(doc_id)
+        member = bisect.bisect_right(self.offsets, doc_id) - 1
+        return member, doc_id - self.offsets[member]
+
+    def __getitem__(self, doc_id):
+        member, local_id = self.locate(doc_id)
+        return self.members[member][local_id]
+
+    def texts(self):
+        return itertools.chain.from_iterable(iter_source_texts(sources) for sources in self.members)
+
+
+class FederatedPack:
+    """Several cached packs queried as one; checksum changes whenever any member changes"""
+
+    def __init__(self, packs):
+        self.packs = packs
+        self.path = None
+        self.sources = FederatedSources([pack.sources for pack in packs])
+        self.checksum = hashlib.sha1("\n".join(pack.checksum for pack in packs).encode("utf-8")).hexdigest()
+
+
+class FederatedIndex:
+    """Searches one index per pack concurrently and merges their results into global document ids"""
+
+    def __init__(self, indexes, sources):
+        self.indexes = indexes
+        self.sources = sources
+
+    def __len__(self):
+        return len(self.sources)
+
+    def search(self, search_terms, k, threshold=0.0):
+        """Global top-k (doc_id, score) pairs scoring at least threshold, best first"""
+        if len(self.indexes) == 1:
+            return self.indexes[0].search(search_terms, k, threshold)
+        futures = [_get_executor().submit(index.search, search_terms, k, threshold) for index in self.indexes]
+        # packs in order, so equal scores keep the earlier pack's chunk like a single index would
+        merged = ((self.sources.offsets[member] + doc_id, score)
+                  for member, future in enumerate(futures) for doc_id, score in future.result())
+        return select_top_k(merged, k)
+
+    def search_batch(self, queries, k, threshold=0.0):
+        """search() for a list of queries, one batch per pack, packs in parallel"""
+        futures = [_get_executor().submit(search_batch, index, queries, k, threshold) for index in self.indexes]
+        per_pack = [future.result() for future in futures]
+        return [select_top_k(((self.sources.offsets[member] + doc_id, score)
+                              for member, results in enumerate(per_pack) for doc_id, score in results[position]), k)
+                for position in range(len(queries))]
+
+
+class FederatedTableIndex:
+    """Table lookups across every pack's table index, mapped to global document ids"""
+
+    def __init__(self, indexes, sources):
+        self.indexes = indexes
+        self.sources = sources
+
+    def lookup(self, search_terms, threshold=0.0, max_docs=None):
+        """Best-scoring lookups over all packs, in the TableIndex.lookup shape"""
+        results = [(self.sources.offsets[member] + doc_id, score, facts)
+                   for member, index in enumerate(self.indexes)
+                   for doc_id, score, facts in index.lookup(search_terms, threshold)]
+        if not results:
+            return []
+        best_score = max(score for _, score, _ in results)
+        results = [result for result in results if result[1] == best_score]
+        return results[:max_docs] if max_docs else results
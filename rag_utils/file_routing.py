@@ -0,0 +1,118 @@
+"""
+Coarse-to-fine retrieval: rank files first, then score only their chunks.
+
+pack.json describes every file with "Description" and "Summary" fields. FileRouter
+indexes those (plus the file name) with BM25, one document per file, and maps a question
+to the chunks of its best-matching files. TwoLevelIndex puts that stage in front of any
+chunk-level retrieval method, so with hundreds of files most of the corpus is pruned
+before chunks are scored.
+
+Pruning never loses a file it cannot judge: files without a description or summary are
+always searched, and a question matching no file profile searches the whole pack.
+"""
+
+import logging
+
+import numpy as np
+
+from rag_utils.bm25_index import BM25Index
+from rag_utils.pack_stream import iter_pack_files
+from rag_utils.parallel_scoring import score_chunks
+from rag_utils.ranking import select_top_k
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOP_FILES = 0
+
+
+def read_file_profiles(pack_file):
+    """{file name: "Description Summary"} for every file in pack_file"""
+    profiles = {}
+    for processed_file in iter_pack_files(pack_file):
+        fields = (processed_file.get("Description"), processed_file.get("Summary"))
+        profiles[processed_file.get("File", "unknown_file")] = " ".join(str(field) for field in fields if field)
+    return profiles
+
+
+def _chunk_file_names(loaded_sources):
+    if hasattr(loaded_sources, "metadata"):
+        return (loaded_sources.metadata(position)[0] for position in range(len(loaded_sources)))
+    return (source["file_name"] for source in loaded_sources)
+
+
+class FileRouter:
+    """BM25 over one profile per file, mapping questions to the chunk ids of the best files"""
+
+    def __init__(self, file_names, file_doc_ids, profiled, index):
+        self.file_names = file_names
+        self.file_doc_ids = file_doc_ids
+        self.profiled = profiled
+        self.index = index
+
+    def __len__(self):
+        return len(self.file_names)
+
+    @classmethod
+    def build(cls, loaded_sources, profiles):
+        """
+        Router for the files of loaded_sources.
+
+        Args:
+            loaded_sources: chunk records or a chunk store
+            profiles: {file name: description and summary text}; missing files are unprofiled
+        """
+        positions = {}
+        for position, file_name in enumerate(_chunk_file_names(loaded_sources)):
+            positions.setdefault(file_name, []).append(position)
+        file_names = list(positions)
+        file_doc_ids = [np.asarray(positions[file_name], dtype=np.int64) for file_name in file_names]
+        profiled = np.array([bool(profiles.get(file_name, "").strip()) for file_name in file_names], dtype=bool)
+        index = BM25Index.build(f"{file_name} {profiles.get(file_name, '')}" for file_name in file_names)
+        logger.info(f"DEBUG: Built file router: {len(file_names)} files, {int(profiled.sum())} with a description or summary")
+        return cls(file_names, file_doc_ids, profiled, index)
+
+    def select(self, search_terms, top_files):
+        """
+        Sorted chunk ids of the top_files best-matching files plus every unprofiled file.
+
+        Returns None when nothing would be pruned: no file profile matches the question, or
+        the selection covers every file.
+        """
+        ranked = self.index.search(search_terms, top_files)
+        if not ranked:
+            return None
+        selected = ~self.profiled
+        selected[[file_id for file_id, _ in ranked]] = True
+        if selected.all():
+            return None
+        doc_ids = np.sort(np.concatenate([self.file_doc_ids[file_id] for file_id in np.flatnonzero(selected)]))
+        logger.info(f"DEBUG: File stage kept {int(selected.sum())} of {len(self)} files "
+                    f"({len(doc_ids)} chunks): {[self.file_names[file_id] for file_id, _ in ranked]}")
+        return doc_ids
+
+
+class TwoLevelIndex:
+    """Chunk retrieval restricted to the files a FileRouter selects for each question"""
+
+    def __init__(self, router, chunk_index, loaded_sources, top_files, scorer=None):
+        self.router = router
+        self.chunk_index = chunk_index
+        self.loaded_sources = loaded_sources
+        self.top_files = top_files
+        # per-chunk scorer(text, search_terms) used when there is no chunk index (full scan)
+        self.scorer = scorer
+
+    def __len__(self):
+        return len(self.loaded_sources)
+
+    def search(self, search_terms, k, threshold=0.0):
+        """Top-k (doc_id, score) pairs among the selected files' chunks, best first"""
+        doc_ids = self.router.select(search_terms, self.top_files)
+        if self.chunk_index is not None:
+            if doc_ids is None:
+                return self.chunk_index.search(search_terms, k, threshold)
+            return self.chunk_index.search(search_terms, k, threshold, doc_ids=doc_ids)
+        if doc_ids is None:
+            return score_chunks(self.scorer, self.loaded_sources, search_terms, threshold, k)
+        scored_ids = ((doc_id, self.scorer(self.loaded_sources[doc_id]["text"], search_terms)) for doc_id in doc_ids.tolist())
+        return select_top_k(((doc_id, score) for doc_id, score in scored_ids if score >= threshold), k)
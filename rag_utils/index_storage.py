@@ -0,0 +1,196 @@
+"""
+Persistence helpers shared by the retrieval indexes.
+
+Every index is a derived artifact of one pack file. It is saved next to the pack (or in
+a temp cache dir when the pack lives in a read-only bundle) together with the pack's
+fingerprint, and refreshed whenever that fingerprint no longer matches.
+
+A refresh is incremental when it can be. Alongside each index a small manifest records
+the pack's file segments: for every run of chunks from one File entry, its name, a hash
+of its chunk texts and pages, and its chunk count. On the next change the segments are
+diffed; chunks of unchanged files keep their postings/vectors (moved to their new
+positions) and only added or changed files are tokenized and embedded. Once the chunks
+re-indexed since the last full build exceed MAX_UPDATE_FRACTION of the pack, the index
+is rebuilt from scratch so corpus-wide statistics (vector idf, vocabulary) are compacted.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def get_pack_fingerprint(pack_file):
+    """Cheap fingerprint of a pack file used to validate persisted indexes"""
+    stat = os.stat(pack_file)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def get_index_path(pack_file, suffix):
+    """
+    Location for a derived artifact of pack_file.
+
+    Artifacts live next to the pack when that directory is writable, otherwise in a
+    per-user temp directory so read-only skill bundles still get a persistent index.
+    """
+    pack_dir = os.path.dirname(os.path.abspath(pack_file))
+    base_name = os.path.basename(pack_file)
+    if os.access(pack_dir, os.W_OK):
+        return os.path.join(pack_dir, f"{base_name}.{suffix}")
+
+    cache_dir = os.path.join(tempfile.gettempdir(), "rag_index_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    path_hash = hashlib.sha1(os.path.abspath(pack_file).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{path_hash}.{base_name}.{suffix}")
+
+
+# share of the pack that may be re-indexed incrementally before a full rebuild
+MAX_UPDATE_FRACTION = 0.3
+
+
+def iter_source_texts(loaded_sources):
+    """Chunk texts in document-id order; chunk stores hand them out without materializing records"""
+    if hasattr(loaded_sources, "texts"):
+        return loaded_sources.texts()
+    return (source["text"] for source in loaded_sources)
+
+
+def _iter_file_chunks(loaded_sources):
+    """(file_name, page, text) of every chunk in document-id order"""
+    if hasattr(loaded_sources, "metadata"):
+        for position in range(len(loaded_sources)):
+            file_name, page = loaded_sources.metadata(position)
+            yield file_name, page, loaded_sources.text(position)
+    else:
+        for source in loaded_sources:
+            yield source["file_name"], source["chunk_index"], source["text"]
+
+
+def compute_segments(loaded_sources):
+    """[file_name, content hash, chunk count] for each run of consecutive chunks from one file"""
+    segments = []
+    digest = None
+    for file_name, page, text in _iter_file_chunks(loaded_sources):
+        if not segments or segments[-1][0] != file_name:
+            if digest is not None:
+                segments[-1][1] = digest.hexdigest()
+            digest = hashlib.blake2b(digest_size=16)
+            segments.append([file_name, None, 0])
+        digest.update(f"{page}\x00".encode("utf-8"))
+        digest.update(str(text).encode("utf-8"))
+        digest.update(b"\x01")
+        segments[-1][2] += 1
+    if digest is not None:
+        segments[-1][1] = digest.hexdigest()
+    return segments
+
+
+def plan_update(old_segments, new_segments):
+    """
+    Diff two segment lists.
+
+    Returns:
+        int64 array with, for every new document id, the old document id holding the same
+        chunk, or -1 where the chunk belongs to an added or changed file
+    """
+    old_starts = {}
+    position = 0
+    for file_name, content_hash, count in old_segments:
+        old_starts.setdefault((file_name, content_hash), []).append(position)
+        position += count
+
+    old_positions = np.full(sum(count for _, _, count in new_segments), -1, dtype=np.int64)
+    position = 0
+    for file_name, content_hash, count in new_segments:
+        starts = old_starts.get((file_name, content_hash))
+        if starts:
+            start = starts.pop(0)
+            old_positions[position:position + count] = np.arange(start, start + count)
+        position += count
+    return old_positions
+
+
+def _manifest_path(index_path):
+    return f"{index_path}.segments.json"
+
+
+def _read_manifest(index_path, fingerprint):
+    try:
+        with open(_manifest_path(index_path), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("fingerprint") == fingerprint else None
+
+
+def _write_manifest(index_path, fingerprint, segments, reindexed):
+    tmp_path = f"{_manifest_path(index_path)}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "segments": segments, "reindexed_since_build": reindexed}, f)
+    os.replace(tmp_path, _manifest_path(index_path))
+
+
+def _update_index(index, index_path, loaded_sources, fingerprint, segments):
+    """Incrementally updated index, or None when there is no usable manifest or too much changed"""
+    manifest = _read_manifest(index_path, index.fingerprint)
+    if manifest is None or not hasattr(index, "update"):
+        return None, 0
+    old_positions = plan_update(manifest["segments"], segments)
+    new_ids = np.flatnonzero(old_positions < 0)
+    reindexed = manifest["reindexed_since_build"] + len(new_ids)
+    if reindexed > MAX_UPDATE_FRACTION * len(old_positions):
+        logger.info(f"DEBUG: {reindexed} of {len(old_positions)} chunks re-indexed since the last build, compacting")
+        return None, 0
+    texts = [loaded_sources[int(doc_id)]["text"] for doc_id in new_ids]
+    logger.info(f"DEBUG: Updating {type(index).__name__} in place: {len(new_ids)} chunks to index, "
+                f"{len(old_positions) - len(new_ids)} reused, {len(index) - (len(old_positions) - len(new_ids))} dropped")
+    return index.update(old_positions, texts, fingerprint=fingerprint), reindexed
+
+
+def load_or_build(index_cls, pack_file, loaded_sources, suffix, **build_kwargs):
+    """
+    Return index_cls for the chunks of pack_file, reusing a persisted copy when it is current.
+
+    index_cls must provide build(texts, fingerprint=..., **build_kwargs), save(path), load(path),
+    a fingerprint attribute and __len__. A stale copy is updated in place when index_cls has
+    update(old_positions, new_texts, fingerprint=...) and its manifest allows it, otherwise it
+    is rebuilt; either way the result is saved again.
+    """
+    name = index_cls.__name__
+    fingerprint = get_pack_fingerprint(pack_file) if pack_file else None
+    index_path = get_index_path(pack_file, suffix) if pack_file else None
+    index = None
+    reindexed = 0
+    segments = None
+
+    if index_path and os.path.exists(index_path):
+        try:
+            stale = index_cls.load(index_path)
+            if stale.fingerprint == fingerprint and len(stale) == len(loaded_sources):
+                logger.info(f"DEBUG: Loaded {name} from {index_path}")
+                return stale
+            logger.info(f"DEBUG: {name} at {index_path} is stale")
+            segments = compute_segments(loaded_sources)
+            index, reindexed = _update_index(stale, index_path, loaded_sources, fingerprint, segments)
+        except Exception as e:
+            logger.warning(f"DEBUG: Could not load or update {name} from {index_path}: {e}")
+
+    if index is None:
+        logger.info(f"DEBUG: Building {name} over {len(loaded_sources)} chunks")
+        index = index_cls.build(iter_source_texts(loaded_sources), fingerprint=fingerprint, **build_kwargs)
+
+    if index_path:
+        try:
+            index.save(index_path)
+            if segments is None:
+                segments = compute_segments(loaded_sources)
+            _write_manifest(index_path, fingerprint, segments, reindexed)
+            logger.info(f"DEBUG: Saved {name} to {index_path}")
+        except OSError as e:
+            logger.warning(f"DEBUG: Could not persist {name} to {index_path}: {e}")
+    return index
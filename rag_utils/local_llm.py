@@ -0,0 +1,58 @@
+"""
+Deterministic, offline stand-in for the platform LLM.
+
+LocalLLM has ArUtils' get_llm_response(prompt) interface and answers the skill's
+prompts extractively: it picks the sentences of each "====== Source N ====" block (or
+the "- fact [N]" lines of a synthesis prompt) that mention the question's terms and
+returns them in the shape the prompt asks for, keeping source numbers. It is selected
+with RAG_LLM_BACKEND=local, for tests, benchmarks and evaluation runs without platform
+access; latency_seconds and seconds_per_kchar simulate a remote model's response time.
+"""
+
+import re
+import time
+
+from rag_utils.bm25_index import query_terms, tokenize
+
+BACKEND_ENV = "RAG_LLM_BACKEND"
+LATENCY_ENV = "RAG_LOCAL_LLM_LATENCY"
+
+_QUESTION = re.compile(r"^(?:Answer this question|Question):\s*(.+)$", re.MULTILINE)
+_SOURCE = re.compile(r"^=+ Source (\d+) =+\n(.*?)(?=^=+ Source \d+ =+|\Z)", re.MULTILINE | re.DOTALL)
+_CONTENT = re.compile(r"^Content:\s*(.*)", re.MULTILINE | re.DOTALL)
+_FACT = re.compile(r"^- (.+?)\s*\[(\d+)\]\s*$", re.MULTILINE)
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+class LocalLLM:
+    """Extractive get_llm_response() with optional simulated latency"""
+
+    def __init__(self, latency_seconds=0.0, seconds_per_kchar=0.0, max_facts_per_source=2):
+        self.latency_seconds = latency_seconds
+        self.seconds_per_kchar = seconds_per_kchar
+        self.max_facts_per_source = max_facts_per_source
+
+    def get_llm_response(self, prompt):
+        delay = self.latency_seconds + self.seconds_per_kchar * len(prompt) / 1000
+        if delay:
+            time.sleep(delay)
+        match = _QUESTION.search(prompt)
+        question = match.group(1).strip() if match else ""
+        terms = set(query_terms([question]))
+
+        facts = [(fact, int(number)) for fact, number in _FACT.findall(prompt.split("### Facts", 1)[1])] \
+            if "### Facts" in prompt else self._extract(prompt, terms)
+        if "### Sources" in prompt:
+            # fact extraction step of map-reduce generation
+            return "\n".join(f"- {fact} [{number}]" for fact, number in facts) or "NONE"
+        content = "".join(f"<p>{fact}<sup>[{number}]</sup></p>" for fact, number in facts)
+        return f"<title>{question or 'Answer'}</title><content>{content or '<p>No relevant facts found.</p>'}</content>"
+
+    def _extract(self, prompt, terms):
+        facts = []
+        for number, block in _SOURCE.findall(prompt):
+            content = _CONTENT.search(block)
+            sentences = [sentence.strip() for sentence in _SENTENCE_END.split(content.group(1) if content else "")]
+            relevant = [sentence for sentence in sentences if sentence and terms & set(tokenize(sentence))]
+            facts.extend((" ".join(sentence.split()), int(number)) for sentence in relevant[:self.max_facts_per_source])
+        return facts
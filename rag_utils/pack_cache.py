@@ -0,0 +1,104 @@
+"""
+Process-level cache of parsed knowledge packs.
+
+A pack is parsed once per process and reused until the file's size or mtime change.
+When only the mtime moved (e.g. the pack was re-copied unchanged) the content checksum
+is compared before throwing the parsed sources away. Anything derived from the sources,
+such as the BM25 index, is memoized on the cached pack and dropped with it.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+_cache_lock = threading.Lock()
+_pack_cache = {}
+_resolved_paths = {}
+
+
+def file_checksum(path, block_size=1 << 20):
+    """SHA-1 of the file contents"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class CachedPack:
+    """Parsed sources of one pack file plus any structures derived from them"""
+
+    def __init__(self, path, stat_key, checksum, sources):
+        self.path = path
+        self.stat_key = stat_key
+        self.checksum = checksum
+        self.sources = sources
+        self._derived = {}
+        self._derived_lock = threading.Lock()
+
+    def get_derived(self, name, builder):
+        """Return the structure stored under name, building it on first use"""
+        with self._derived_lock:
+            if name not in self._derived:
+                self._derived[name] = builder()
+            return self._derived[name]
+
+
+def get_cached_pack(pack_file, loader, checksum=file_checksum):
+    """
+    Return the CachedPack for pack_file, calling loader(pack_file) only on a cold or stale cache.
+
+    checksum(pack_file) identifies the content; compiled stores pass a function that reads the
+    digest from their header instead of hashing the whole file. Empty loads are not cached so
+    a transient read error does not stick for the process lifetime.
+    """
+    pack_file = os.path.abspath(pack_file)
+    stat_key = _stat_key(pack_file)
+
+    with _cache_lock:
+        cached = _pack_cache.get(pack_file)
+    if cached is not None:
+        if cached.stat_key == stat_key:
+            logger.info(f"DEBUG: Pack cache hit for {pack_file}")
+            return cached
+        if checksum(pack_file) == cached.checksum:
+            logger.info(f"DEBUG: Pack {pack_file} touched but unchanged, keeping cached sources")
+            cached.stat_key = stat_key
+            return cached
+        logger.info(f"DEBUG: Pack {pack_file} changed on disk, reloading")
+
+    content_checksum = checksum(pack_file)
+    sources = loader(pack_file)
+    pack = CachedPack(pack_file, stat_key, content_checksum, sources)
+    if sources:
+        with _cache_lock:
+            _pack_cache[pack_file] = pack
+    return pack
+
+
+def get_cached_path(key, resolver):
+    """Memoize a path lookup under key while the resolved file still exists"""
+    with _cache_lock:
+        path = _resolved_paths.get(key)
+    if path and os.path.exists(path):
+        return path
+    path = resolver()
+    if path:
+        with _cache_lock:
+            _resolved_paths[key] = path
+    return path
+
+
+def clear_pack_cache():
+    """Drop every cached pack and resolved path"""
+    with _cache_lock:
+        _pack_cache.clear()
+        _resolved_paths.clear()
@@ -0,0 +1,115 @@
+"""
+Streaming reader for pack.json.
+
+pack.json is a top-level array of file objects ([{"File": ..., "Chunks": [...]}, ...]).
+Instead of json.load on the whole document, the array is walked one element at a time
+with JSONDecoder.raw_decode over a growing read buffer, so at most one file object is
+held in memory at once.
+"""
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+READ_BLOCK_SIZE = 1 << 20
+DESCRIPTION_LENGTH = 200
+_WHITESPACE = " \t\n\r"
+
+
+def make_description(text):
+    """Chunk description used in prompts: the first 200 characters of the text"""
+    text = str(text)
+    return text[:DESCRIPTION_LENGTH] + "..." if len(text) > DESCRIPTION_LENGTH else text
+
+
+class _PackReader:
+    """Buffered text reader that can peek past whitespace and grow its buffer on demand"""
+
+    def __init__(self, f, block_size):
+        self.f = f
+        self.block_size = block_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self, size=None):
+        data = self.f.read(size or self.block_size)
+        if not data:
+            self.eof = True
+            return False
+        # drop consumed text so the buffer only ever holds the current element
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-whitespace character, or '' at end of input"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ""
+
+
+def iter_pack_files(pack_file, block_size=READ_BLOCK_SIZE):
+    """
+    Yield each top-level file object of pack_file in order.
+
+    Raises:
+        ValueError: if the document is not a JSON array or is truncated
+    """
+    decoder = json.JSONDecoder()
+    with open(pack_file, "r", encoding="utf-8") as f:
+        reader = _PackReader(f, block_size)
+        if reader.peek() != "[":
+            raise ValueError(f"Unexpected pack.json format - expected array of files in {pack_file}")
+        reader.pos += 1
+
+        expect_value = True
+        while True:
+            char = reader.peek()
+            if char == "]":
+                return
+            if char == "":
+                raise ValueError(f"Unexpected end of {pack_file}")
+            if char == ",":
+                if expect_value:
+                    raise ValueError(f"Malformed array in {pack_file}")
+                reader.pos += 1
+                expect_value = True
+                continue
+
+            while True:
+                try:
+                    value, end = decoder.raw_decode(reader.buffer, reader.pos)
+                    # a value ending exactly at the buffer edge may be a truncated number
+                    if end < len(reader.buffer) or reader.eof:
+                        break
+                except json.JSONDecodeError:
+                    if reader.eof:
+                        raise
+                # grow geometrically so re-decoding a large element stays linear overall
+                reader.read_more(max(reader.block_size, len(reader.buffer)))
+            reader.pos = end
+            expect_value = False
+            yield value
+
+
+def iter_pack_sources(pack_file, block_size=READ_BLOCK_SIZE):
+    """Yield source records (the load_document_sources shape) one chunk at a time"""
+    for processed_file in iter_pack_files(pack_file, block_size):
+        file_name = processed_file.get("File", "unknown_file")
+        chunks = processed_file.get("Chunks", [])
+        logger.info(f"DEBUG: Processing file '{file_name}' with {len(chunks)} chunks")
+        for chunk in chunks:
+            text = chunk.get("Text", "")
+            yield {
+                "file_name": file_name,
+                "text": text,
+                "description": make_description(text),
+                "chunk_index": chunk.get("Page", 1),
+                "citation": file_name
+            }
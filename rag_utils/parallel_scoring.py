@@ -0,0 +1,121 @@
+"""
+Sharded, multi-process scoring for the per-chunk relevance scan.
+
+The keyword scorer is pure Python and visits every chunk, so on large packs it is
+CPU-bound on one core. score_chunks splits the corpus into contiguous shards, scores
+them on a process pool and merges each shard's local top-k into the global top-k.
+Shards are merged in document order with the same tie-breaking as select_top_k, so
+the result is identical to a serial scan.
+
+Only chunk stores are sharded: workers get the store's path and memory-map it once, so
+no chunk text crosses process boundaries per query. Plain source lists are always scanned
+in-process, since pickling every shard's text to the workers costs about as much as the
+scan itself. Workers are started with forkserver (spawn where that is unavailable), never
+forked from the skill process, which has threads of its own.
+
+The sharded scan is off by default. Set RAG_PARALLEL_MIN_CHUNKS to the store size from
+which it beats a serial scan on the host, as measured by
+`python -m benchmarks.bench_rag_retrieval parallel`.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from rag_utils.index_storage import iter_source_texts
+from rag_utils.ranking import select_top_k
+
+logger = logging.getLogger(__name__)
+
+PARALLEL_MIN_CHUNKS_ENV = "RAG_PARALLEL_MIN_CHUNKS"
+
+_pool = None
+_pool_lock = threading.Lock()
+_worker_stores = {}
+
+
+def get_worker_count():
+    """Cores available to this process"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_parallel_min_chunks():
+    """Store size from which scans are sharded, from $RAG_PARALLEL_MIN_CHUNKS; None (never) when unset"""
+    value = os.environ.get(PARALLEL_MIN_CHUNKS_ENV)
+    try:
+        return int(value) if value else None
+    except ValueError:
+        logger.warning(f"DEBUG: Ignoring {PARALLEL_MIN_CHUNKS_ENV}={value!r}, scanning serially")
+        return None
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(max_workers=get_worker_count(), mp_context=multiprocessing.get_context(method))
+        return _pool
+
+
+def shutdown_pool():
+    """Stop the worker processes; the next parallel scan starts a new pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def _score_texts(scorer, texts, start, search_terms, threshold, k):
+    scored_ids = ((doc_id, scorer(text, search_terms)) for doc_id, text in enumerate(texts, start))
+    return select_top_k(((doc_id, score) for doc_id, score in scored_ids if score >= threshold), k)
+
+
+def _score_store_shard(scorer, store_path, start, end, search_terms, threshold, k):
+    """Worker side: score chunks [start, end) of a chunk store opened (once) in this process"""
+    from rag_utils.chunk_store import ChunkStore
+
+    # keyed by mtime too, so a recompiled store is re-opened rather than read through a stale map
+    store_key = (store_path, os.stat(store_path).st_mtime_ns)
+    store = _worker_stores.get(store_key)
+    if store is None:
+        store = _worker_stores[store_key] = ChunkStore.open(store_path)
+    return _score_texts(scorer, (store.text(position) for position in range(start, end)), start,
+                        search_terms, threshold, k)
+
+
+def score_chunks(scorer, loaded_sources, search_terms, threshold, k, min_chunks=None, workers=None):
+    """
+    Top-k (doc_id, score) pairs of scorer(text, search_terms) over every chunk scoring at least threshold.
+
+    scorer must be a module-level function so it can be sent to worker processes. Chunk stores
+    of at least min_chunks (default: get_parallel_min_chunks(), never when unset) are split into
+    one shard per worker; source lists and a failing pool get a serial scan.
+    """
+    num_chunks = len(loaded_sources)
+    workers = workers or get_worker_count()
+    min_chunks = get_parallel_min_chunks() if min_chunks is None else min_chunks
+    store_path = getattr(loaded_sources, "path", None)
+    if not store_path or min_chunks is None or num_chunks < min_chunks or workers < 2:
+        return _score_texts(scorer, iter_source_texts(loaded_sources), 0, search_terms, threshold, k)
+
+    bounds = [num_chunks * shard // workers for shard in range(workers + 1)]
+    logger.info(f"DEBUG: Scoring {num_chunks} chunks in {workers} shards")
+    try:
+        pool = _get_pool()
+        futures = [pool.submit(_score_store_shard, scorer, store_path, start, end, search_terms, threshold, k)
+                   for start, end in zip(bounds, bounds[1:])]
+        shard_results = [future.result() for future in futures]
+    except Exception as e:
+        logger.warning(f"DEBUG: Parallel scoring failed, scanning serially: {e}")
+        shutdown_pool()
+        return _score_texts(scorer, iter_source_texts(loaded_sources), 0, search_terms, threshold, k)
+
+    # shards are in document order, so merging keeps select_top_k's earliest-first tie-breaking
+    return select_top_k((pair for shard in shard_results for pair in shard), k)
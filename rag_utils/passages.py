@@ -0,0 +1,77 @@
+"""
+Query-time passage extraction for retrieved chunks.
+
+A retrieved chunk is a whole page, usually with START/END OF PAGE markers and tables
+unrelated to the question. extract_passage keeps only windows of context characters
+around each query-term hit, merged where they overlap and widened to word boundaries,
+so the prompt carries the relevant sentences instead of the page. Terms match their
+inflections too ("emergency" finds "emergencies"), mirroring what the indexes match.
+"""
+
+import re
+
+from rag_utils.bm25_index import query_terms
+
+DEFAULT_CONTEXT_CHARS = 300
+PASSAGE_SEPARATOR = " ... "
+# terms up to this long only match as whole words (plus a plural ending)
+SHORT_TERM_LENGTH = 4
+
+_PAGE_MARKER = re.compile(r"(?:START|END) OF PAGE:?\s*\d*", re.IGNORECASE)
+
+
+def _term_alternative(term):
+    if len(term) <= SHORT_TERM_LENGTH:
+        return re.escape(term) + r"(?:s|es)?\b"
+    # keep at least five characters and drop up to three of inflection: emergency/emergencies, flood/flooding
+    return re.escape(term[:max(len(term) - 3, 5)]) + r"\w*"
+
+
+def compile_term_pattern(search_terms):
+    """Regex matching any query term (or an inflection of it) as a word, or None if there are no terms"""
+    alternatives = {_term_alternative(term) for term in query_terms(search_terms)}
+    if not alternatives:
+        return None
+    return re.compile(r"\b(?:" + "|".join(sorted(alternatives, key=len, reverse=True)) + ")", re.IGNORECASE)
+
+
+def strip_page_markers(text):
+    """Chunk text without the START/END OF PAGE markers added by the pack builder"""
+    return _PAGE_MARKER.sub("", text).strip()
+
+
+def _widen(text, start, end):
+    """Move start back and end forward to the nearest whitespace"""
+    while start > 0 and not text[start - 1].isspace():
+        start -= 1
+    while end < len(text) and not text[end].isspace():
+        end += 1
+    return start, end
+
+
+def extract_passage(text, term_pattern, context_chars=DEFAULT_CONTEXT_CHARS):
+    """
+    The parts of text within context_chars of a term hit, joined with " ... ".
+
+    Returns the marker-free text unchanged when it is already short enough, and its opening
+    2 * context_chars when nothing matches (e.g. a chunk found through a trigram match).
+    """
+    text = strip_page_markers(str(text or ""))
+    if context_chars is None or context_chars <= 0 or len(text) <= 2 * context_chars:
+        return text
+
+    windows = []
+    if term_pattern is not None:
+        for match in term_pattern.finditer(text):
+            start, end = _widen(text, max(0, match.start() - context_chars), min(len(text), match.end() + context_chars))
+            if windows and start <= windows[-1][1]:
+                windows[-1][1] = end
+            else:
+                windows.append([start, end])
+    if not windows:
+        windows = [list(_widen(text, 0, 2 * context_chars))]
+
+    parts = [text[start:end].strip() for start, end in windows]
+    prefix = PASSAGE_SEPARATOR.lstrip() if windows[0][0] > 0 else ""
+    suffix = PASSAGE_SEPARATOR.rstrip() if windows[-1][1] < len(text) else ""
+    return prefix + PASSAGE_SEPARATOR.join(parts) + suffix
@@ -0,0 +1,41 @@
+"""
+Top-k selection helpers for document retrieval.
+"""
+
+import heapq
+
+
+def select_top_k(scored_items, k):
+    """
+    Keep the k highest-scoring items from an iterable of (item, score) pairs.
+
+    Uses a bounded min-heap, so memory is O(k) and an item that cannot enter the
+    top k costs a single comparison against the current k-th best score.
+    Ties are broken in favour of the item seen first.
+
+    Returns:
+        list of (item, score) pairs sorted by descending score
+    """
+    k = int(k)
+    if k <= 0:
+        return []
+
+    heap = []
+    seq = 0
+    for item, score in scored_items:
+        seq += 1
+        if len(heap) < k:
+            # -seq makes earlier items compare as larger on equal scores
+            heapq.heappush(heap, (score, -seq, item))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, -seq, item))
+
+    heap.sort(key=lambda entry: entry[:2], reverse=True)
+    return [(item, score) for score, _, item in heap]
+
+
+def search_batch(index, queries, k, threshold=0.0):
+    """Top-k results per query, batched when the index supports it and one search() each otherwise"""
+    if hasattr(index, "search_batch"):
+        return index.search_batch(queries, k, threshold)
+    return [index.search(search_terms, k, threshold) for search_terms in queries]
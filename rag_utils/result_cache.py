@@ -0,0 +1,118 @@
+"""
+Process-level cache of rendered skill results.
+
+The same few questions are asked over and over, and every miss pays for retrieval plus
+an LLM call. Results are keyed by the normalized question, every parameter that changes
+retrieval or rendering, and the pack checksum, so a new pack version never serves stale
+answers. Entries expire after a TTL and the least recently used ones are evicted once
+the cached HTML exceeds a byte budget.
+"""
+
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 60 * 60
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.]+$")
+
+
+def normalize_question(question):
+    """Case- and whitespace-insensitive form of a question, ignoring trailing punctuation"""
+    return _TRAILING_PUNCTUATION.sub("", " ".join(str(question or "").split()).casefold())
+
+
+def make_result_key(user_question, pack_checksum, **parameters):
+    """Stable key for a question against one pack version; parameters are compared by value"""
+    parts = [normalize_question(user_question), pack_checksum or ""]
+    parts.extend(f"{name}={parameters[name]!r}" for name in sorted(parameters))
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def _entry_size(value):
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, dict):
+        return sum(_entry_size(item) for item in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(_entry_size(item) for item in value)
+    return 64
+
+
+class ResultCache:
+    """Thread-safe LRU cache bounded by total entry size, with per-entry TTL and hit/miss counters"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Cached value for key, or None on a miss or an expired entry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.clock() - entry[0] > self.ttl_seconds:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value):
+        """Store value under key, evicting least recently used entries to stay within max_bytes"""
+        size = _entry_size(value)
+        if size > self.max_bytes:
+            logger.info(f"DEBUG: Result of {size} bytes exceeds the cache budget, not caching")
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.clock(), size, value)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def clear(self):
+        """Drop every entry; counters are kept"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """Counters and occupancy, e.g. for logging"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
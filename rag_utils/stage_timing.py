@@ -0,0 +1,78 @@
+"""
+Per-invocation stage timings for the skill.
+
+A StageRecorder is created per question. Each stage (loading the pack, the retrieval
+index, ranking, the LLM call, HTML rendering, wire_layout) runs inside span(name), which
+records its offset from the start of the invocation, its duration and whatever counts the
+stage adds to the yielded dict (chunks searched, prompt characters, HTML size). A stage
+that raises is recorded with the exception type and the exception propagates.
+
+record() is one structured dict per invocation. write() appends it as a JSON line to the
+file named by RAG_STAGE_TIMINGS_PATH (or an explicit path), so slow answers can be broken
+down offline; without a path nothing is written. A path that cannot be written is logged
+and skipped, it never fails the invocation.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TIMINGS_PATH_ENV = "RAG_STAGE_TIMINGS_PATH"
+
+# one lock for every recorder, so concurrent invocations never interleave lines
+_WRITE_LOCK = threading.Lock()
+
+
+class StageRecorder:
+    """Timed spans of one skill invocation, plus invocation-level attributes"""
+
+    def __init__(self, **attributes):
+        self.attributes = attributes
+        self.spans = []
+        self.timestamp = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Time the body; the yielded dict's items are stored with the span"""
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            span = {"name": name, "start_ms": round((start - self._start) * 1000, 3),
+                    "duration_ms": round(duration_ms, 3), **attributes}
+            with self._lock:
+                self.spans.append(span)
+            logger.info(f"DEBUG: Stage {name} took {duration_ms:.1f}ms {attributes}")
+
+    def record(self):
+        """{"timestamp", "total_ms", invocation attributes..., "spans": [...]} so far"""
+        with self._lock:
+            spans = list(self.spans)
+        return {"timestamp": self.timestamp, "total_ms": round((time.perf_counter() - self._start) * 1000, 3),
+                **self.attributes, "spans": spans}
+
+    def write(self, path=None):
+        """Append record() as one JSON line to path (default: $RAG_STAGE_TIMINGS_PATH); the record, or None if unset or unwritable"""
+        path = path or os.environ.get(TIMINGS_PATH_ENV)
+        if not path:
+            return None
+        record = self.record()
+        line = json.dumps(record, default=str)
+        try:
+            with _WRITE_LOCK, open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"DEBUG: Could not write stage timings to {path}: {e}")
+            return None
+        return record
@@ -0,0 +1,188 @@
+"""
+Structured index of the markdown tables inside pack chunks.
+
+Many pages are mostly tables (city highs, wind speeds per region). Every table row is
+parsed into facts of (row entity, column header, value) plus the nearest heading above
+the table and the id of the chunk it came from, stored column-wise and persisted next to
+the pack like the retrieval indexes. The row entity is the row's first cell.
+
+A question is a direct lookup when it names a row entity ("Dubai") and a column or table
+heading ("forecast high" matches "Major City Highs"). For those, lookup() returns the
+matching rows as a few compact lines per chunk, so the prompt carries the facts instead
+of whole pages.
+"""
+
+import logging
+import os
+import re
+
+import numpy as np
+
+from rag_utils.bm25_index import query_terms, tokenize
+from rag_utils.index_storage import load_or_build
+from rag_utils.passages import compile_term_pattern
+
+logger = logging.getLogger(__name__)
+
+TABLE_FORMAT_VERSION = 1
+DEFAULT_MAX_FACTS = 12
+
+_SEPARATOR_CELL = re.compile(r"^:?-+:?$")
+
+
+def _split_row(line):
+    return [cell.strip() for cell in line.strip().strip("|").split("|")]
+
+
+def parse_markdown_tables(text):
+    """
+    Yield (heading, headers, rows) for every markdown table in text.
+
+    heading is the closest "#" heading above the table ("" if none); rows are padded or cut
+    to the number of headers.
+    """
+    lines = str(text or "").splitlines()
+    heading = ""
+    position = 0
+    while position < len(lines):
+        line = lines[position].strip()
+        if line.startswith("#"):
+            heading = line.lstrip("#").strip()
+        if (line.startswith("|") and position + 1 < len(lines)
+                and all(_SEPARATOR_CELL.match(cell) for cell in _split_row(lines[position + 1]))):
+            headers = _split_row(line)
+            rows = []
+            position += 2
+            while position < len(lines) and lines[position].strip().startswith("|"):
+                cells = _split_row(lines[position])
+                rows.append((cells + [""] * len(headers))[:len(headers)])
+                position += 1
+            yield heading, headers, rows
+            continue
+        position += 1
+
+
+def extract_facts(text):
+    """(heading, entity, column, value) for every non-empty cell after each row's first"""
+    for heading, headers, rows in parse_markdown_tables(text):
+        for cells in rows:
+            if not cells[0]:
+                continue
+            for column, value in zip(headers[1:], cells[1:]):
+                if value:
+                    yield heading, cells[0], column, value
+
+
+def format_fact(entity, column, value):
+    return f"{entity} | {column}: {value}"
+
+
+class TableIndex:
+    """Column-wise (chunk id, heading, entity, column, value) facts with an entity token lookup"""
+
+    def __init__(self, doc_ids, headings, entities, columns, values, num_docs, fingerprint=None):
+        self.doc_ids = doc_ids
+        self.headings = headings
+        self.entities = entities
+        self.columns = columns
+        self.values = values
+        self.num_docs = num_docs
+        self.fingerprint = fingerprint
+        self.entity_facts = {}
+        for fact_id, entity in enumerate(entities.tolist()):
+            for token in set(tokenize(entity)):
+                self.entity_facts.setdefault(token, []).append(fact_id)
+
+    def __len__(self):
+        return self.num_docs
+
+    @classmethod
+    def build(cls, texts, fingerprint=None):
+        """Parse the tables of an iterable of chunk texts"""
+        facts = []
+        num_docs = 0
+        for doc_id, text in enumerate(texts):
+            num_docs += 1
+            if "|" in text:
+                facts.extend((doc_id,) + fact for fact in extract_facts(text))
+        columns = list(zip(*facts)) or [(), (), (), (), ()]
+        logger.info(f"Built table index: {len(facts)} facts from {num_docs} chunks")
+        return cls(np.asarray(columns[0], dtype=np.int32), *(np.asarray(column, dtype=str) for column in columns[1:]),
+                   num_docs=num_docs, fingerprint=fingerprint)
+
+    def lookup(self, search_terms, threshold=0.0, max_docs=None, max_facts=DEFAULT_MAX_FACTS):
+        """
+        Direct-lookup matches for a question.
+
+        Returns:
+            (doc_id, score, facts text) per chunk, best first, where facts text holds the chunk's
+            matching rows (at most max_facts in total). A fact matches when its entity contains
+            a query term and its column or heading matches another; its score is the fraction of
+            query terms it covers, and only the best-scoring facts are kept. Empty when the
+            question is not a direct lookup.
+        """
+        terms = query_terms(search_terms)
+        fact_ids = sorted({fact_id for term in terms for fact_id in self.entity_facts.get(term, ())})
+        if not fact_ids:
+            return []
+
+        patterns = {term: compile_term_pattern([term]) for term in terms}
+        scored = []
+        for fact_id in fact_ids:
+            entity_terms = set(tokenize(self.entities[fact_id])) & set(terms)
+            label = f"{self.columns[fact_id]} {self.headings[fact_id]}"
+            label_terms = [term for term in terms if term not in entity_terms
+                           and patterns[term].search(label)]
+            score = (len(entity_terms) + len(label_terms)) / len(terms)
+            if label_terms and score >= threshold:
+                column_hits = sum(1 for term in label_terms if patterns[term].search(self.columns[fact_id]))
+                scored.append(((score, column_hits), fact_id))
+        if not scored:
+            return []
+        # only the best-covering rows answer the lookup, a column match beating a heading match;
+        # document order among them
+        best_rank = max(rank for rank, _ in scored)
+        scored = [(rank[0], fact_id) for rank, fact_id in scored if rank == best_rank][:max_facts]
+
+        by_doc = {}
+        for score, fact_id in scored:
+            doc_id = int(self.doc_ids[fact_id])
+            best, facts = by_doc.setdefault(doc_id, (score, {}))
+            facts.setdefault(str(self.headings[fact_id]), []).append(
+                format_fact(self.entities[fact_id], self.columns[fact_id], self.values[fact_id]))
+        results = [(doc_id, best, "\n".join((f"{heading}:\n" if heading else "") + "\n".join(lines)
+                                            for heading, lines in facts.items()))
+                   for doc_id, (best, facts) in by_doc.items()]
+        logger.info(f"DEBUG: Table lookup matched {len(scored)} facts in {len(results)} chunks")
+        return results[:max_docs] if max_docs else results
+
+    def save(self, path):
+        """Persist the facts as an uncompressed .npz file"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=np.array(TABLE_FORMAT_VERSION),
+                doc_ids=self.doc_ids,
+                headings=self.headings,
+                entities=self.entities,
+                columns=self.columns,
+                values=self.values,
+                num_docs=np.array(self.num_docs),
+                fingerprint=np.array(self.fingerprint or ""),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save()"""
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != TABLE_FORMAT_VERSION:
+                raise ValueError(f"Unsupported table index version in {path}")
+            return cls(data["doc_ids"], data["headings"], data["entities"], data["columns"], data["values"],
+                       num_docs=int(data["num_docs"]), fingerprint=str(data["fingerprint"]) or None)
+
+
+def load_or_build_table_index(pack_file, loaded_sources):
+    """Table index for the chunks of pack_file, persisted next to it like the retrieval indexes"""
+    return load_or_build(TableIndex, pack_file, loaded_sources, "tables.npz")
@@ -0,0 +1,60 @@
+"""
+Shared, precompiled Jinja templates for the RAG prompts and HTML.
+
+Template(source) compiles its source on every call. TemplateRenderer registers the
+skill's template strings by name in one jinja2.Environment, compiles each on first use
+and keeps it for the life of the process (auto_reload is off, as the sources never
+change at runtime). The environment has Template()'s defaults, so renders are
+byte-identical.
+
+With a bytecode cache directory (argument or RAG_TEMPLATE_CACHE_DIR) the compiled code is
+also written to disk, keyed by a checksum of the template source, so a cold worker
+loads it instead of compiling. Every render is timed; stats() reports the counts and
+milliseconds per template.
+"""
+
+import logging
+import threading
+import time
+
+from jinja2 import DictLoader, Environment, FileSystemBytecodeCache
+
+logger = logging.getLogger(__name__)
+
+BYTECODE_CACHE_ENV = "RAG_TEMPLATE_CACHE_DIR"
+
+
+class TemplateRenderer:
+    """Named templates compiled once per process, with per-template render timings"""
+
+    def __init__(self, sources, bytecode_cache_dir=None):
+        bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir) if bytecode_cache_dir else None
+        self.environment = Environment(loader=DictLoader(sources), bytecode_cache=bytecode_cache,
+                                       auto_reload=False, cache_size=-1)
+        self._lock = threading.Lock()
+        self._timings = {}
+
+    def get_template(self, name):
+        """Compiled template, from the environment cache, the bytecode cache or a fresh compile"""
+        return self.environment.get_template(name)
+
+    def render(self, name, **context):
+        """Render template name with context, recording how long it took"""
+        start = time.perf_counter()
+        rendered = self.get_template(name).render(**context)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            count, total_ms, max_ms = self._timings.get(name, (0, 0.0, 0.0))
+            self._timings[name] = (count + 1, total_ms + elapsed_ms, max(max_ms, elapsed_ms))
+        logger.info(f"DEBUG: Rendered template {name} in {elapsed_ms:.2f}ms ({len(rendered)} chars)")
+        return rendered
+
+    def stats(self):
+        """{template name: {"renders", "total_ms", "max_ms"}} since startup or the last reset"""
+        with self._lock:
+            return {name: {"renders": count, "total_ms": total_ms, "max_ms": max_ms}
+                    for name, (count, total_ms, max_ms) in self._timings.items()}
+
+    def reset_stats(self):
+        with self._lock:
+            self._timings.clear()
@@ -0,0 +1,244 @@
+"""
+Offline vector retrieval over knowledge pack chunks.
+
+Chunks are embedded without any model or network call: each token contributes a
+word feature plus its character trigrams (so "emergency" and "emergencies" overlap),
+hashed into a fixed number of signed buckets, weighted by sublinear tf and bucket
+idf and L2-normalized. All chunk vectors live in one contiguous float32 matrix, so a
+query is a single matrix-vector product followed by argpartition for the top k.
+
+Raw cosine similarity against a long page is small even when the page answers the
+question, so the reported score is the geometric mean of the cosine and the query
+coverage (the cosine restricted to the query's own features). That keeps scores in
+[0, 1] on the same scale match_threshold is tuned for.
+
+An incremental update (see index_storage) embeds only added or changed chunks, weighted
+with the idf of the last full build; the periodic full rebuild refreshes the idf.
+
+Memory is num_chunks * dimensions * 4 bytes (40MB for 10k chunks at 1024 dims);
+use the ANN index for packs that do not fit comfortably.
+"""
+
+import logging
+import math
+import os
+import zlib
+
+import numpy as np
+
+from rag_utils.bm25_index import STOPWORDS, tokenize
+from rag_utils.index_storage import load_or_build
+
+logger = logging.getLogger(__name__)
+
+VECTOR_FORMAT_VERSION = 1
+DEFAULT_DIMENSIONS = 1024
+# total weight of a token's trigrams relative to its whole-word feature
+TRIGRAM_WEIGHT = 0.5
+
+
+def _token_features(token, dimensions):
+    """Hashed (buckets, signed weights) for a token's word feature and character trigrams"""
+    padded = f"<{token}>"
+    trigrams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+    features = [f"w:{token}"] + trigrams
+    hashes = np.array([zlib.crc32(feature.encode("utf-8")) for feature in features], dtype=np.uint32)
+    buckets = (hashes % dimensions).astype(np.int64)
+    # top hash bit picks the sign so colliding features tend to cancel rather than add up
+    weights = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+    weights[1:] *= TRIGRAM_WEIGHT / len(trigrams)
+    return buckets, weights
+
+
+class HashedVectorizer:
+    """Maps text to unnormalized signed-hash feature vectors; keeps a per-token feature cache"""
+
+    def __init__(self, dimensions=DEFAULT_DIMENSIONS):
+        self.dimensions = dimensions
+        self._feature_cache = {}
+
+    def _features(self, token):
+        features = self._feature_cache.get(token)
+        if features is None:
+            features = self._feature_cache[token] = _token_features(token, self.dimensions)
+        return features
+
+    def transform(self, text, out=None):
+        """Sublinear-tf feature vector of text (stopwords dropped), written into out if given"""
+        vector = out if out is not None else np.zeros(self.dimensions, dtype=np.float32)
+        counts = {}
+        for token in tokenize(text):
+            if token not in STOPWORDS:
+                counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            buckets, weights = self._features(token)
+            np.add.at(vector, buckets, weights * (1.0 + math.log(tf)))
+        return vector
+
+
+def embed_query(vectorizer, idf, search_terms):
+    """Normalized, idf-weighted query vector for the question plus topics"""
+    vector = np.zeros(vectorizer.dimensions, dtype=np.float32)
+    for search_term in search_terms:
+        vectorizer.transform(search_term, out=vector)
+    vector *= idf
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class VectorIndex:
+    """Dense hashed TF-IDF vectors for every chunk; document ids are list positions"""
+
+    def __init__(self, matrix, idf, dimensions=DEFAULT_DIMENSIONS, fingerprint=None):
+        self.matrix = matrix
+        self.idf = idf
+        self.dimensions = dimensions
+        self.fingerprint = fingerprint
+        self.vectorizer = HashedVectorizer(dimensions)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    @classmethod
+    def build(cls, texts, dimensions=DEFAULT_DIMENSIONS, fingerprint=None):
+        """Embed an iterable of chunk texts into a normalized float32 matrix"""
+        vectorizer = HashedVectorizer(dimensions)
+        matrix = np.zeros((1024, dimensions), dtype=np.float32)
+        num_docs = 0
+        for text in texts:
+            if num_docs == len(matrix):
+                grown = np.zeros((2 * len(matrix), dimensions), dtype=np.float32)
+                grown[:num_docs] = matrix
+                matrix = grown
+            vectorizer.transform(text, out=matrix[num_docs])
+            num_docs += 1
+        matrix = np.ascontiguousarray(matrix[:num_docs])
+
+        doc_freqs = np.count_nonzero(matrix, axis=0)
+        idf = (np.log((1 + num_docs) / (1 + doc_freqs)) + 1).astype(np.float32)
+        matrix *= idf
+        _normalize_rows(matrix)
+
+        logger.info(f"Built vector index: {num_docs} chunks x {dimensions} dims ({matrix.nbytes / 1e6:.1f}MB)")
+        return cls(matrix, idf, dimensions=dimensions, fingerprint=fingerprint)
+
+    def update(self, old_positions, new_texts, fingerprint=None):
+        """
+        Index for a changed pack: rows of unchanged chunks are copied, only new_texts are embedded.
+
+        old_positions holds, for every document of the new pack, its row in this index or -1
+        for the documents of new_texts (in order). The idf is kept from this index.
+        """
+        return type(self)(update_rows(self.matrix, old_positions, new_texts, self.vectorizer, self.idf),
+                          self.idf, dimensions=self.dimensions, fingerprint=fingerprint)
+
+    def embed_query(self, search_terms):
+        """Normalized query vector for the question plus topics"""
+        return embed_query(self.vectorizer, self.idf, search_terms)
+
+    def score(self, search_terms):
+        """Relevance of every chunk: sqrt(cosine * query coverage), in [0, 1]"""
+        return relevance(self.matrix, self.embed_query(search_terms))
+
+    def search(self, search_terms, k, threshold=0.0, doc_ids=None):
+        """Top-k (doc_id, score) pairs scoring at least threshold, best first, optionally among doc_ids only"""
+        return self.search_vector(self.embed_query(search_terms), k, threshold, doc_ids)
+
+    def search_vector(self, query, k, threshold=0.0, doc_ids=None):
+        """Exact top-k for an already embedded query; doc_ids (sorted) restricts the rows scored"""
+        if doc_ids is not None:
+            return top_k_scores(relevance(self.matrix[doc_ids], query), k, threshold, doc_ids=doc_ids)
+        return top_k_scores(relevance(self.matrix, query), k, threshold)
+
+    def search_batch(self, queries, k, threshold=0.0):
+        """search() for a list of queries, scoring all of them with one matrix product"""
+        if not queries:
+            return []
+        embedded = np.stack([self.embed_query(search_terms) for search_terms in queries], axis=1)
+        similarities = self.matrix @ embedded
+        return [top_k_scores(relevance(self.matrix, embedded[:, column], similarities[:, column]), k, threshold)
+                for column in range(embedded.shape[1])]
+
+    def save(self, path):
+        """Persist the matrix and idf weights as an uncompressed .npz file"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=np.array(VECTOR_FORMAT_VERSION),
+                matrix=self.matrix,
+                idf=self.idf,
+                fingerprint=np.array(self.fingerprint or ""),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save()"""
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != VECTOR_FORMAT_VERSION:
+                raise ValueError(f"Unsupported vector index version in {path}")
+            matrix = data["matrix"]
+            return cls(matrix, data["idf"], dimensions=matrix.shape[1],
+                       fingerprint=str(data["fingerprint"]) or None)
+
+
+def relevance(rows, query, similarity=None):
+    """
+    sqrt(cosine * query coverage) of each row against a normalized query, in [0, 1].
+
+    similarity is rows @ query when the caller already has it (e.g. from a batched product).
+    """
+    support = np.flatnonzero(query)
+    if not len(support):
+        return np.zeros(len(rows), dtype=np.float32)
+
+    if similarity is None:
+        similarity = rows @ query
+    # norm of each row restricted to the query's buckets; cosine / support_norm is coverage
+    projected = rows[:, support] if len(support) < rows.shape[1] else rows
+    support_norms = np.sqrt(np.einsum("ij,ij->i", projected, projected))
+    return np.where(similarity > 0, similarity / np.sqrt(np.maximum(support_norms, 1e-12)), 0.0)
+
+
+def top_k_scores(scores, k, threshold=0.0, doc_ids=None):
+    """
+    Top-k (doc_id, score) pairs from a dense score array using argpartition.
+
+    doc_ids maps score positions to document ids when scores cover a subset of the corpus.
+    """
+    k = min(int(k), len(scores))
+    if k <= 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    ids = top if doc_ids is None else doc_ids[top]
+    return [(int(doc_id), float(scores[position])) for doc_id, position in zip(ids, top)
+            if scores[position] > 0 and scores[position] >= threshold]
+
+
+def update_rows(matrix, old_positions, new_texts, vectorizer, idf):
+    """Matrix for a changed pack: rows copied from matrix by old_positions, -1 rows embedded from new_texts"""
+    old_positions = np.asarray(old_positions, dtype=np.int64)
+    reused = np.flatnonzero(old_positions >= 0)
+    new_ids = np.flatnonzero(old_positions < 0)
+    updated = np.zeros((len(old_positions), matrix.shape[1]), dtype=np.float32)
+    updated[reused] = matrix[old_positions[reused]]
+    for doc_id, text in zip(new_ids, new_texts):
+        vectorizer.transform(text, out=updated[doc_id])
+    if len(new_ids):
+        added = updated[new_ids] * idf
+        _normalize_rows(added)
+        updated[new_ids] = added
+    return updated
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+
+
+def load_or_build_vector_index(pack_file, loaded_sources, dimensions=DEFAULT_DIMENSIONS):
+    """Vector index for the chunks of pack_file, persisted next to it like the BM25 index"""
+    return load_or_build(VectorIndex, pack_file, loaded_sources, "vectors.npz", dimensions=dimensions)
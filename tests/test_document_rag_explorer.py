@@ -0,0 +1,848 @@
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from document_rag_explorer import PARTIAL_ANSWER_NOTE, RESULT_CACHE, TEMPLATES, answer_questions, calculate_simple_relevance, create_references_list, create_sources_table, force_ascii_replace, document_rag_explorer, get_retrieval_index, load_document_pack, load_document_sources, find_matching_documents, generate_rag_response, resolve_pack_file
+from rag_utils.ann_index import IVFIndex, default_probe_count, load_or_build_ann_index
+from rag_utils.bm25_index import BM25Index, load_or_build_index, query_terms, tokenize
+from rag_utils.chunk_store import ChunkStore, compile_pack, open_compiled_pack, read_store_checksum
+from rag_utils.dedup import DEDUP_ENV, NearDuplicateDetector
+from rag_utils.html_sanitizer import reference_sanitize_html
+from rag_utils.local_llm import BACKEND_ENV, LATENCY_ENV, LocalLLM
+from rag_utils.compact_html import RESPONSE_STYLE, SOURCES_STYLE, references_list, sources_table
+from rag_utils.completion_cache import CACHE_PATH_ENV, CompletionCache, get_completion_cache
+from rag_utils.context_packing import estimate_tokens, pack_context
+from rag_utils.pack_stream import iter_pack_files
+from rag_utils.pack_cache import clear_pack_cache, get_cached_pack
+from rag_utils.parallel_scoring import PARALLEL_MIN_CHUNKS_ENV, score_chunks, shutdown_pool
+from rag_utils.passages import compile_term_pattern, extract_passage
+from rag_utils.ranking import select_top_k
+from rag_utils.result_cache import ResultCache, make_result_key
+from rag_utils.stage_timing import TIMINGS_PATH_ENV, StageRecorder
+from rag_utils.table_index import TableIndex, parse_markdown_tables
+from rag_utils.template_rendering import TemplateRenderer
+from rag_utils.term_matcher import TermMatcher, reference_relevance
+from rag_utils.vector_index import VectorIndex, load_or_build_vector_index
+from jinja2 import Environment, Template
+from skill_framework import SkillInput
+
+BASE_URL = "https://example.com/kb/"
+
+
+def _find(question, loaded_sources, index=None, max_sources=5, match_threshold=0.2, max_characters=100000):
+    return find_matching_documents(
+        user_question=question,
+        topics=[],
+        loaded_sources=loaded_sources,
+        base_url=BASE_URL,
+        max_sources=max_sources,
+        match_threshold=match_threshold,
+        max_characters=max_characters,
+        index=index
+    )
+
+
+@pytest.fixture(autouse=True)
+def isolated_pack(tmp_path, monkeypatch):
+    """Every test runs on a copy of the bundled pack.json with its own completion cache,
+    so indexes, stores and cached completions never land in the working tree or a shared database"""
+    explorer = sys.modules[find_matching_documents.__module__]
+    bundle_dir = os.path.dirname(os.path.abspath(explorer.__file__))
+    pack_dir = tmp_path / "bundle"
+    pack_dir.mkdir()
+    shutil.copy(os.path.join(bundle_dir, "pack.json"), pack_dir / "pack.json")
+    find_pack_in = explorer.find_pack_in
+    monkeypatch.setattr(explorer, "find_pack_in", lambda directory: find_pack_in(
+        str(pack_dir) if os.path.abspath(directory) == bundle_dir else directory))
+    monkeypatch.setenv(CACHE_PATH_ENV, str(tmp_path / "completions.sqlite3"))
+    clear_pack_cache()
+    yield
+    clear_pack_cache()
+
+
+class TestDocumentRagExplorer:
+
+    def _run_rag(self, parameters):
+        skill_input: SkillInput = document_rag_explorer.create_input(arguments=parameters)
+        return document_rag_explorer(skill_input)
+
+    def test_document_rag_explorer_skill(self):
+        out = self._run_rag({"user_question": "What is the forecast high in Dubai?", "base_url": BASE_URL})
+        assert len(out.visualizations) == 2
+        assert "Dubai" in out.visualizations[0].layout
+
+    def test_bm25_ranks_chunks_containing_query_terms(self):
+        loaded_sources = load_document_sources()
+        index = BM25Index.build(source["text"] for source in loaded_sources)
+        doc_ids, scores = index.score(["cyclone wind speed in Mombasa"])
+
+        best = loaded_sources[doc_ids[scores.argmax()]]
+        assert "Mombasa" in best["text"]
+        assert all(0 < score < 1 for score in scores)
+        terms = {"cyclone", "wind", "speed", "mombasa"}
+        assert all(terms & set(tokenize(loaded_sources[doc_id]["text"])) for doc_id in doc_ids)
+
+    def test_bm25_ignores_stopwords_and_unknown_terms(self):
+        assert query_terms(["What is the forecast high in Dubai?"]) == ["forecast", "high", "dubai"]
+        index = BM25Index.build(["clouds are white", "the sky is blue"])
+        doc_ids, _ = index.score(["is there rain"])
+        assert len(doc_ids) == 0
+
+    def test_bm25_scores_keep_the_scan_scale_at_the_default_threshold(self):
+        loaded_sources = load_document_sources()
+        index = BM25Index.build(source["text"] for source in loaded_sources)
+        # "flights" and "predictions" appear in no chunk and must not push every score under the threshold
+        for question in ["What are the impacts on flights?", "What are the heat wave predictions for Europe?",
+                         "What advisory is given for wildfires?"]:
+            scan = _find(question, loaded_sources, match_threshold=0.3)
+            bm25 = _find(question, loaded_sources, index=index, match_threshold=0.3)
+            pages = {(doc.file_name, doc.chunk_index) for doc in bm25}
+            assert {(doc.file_name, doc.chunk_index) for doc in scan[:2]} <= pages, question
+        doc_ids, scores = index.score(["impacts on flights"])
+        assert doc_ids.tolist() == index.score(["impacts"])[0].tolist() and all(0 < score < 1 for score in scores)
+
+    def test_bm25_index_persists_and_invalidates(self, tmp_path):
+        pack_file = tmp_path / "pack.json"
+        pack_file.write_text('[{"File": "a.pdf", "Chunks": [{"Text": "heatwave in Seville", "Page": 1}, {"Text": "flooding in Berlin", "Page": 2}]}]')
+        loaded_sources = load_document_sources(str(pack_file))
+
+        index = load_or_build_index(str(pack_file), loaded_sources)
+        assert os.path.exists(f"{pack_file}.bm25.npz")
+        reloaded = load_or_build_index(str(pack_file), loaded_sources)
+        assert reloaded.vocabulary == index.vocabulary
+        assert reloaded.score(["berlin"])[0].tolist() == [1]
+
+        pack_file.write_text('[{"File": "a.pdf", "Chunks": [{"Text": "flooding in Berlin", "Page": 1}]}]')
+        loaded_sources = load_document_sources(str(pack_file))
+        rebuilt = load_or_build_index(str(pack_file), loaded_sources)
+        assert rebuilt.score(["berlin"])[0].tolist() == [0]
+
+    def test_find_matching_documents_with_index(self):
+        loaded_sources = load_document_sources()
+        index = load_or_build_index(resolve_pack_file(), loaded_sources)
+        docs = _find("wildfire risk in the Mediterranean", loaded_sources, index=index)
+
+        assert docs
+        assert docs[0].url == f"{BASE_URL.rstrip('/')}/{docs[0].file_name}#page={docs[0].chunk_index}"
+        assert [doc.match_score for doc in docs] == sorted((doc.match_score for doc in docs), reverse=True)
+        assert "Mediterranean" in docs[0].text
+
+    def test_select_top_k_is_global_and_stable(self):
+        scored = [("a", 0.1), ("b", 0.9), ("c", 0.5), ("d", 0.9), ("e", 0.7)]
+        assert select_top_k(scored, 3) == [("b", 0.9), ("d", 0.9), ("e", 0.7)]
+        assert select_top_k(iter(scored), 10) == sorted(scored, key=lambda pair: pair[1], reverse=True)
+        assert select_top_k(scored, 0) == []
+
+    def test_find_matching_documents_ranks_before_character_budget(self):
+        loaded_sources = [
+            {"file_name": "a.pdf", "text": "weak match on heat", "description": "", "chunk_index": 1, "citation": "a.pdf"},
+            {"file_name": "b.pdf", "text": "heat heat heat heat", "description": "", "chunk_index": 1, "citation": "b.pdf"},
+            {"file_name": "c.pdf", "text": "heat heat heat", "description": "", "chunk_index": 1, "citation": "c.pdf"},
+        ]
+        docs = _find("heat", loaded_sources, max_sources=2, match_threshold=0.1)
+        assert [doc.file_name for doc in docs] == ["b.pdf", "c.pdf"]
+
+        docs = _find("heat", loaded_sources, max_sources=3, match_threshold=0.1, max_characters=10)
+        assert [doc.file_name for doc in docs] == ["b.pdf"]
+
+    def test_pack_cache_reloads_only_when_file_changes(self, tmp_path):
+        clear_pack_cache()
+        pack_file = tmp_path / "pack.json"
+        pack_file.write_text('[{"File": "a.pdf", "Chunks": [{"Text": "heatwave in Seville", "Page": 1}]}]')
+        loads = []
+
+        def loader(path):
+            loads.append(path)
+            return load_document_sources(path)
+
+        pack = get_cached_pack(str(pack_file), loader)
+        assert get_cached_pack(str(pack_file), loader) is pack
+        assert pack.get_derived("bm25", lambda: "index") == "index"
+        assert pack.get_derived("bm25", lambda: "rebuilt") == "index"
+
+        stat = os.stat(pack_file)
+        os.utime(pack_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert get_cached_pack(str(pack_file), loader) is pack
+        assert len(loads) == 1
+
+        pack_file.write_text('[{"File": "b.pdf", "Chunks": [{"Text": "flooding in Berlin", "Page": 2}]}]')
+        reloaded = get_cached_pack(str(pack_file), loader)
+        assert len(loads) == 2
+        assert reloaded.sources[0]["file_name"] == "b.pdf"
+        assert reloaded.get_derived("bm25", lambda: "rebuilt") == "rebuilt"
+        clear_pack_cache()
+
+    def test_chunk_store_matches_pack_json(self, tmp_path):
+        pack_file = resolve_pack_file()
+        store_path = compile_pack(pack_file, str(tmp_path / "pack.chunkstore"))
+        store = ChunkStore.open(store_path)
+        loaded_sources = load_document_sources(pack_file)
+
+        assert len(store) == len(loaded_sources)
+        assert list(store) == loaded_sources
+        assert store.metadata(1) == (loaded_sources[1]["file_name"], loaded_sources[1]["chunk_index"])
+        assert read_store_checksum(store_path) == store.checksum
+
+        store_index = load_or_build_index(store_path, store)
+        json_docs = _find("flooding in Berlin", loaded_sources, index=BM25Index.build(s["text"] for s in loaded_sources))
+        store_docs = _find("flooding in Berlin", store, index=store_index)
+        assert [vars(doc) for doc in store_docs] == [vars(doc) for doc in json_docs]
+
+    def test_streaming_parser_matches_json_load(self, tmp_path):
+        import json
+        pack_file = resolve_pack_file()
+        with open(pack_file, encoding="utf-8") as f:
+            expected = json.load(f)
+        # tiny blocks force values to straddle buffer boundaries
+        assert list(iter_pack_files(pack_file, block_size=7)) == expected
+
+        numbers_file = tmp_path / "pack.json"
+        numbers_file.write_text(' [ {"File": "a.pdf", "Chunks": []} , 12345 ,{"File":"b"}]  ')
+        assert list(iter_pack_files(str(numbers_file), block_size=3)) == [{"File": "a.pdf", "Chunks": []}, 12345, {"File": "b"}]
+
+        pack_copy = tmp_path / "large_pack.json"
+        pack_copy.write_text(json.dumps(expected * 3))
+        store = open_compiled_pack(str(pack_copy))
+        assert os.path.exists(f"{pack_copy}.chunkstore")
+        assert list(store) == load_document_sources(str(pack_copy))
+
+        for broken in ('{"File": "a.pdf"}', '[{"File": "a.pdf"}', '[{"File": "a.pdf"},,{}]'):
+            numbers_file.write_text(broken)
+            try:
+                list(iter_pack_files(str(numbers_file), block_size=4))
+                assert False, f"Expected failure for {broken}"
+            except ValueError:
+                pass
+
+    def test_vector_index_ranks_and_persists(self, tmp_path):
+        loaded_sources = load_document_sources()
+        index = VectorIndex.build(source["text"] for source in loaded_sources)
+        assert index.matrix.dtype.name == "float32" and index.matrix.flags["C_CONTIGUOUS"]
+
+        results = index.search(["cyclone wind speed in Mombasa"], 3)
+        assert "Mombasa" in loaded_sources[results[0][0]]["text"]
+        assert all(0 < score <= 1 for _, score in results)
+        # trigram features let morphological variants match
+        assert "Emergency" in loaded_sources[index.search(["emergencies"], 1)[0][0]]["text"]
+        assert index.search(["clouds"], 3, threshold=0.2) == []
+
+        index.save(str(tmp_path / "vectors.npz"))
+        reloaded = VectorIndex.load(str(tmp_path / "vectors.npz"))
+        assert reloaded.search(["flooding in Berlin"], 3) == index.search(["flooding in Berlin"], 3)
+
+    def test_document_rag_explorer_vector_retrieval(self):
+        out = self._run_rag({"user_question": "cyclone wind speed in Mombasa", "base_url": BASE_URL, "retrieval_method": "vector"})
+        assert "Mombasa" in out.visualizations[0].layout
+
+    def test_ann_index_matches_exact_search_when_probing_all_lists(self, tmp_path, monkeypatch):
+        loaded_sources = load_document_sources()
+        exact = VectorIndex.build(source["text"] for source in loaded_sources)
+        ann = IVFIndex.from_vector_index(exact, n_lists=4, n_probe=4)
+        assert ann.list_offsets[-1] == len(loaded_sources)
+        assert sorted(ann.list_doc_ids.tolist()) == list(range(len(loaded_sources)))
+
+        for question in ("cyclone wind speed in Mombasa", "wildfire risk in the Mediterranean"):
+            approx = ann.search([question], 5)
+            assert [doc_id for doc_id, _ in approx] == [doc_id for doc_id, _ in exact.search([question], 5)]
+            assert len(ann.search([question], 5, n_probe=1)) <= 5
+
+        ann.save(str(tmp_path / "ivf.npz"))
+        reloaded = IVFIndex.load(str(tmp_path / "ivf.npz"))
+        assert reloaded.n_lists == 4
+        assert reloaded.search(["flooding in Berlin"], 3) == ann.search(["flooding in Berlin"], 3)
+        # vectors stay on disk as float16 and are paged in on demand
+        assert isinstance(reloaded.list_vectors, np.memmap) and reloaded.list_vectors.dtype == np.float16
+        # the default probes a fixed share of the lists, so large packs are not left with a sliver of the index
+        assert [default_probe_count(n_lists) for n_lists in (4, 894, 4000)] == [4, 112, 500]
+
+        # a save cut short before the .npz is replaced leaves the previous index and its vectors intact
+        def disk_full(*args, **kwargs):
+            raise OSError("disk full")
+        with monkeypatch.context() as patch:
+            patch.setattr(np, "savez", disk_full)
+            with pytest.raises(OSError):
+                IVFIndex.from_vector_index(exact, n_lists=2).save(str(tmp_path / "ivf.npz"))
+        reloaded = IVFIndex.load(str(tmp_path / "ivf.npz"))
+        assert reloaded.n_lists == 4
+        assert reloaded.search(["flooding in Berlin"], 3) == ann.search(["flooding in Berlin"], 3)
+        # a complete save removes the vector files it no longer names
+        ann.save(str(tmp_path / "ivf.npz"))
+        [vectors_file] = tmp_path.glob("ivf.npz.*.vectors.npy")
+        np.save(str(vectors_file), np.zeros((2, ann.dimensions), dtype=np.float16))
+        with pytest.raises(ValueError):
+            IVFIndex.load(str(tmp_path / "ivf.npz"))
+
+    def test_document_rag_explorer_ann_retrieval(self):
+        out = self._run_rag({"user_question": "cyclone wind speed in Mombasa", "base_url": BASE_URL, "retrieval_method": "ann"})
+        assert "Mombasa" in out.visualizations[0].layout
+
+    def test_result_cache_lru_ttl_and_counters(self):
+        now = [0.0]
+        cache = ResultCache(max_bytes=10, ttl_seconds=60, clock=lambda: now[0])
+        assert make_result_key("  What is the forecast in Dubai? ", "abc", max_sources=5) == \
+            make_result_key("what is the forecast   in DUBAI", "abc", max_sources=5)
+        assert make_result_key("forecast", "abc", max_sources=5) != make_result_key("forecast", "def", max_sources=5)
+        assert make_result_key("forecast", "abc", max_sources=5) != make_result_key("forecast", "abc", max_sources=6)
+
+        cache.put("a", "aaaa")
+        cache.put("b", "bbbb")
+        assert cache.get("a") == "aaaa"
+        cache.put("c", "cccc")  # over budget: "b" is least recently used
+        assert cache.get("b") is None and cache.get("c") == "cccc"
+        now[0] = 61.0
+        assert cache.get("a") is None
+        assert cache.stats() == {"entries": 1, "bytes": 4, "hits": 2, "misses": 2, "hit_rate": 0.5,
+                                 "evictions": 1, "expirations": 1}
+
+    def test_document_rag_explorer_serves_repeated_questions_from_cache(self, monkeypatch):
+        monkeypatch.setenv(BACKEND_ENV, "local")
+        RESULT_CACHE.clear()
+        first = self._run_rag({"user_question": "Heatwave risk in Seville?", "base_url": BASE_URL})
+        hits = RESULT_CACHE.hits
+        again = self._run_rag({"user_question": "heatwave risk in  seville", "base_url": BASE_URL})
+        assert RESULT_CACHE.hits == hits + 1
+        assert [viz.layout for viz in again.visualizations] == [viz.layout for viz in first.visualizations]
+
+        self._run_rag({"user_question": "Heatwave risk in Seville?", "base_url": BASE_URL, "max_sources": 2})
+        assert RESULT_CACHE.hits == hits + 1
+
+        # llm_cache=disabled neither reads nor writes the result cache
+        entries = len(RESULT_CACHE)
+        self._run_rag({"user_question": "Heatwave risk in Seville?", "base_url": BASE_URL, "llm_cache": "disabled"})
+        self._run_rag({"user_question": "Flooding in Berlin?", "base_url": BASE_URL, "llm_cache": "disabled"})
+        assert RESULT_CACHE.hits == hits + 1 and len(RESULT_CACHE) == entries
+
+    def test_failed_llm_fallback_is_not_cached(self, tmp_path, monkeypatch):
+        calls = []
+
+        class FlakyLLM(LocalLLM):
+            def get_llm_response(self, prompt):
+                calls.append(prompt)
+                if len(calls) == 1:
+                    raise ConnectionError("LLM service unavailable")
+                return super().get_llm_response(prompt)
+
+        monkeypatch.setattr("document_rag_explorer.get_llm_client", FlakyLLM)
+        RESULT_CACHE.clear()
+        arguments = {"user_question": "What is the wind speed in Mombasa?", "base_url": BASE_URL}
+        failed = self._run_rag(arguments)
+        assert failed.visualizations[0].title == "Analysis: What is the wind speed in Mombasa?"
+        assert len(RESULT_CACHE) == 0
+        answered = self._run_rag(arguments)
+        assert len(calls) == 2
+        assert answered.visualizations[0].title == "What is the wind speed in Mombasa?"
+        assert len(RESULT_CACHE) == 1
+        RESULT_CACHE.clear()
+
+    def test_completion_cache_ttl_and_size_limit(self, tmp_path):
+        now = [1000.0]
+        path = str(tmp_path / "completions.sqlite3")
+        cache = CompletionCache(path, max_bytes=10, ttl_seconds=60, clock=lambda: now[0])
+        cache.put("prompt a", "aaaa")
+        now[0] += 1
+        cache.put("prompt b", "bbbb")
+        now[0] += 1
+        assert cache.get("prompt a") == "aaaa"
+        now[0] += 1
+        cache.put("prompt c", "cccc")  # over budget: "prompt b" is least recently used
+        assert cache.get("prompt b") is None
+        assert len(cache) == 2
+
+        # shared through the file with other processes / instances
+        assert CompletionCache(path, clock=lambda: now[0]).get("prompt c") == "cccc"
+        now[0] += 61
+        assert cache.get("prompt c") is None
+
+    def test_generate_rag_response_uses_completion_cache(self, tmp_path, monkeypatch):
+        docs = _find("flooding in Berlin", load_document_sources())
+        prompt = generate_rag_response("flooding in Berlin", docs)["raw_prompt"]
+
+        get_completion_cache().put(prompt, "<title>Berlin floods</title><content><p>cached</p></content>", "platform")
+        cached = generate_rag_response("flooding in Berlin", docs)
+        assert cached["title"] == "Berlin floods" and cached["content"] == "<p>cached</p>"
+        # another backend's completions are never served for the same prompt
+        monkeypatch.setenv(BACKEND_ENV, "local")
+        assert generate_rag_response("flooding in Berlin", docs)["title"] != "Berlin floods"
+        monkeypatch.delenv(BACKEND_ENV)
+        assert generate_rag_response("flooding in Berlin", docs, use_llm_cache=False)["title"] != "Berlin floods"
+
+    def test_completion_cache_fills_from_an_empty_database(self, tmp_path, monkeypatch):
+        calls = []
+
+        class CountingLLM(LocalLLM):
+            def get_llm_response(self, prompt):
+                calls.append(prompt)
+                return super().get_llm_response(prompt)
+
+        monkeypatch.setattr("document_rag_explorer.get_llm_client", CountingLLM)
+        docs = _find("flooding in Berlin", load_document_sources())
+        responses = [generate_rag_response("flooding in Berlin", docs) for _ in range(3)]
+        assert len(calls) == 1 and len(get_completion_cache()) == 1
+        assert responses[1]["content"] == responses[2]["content"] == responses[0]["content"]
+
+    def test_sharded_scoring_matches_serial_scan(self, tmp_path, monkeypatch):
+        loaded_sources = load_document_sources()
+        store = ChunkStore.open(compile_pack(resolve_pack_file(), str(tmp_path / "pack.chunkstore")))
+        search_terms = ["weather warning for coastal areas"]
+
+        serial = score_chunks(calculate_simple_relevance, loaded_sources, search_terms, 0.1, 5)
+        assert serial
+        assert score_chunks(calculate_simple_relevance, store, search_terms, 0.1, 5, min_chunks=0, workers=3) == serial
+        shutdown_pool()
+
+        # source lists, and stores while RAG_PARALLEL_MIN_CHUNKS is unset, never reach the pool
+        def no_pool():
+            raise AssertionError("scan was sharded")
+
+        monkeypatch.setattr("rag_utils.parallel_scoring._get_pool", no_pool)
+        monkeypatch.delenv(PARALLEL_MIN_CHUNKS_ENV, raising=False)
+        assert score_chunks(calculate_simple_relevance, loaded_sources, search_terms, 0.1, 5, min_chunks=0, workers=3) == serial
+        assert score_chunks(calculate_simple_relevance, store, search_terms, 0.1, 5, workers=3) == serial
+
+    def test_document_rag_explorer_scan_retrieval(self):
+        out = self._run_rag({"user_question": "cyclone wind speed in Mombasa", "base_url": BASE_URL, "retrieval_method": "scan"})
+        assert "Mombasa" in out.visualizations[0].layout
+
+    def test_pack_context_maximizes_relevance_within_token_budget(self):
+        def source(name, words):
+            return {"file_name": name, "text": " ".join(f"{name}{i}" for i in range(words))}
+
+        huge, small_a, small_b = source("huge", 200), source("a", 40), source("b", 40)
+        budget = estimate_tokens(small_a["text"]) + estimate_tokens(small_b["text"])
+        packed = pack_context([(huge, 0.9), (small_a, 0.8), (small_b, 0.7)], budget, 5)
+        assert [s["file_name"] for s, _ in packed] == ["a", "b"]
+
+        # budget not binding: the best max_items by score, in score order
+        packed = pack_context([(huge, 0.9), (small_a, 0.8), (small_b, 0.7)], 10000, 2)
+        assert [s["file_name"] for s, _ in packed] == ["huge", "a"]
+
+        # the best match is kept even if it alone is over budget
+        assert [s["file_name"] for s, _ in pack_context([(huge, 0.9)], 10, 5)] == ["huge"]
+
+    def test_max_characters_sets_the_context_budget_by_default(self, monkeypatch):
+        monkeypatch.setenv(BACKEND_ENV, "local")
+        arguments = {"user_question": "Which cities have heat warnings and high temperatures?", "base_url": BASE_URL,
+                     "match_threshold": 0.05, "llm_cache": "disabled"}
+
+        def cited_pages(**overrides):
+            return self._run_rag({**arguments, **overrides}).visualizations[1].layout.count("#page=")
+
+        wide = cited_pages(max_characters=3000)
+        assert cited_pages(max_characters=600) < wide
+        # an explicit token budget still takes precedence: 3000 characters are 750 tokens
+        assert cited_pages(max_characters=600, max_context_tokens=750) == wide
+
+    def test_pack_context_drops_duplicate_text(self):
+        text = "heavy rain is expected across the northern districts with flooding likely near rivers"
+        candidates = [
+            ({"file_name": "a.pdf", "text": text}, 0.9),
+            ({"file_name": "b.pdf", "text": text + " tonight"}, 0.8),
+            ({"file_name": "c.pdf", "text": "strong winds along the coast"}, 0.5),
+        ]
+        assert [s["file_name"] for s, _ in pack_context(candidates, 10000, 5)] == ["a.pdf", "c.pdf"]
+
+    def test_extract_passage_keeps_windows_around_hits(self):
+        text = "START OF PAGE: 3 " + "filler " * 100 + "Heavy flooding hit Berlin overnight." + " filler" * 100 + " END OF PAGE: 3"
+        passage = extract_passage(text, compile_term_pattern(["floods in Berlin"]), context_chars=20)
+        assert "flooding hit Berlin" in passage
+        assert "PAGE" not in passage
+        assert passage.startswith("...") and passage.endswith("...")
+        assert len(passage) < 100
+        # no hits: the opening of the chunk
+        assert extract_passage(text, compile_term_pattern(["snow"]), context_chars=20).startswith("filler")
+
+    def test_find_matching_documents_sends_only_passages_to_prompt(self):
+        loaded_sources = load_document_sources()
+        index = load_or_build_index(resolve_pack_file(), loaded_sources)
+        whole = _find("cyclone wind speed in Mombasa", loaded_sources, index=index, max_sources=3)
+        cut = find_matching_documents("cyclone wind speed in Mombasa", [], loaded_sources, BASE_URL, 3, 0.2, 100000,
+                                      index=index, passage_context=150)
+        assert cut[0].url == whole[0].url and cut[0].text == whole[0].text
+        assert "Mombasa" in cut[0].passage and len(cut[0].passage) < len(cut[0].text)
+
+        prompt = generate_rag_response("cyclone wind speed in Mombasa", cut)["raw_prompt"]
+        assert cut[0].passage in prompt and cut[0].text not in prompt
+        assert len(generate_rag_response("cyclone wind speed in Mombasa", cut)["references"]) == len(cut)
+
+    def test_near_duplicate_pages_are_folded_on_load_and_compile(self, tmp_path):
+        table = " ".join(f"City{i} high {30 + i}C low {20 + i}C humidity {40 + i}%" for i in range(40))
+        pages = [
+            {"File": "report_v1.pdf", "Chunks": [{"Text": f"START OF PAGE: 2 {table}", "Page": 2},
+                                                 {"Text": "Cyclone warning for Mombasa with gusts near 120 km/h", "Page": 3}]},
+            {"File": "report_v2.pdf", "Chunks": [{"Text": f"START OF PAGE: 5 {table} compiled by the regional office", "Page": 5}]},
+        ]
+        pack_file = tmp_path / "pack.json"
+        pack_file.write_text(json.dumps(pages))
+
+        loaded_sources = load_document_sources(str(pack_file))
+        assert [source["file_name"] for source in loaded_sources] == ["report_v1.pdf", "report_v1.pdf"]
+        assert loaded_sources[0]["duplicates"] == [{"file_name": "report_v2.pdf", "chunk_index": 5, "citation": "report_v2.pdf"}]
+        assert loaded_sources[1]["duplicates"] == []
+
+        store = ChunkStore.open(compile_pack(str(pack_file), str(tmp_path / "pack.chunkstore")))
+        assert list(store) == loaded_sources
+        assert len(ChunkStore.open(compile_pack(str(pack_file), str(tmp_path / "all.chunkstore"), dedupe=False))) == 3
+
+        detector = NearDuplicateDetector()
+        assert detector.add("heavy rain expected across northern districts tonight") is None
+        assert detector.add("strong winds along the coast through the weekend") is None
+        assert detector.add("heavy rain expected across northern districts tonight") == 0
+
+    def test_pages_with_different_numbers_are_kept_and_dedup_can_be_switched_off(self, tmp_path, monkeypatch):
+        table = " ".join(f"City{i} high {30 + i}C low {20 + i}C" for i in range(40))
+        revised = table.replace("City7 high 37C", "City7 high 44C")
+        pages = [
+            {"File": "forecast_v1.pdf", "Chunks": [{"Text": f"START OF PAGE: 1 {table}", "Page": 1}]},
+            {"File": "forecast_v2.pdf", "Chunks": [{"Text": f"START OF PAGE: 1 {revised}", "Page": 1}]},
+            {"File": "forecast_copy.pdf", "Chunks": [{"Text": f"START OF PAGE: 1 {table}", "Page": 1}]},
+        ]
+        pack_file = tmp_path / "pack.json"
+        pack_file.write_text(json.dumps(pages))
+
+        loaded_sources = load_document_sources(str(pack_file))
+        assert [source["file_name"] for source in loaded_sources] == ["forecast_v1.pdf", "forecast_v2.pdf"]
+        assert loaded_sources[0]["duplicates"] == [{"file_name": "forecast_copy.pdf", "chunk_index": 1, "citation": "forecast_copy.pdf"}]
+        matches = _find("City7 high 44C", loaded_sources)
+        assert "forecast_v2.pdf" in [doc.file_name for doc in matches]
+
+        monkeypatch.setenv(DEDUP_ENV, "off")
+        clear_pack_cache()
+        all_sources = load_document_sources(str(pack_file))
+        assert [source["file_name"] for source in all_sources] == ["forecast_v1.pdf", "forecast_v2.pdf", "forecast_copy.pdf"]
+        assert all(source["duplicates"] == [] for source in all_sources)
+        assert len(open_compiled_pack(str(pack_file))) == 3
+        clear_pack_cache()
+
+    def test_indexes_update_incrementally_when_files_change(self, tmp_path, monkeypatch):
+        cities = ["Berlin", "Seville", "Mombasa", "Dubai", "Lagos", "Oslo", "Lima", "Perth", "Osaka", "Quito"]
+        files = [{"File": f"{city}.pdf", "Chunks": [{"Text": f"{city} forecast: rain and wind {i}", "Page": 1},
+                                                   {"Text": f"{city} advisory: heat warning level {i}", "Page": 2}]}
+                 for i, city in enumerate(cities)]
+        pack_file = tmp_path / "pack.json"
+        pack_file.write_text(json.dumps(files))
+        loaders = (load_or_build_index, load_or_build_vector_index, load_or_build_ann_index)
+        for loader in loaders:
+            loader(str(pack_file), load_document_sources(str(pack_file)))
+
+        # Oslo changed, Berlin removed, Nairobi added: 4 of 20 chunks to index
+        files[5]["Chunks"][0]["Text"] = "Oslo forecast: heavy snow"
+        files = files[1:] + [{"File": "Nairobi.pdf", "Chunks": [{"Text": "Nairobi forecast: thunderstorms", "Page": 1},
+                                                                {"Text": "Nairobi advisory: flash floods", "Page": 2}]}]
+        pack_file.write_text(json.dumps(files))
+        loaded_sources = load_document_sources(str(pack_file))
+
+        def no_full_build(*args, **kwargs):
+            raise AssertionError("expected an incremental update")
+        with monkeypatch.context() as patch:
+            for index_cls in (BM25Index, VectorIndex, IVFIndex):
+                patch.setattr(index_cls, "build", no_full_build)
+            bm25, vectors, ann = (loader(str(pack_file), loaded_sources) for loader in loaders)
+
+        rebuilt = BM25Index.build(source["text"] for source in loaded_sources)
+        for question in ("snow in Oslo", "thunderstorms", "heat warning", "Berlin"):
+            assert sorted(bm25.search([question], 5)) == sorted(rebuilt.search([question], 5))
+        assert loaded_sources[vectors.search(["thunderstorms"], 1)[0][0]]["file_name"] == "Nairobi.pdf"
+        assert loaded_sources[ann.search(["heavy snow"], 1)[0][0]]["text"] == "Oslo forecast: heavy snow"
+        assert len(vectors) == len(ann) == len(loaded_sources)
+        # reused and new chunks alike hold the vector index's rows, stored as float16
+        assert np.array_equal(ann.list_vectors[np.argsort(ann.list_doc_ids)], vectors.matrix.astype(np.float16))
+
+        # the persisted, updated copy is current for the next invocation
+        assert load_or_build_index(str(pack_file), loaded_sources).fingerprint == bm25.fingerprint
+
+    def test_federated_search_merges_results_across_packs(self, tmp_path, monkeypatch):
+        workspace = tmp_path / "tenant" / "skill_workspaces" / "copilot" / "skill"
+        for name, text in (("regional", "Lagos flood advisory: river levels rising after heavy rain"),
+                           ("coastal", "Mombasa cyclone warning: flood risk along the coast")):
+            (workspace / name).mkdir(parents=True)
+            (workspace / name / "pack.json").write_text(json.dumps([{"File": f"{name}.pdf", "Chunks": [{"Text": text, "Page": 1}]}]))
+        for name, value in (("AR_DATA_BASE_PATH", str(tmp_path)), ("AR_TENANT_ID", "tenant"),
+                            ("AR_COPILOT_ID", "copilot"), ("AR_COPILOT_SKILL_ID", "skill")):
+            monkeypatch.setenv(name, value)
+
+        pack = load_document_pack("all_packs")
+        assert len(pack.packs) == 3  # the bundled pack.json plus both workspace packs
+        assert len(pack.sources) == sum(len(member.sources) for member in pack.packs)
+        for method in ("bm25", "vector"):
+            results = get_retrieval_index(pack, method).search(["flood warning"], 5)
+            files = {pack.sources[doc_id]["file_name"] for doc_id, _ in results}
+            assert {"regional.pdf", "coastal.pdf"} <= files
+            assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+
+        docs = _find("Lagos flood", pack.sources, index=get_retrieval_index(pack, "bm25"))
+        assert "regional.pdf" in [doc.file_name for doc in docs]
+
+        out = self._run_rag({"user_question": "cyclone warning in Mombasa", "base_url": BASE_URL, "search_scope": "all_packs",
+                              "table_lookup": "disabled"})
+        assert "coastal.pdf" in out.visualizations[1].layout
+
+    def test_two_level_retrieval_scores_only_chunks_of_top_files(self, tmp_path):
+        files = [
+            {"File": "coast.pdf", "Summary": "Coastal cyclone and storm surge outlook", "Description": "",
+             "Chunks": [{"Text": "Cyclone bands bring rain and wind to Mombasa", "Page": 1}]},
+            {"File": "inland.pdf", "Summary": "Inland heat and drought outlook", "Description": "Sahel region",
+             "Chunks": [{"Text": "Rain unlikely, wind from the north", "Page": 1}, {"Text": "Drought deepens", "Page": 2}]},
+            {"File": "notes.pdf", "Chunks": [{"Text": "Field notes: rain gauge readings and wind logs", "Page": 1}]},
+        ]
+        pack_file = tmp_path / "pack.json"
+        pack_file.write_text(json.dumps(files))
+        pack = get_cached_pack(str(pack_file), load_document_sources)
+
+        for method in ("bm25", "vector", "ann", "scan"):
+            if method != "scan":
+                full = get_retrieval_index(pack, method).search(["cyclone rain wind"], 5)
+                assert "inland.pdf" in {pack.sources[doc_id]["file_name"] for doc_id, _ in full}
+            # the cyclone outlook wins the file stage; unsummarized notes.pdf is always searched
+            results = get_retrieval_index(pack, method, top_files=1).search(["cyclone rain wind"], 5)
+            assert {pack.sources[doc_id]["file_name"] for doc_id, _ in results} == {"coast.pdf", "notes.pdf"}
+
+        bm25 = get_retrieval_index(pack, "bm25")
+        assert dict(bm25.search(["rain wind"], 5, doc_ids=[0, 3])) == {doc_id: score for doc_id, score in bm25.search(["rain wind"], 5) if doc_id in (0, 3)}
+        # no file profile matches: nothing is pruned
+        assert get_retrieval_index(pack, "bm25", top_files=1).search(["gauge readings"], 5) == bm25.search(["gauge readings"], 5)
+
+    def test_table_index_answers_direct_lookups_with_compact_facts(self, tmp_path):
+        text = """# City Highs
+
+| City           | High (°C) | Advisory        |
+|----------------|-----------|-----------------|
+| Dubai, UAE     | 49        | Extreme heat    |
+| Seville, Spain | 45        | Wildfire risk   |
+| Cairo, Egypt   |           | Dust storms     |
+
+Dubai will see record heat all week."""
+        assert list(parse_markdown_tables(text)) == [("City Highs", ["City", "High (°C)", "Advisory"], [
+            ["Dubai, UAE", "49", "Extreme heat"], ["Seville, Spain", "45", "Wildfire risk"], ["Cairo, Egypt", "", "Dust storms"]])]
+
+        index = TableIndex.build(["Dubai travel notes without tables", text])
+        assert len(index.values) == 5
+        assert index.lookup(["What is the forecast high in Dubai?"]) == [(1, 2 / 3, "City Highs:\nDubai, UAE | High (°C): 49")]
+        assert index.lookup(["Tell me about Dubai"]) == []  # an entity alone is not a lookup
+        index.save(str(tmp_path / "tables.npz"))
+        assert TableIndex.load(str(tmp_path / "tables.npz")).lookup(["Seville advisory"])[0][2] == "City Highs:\nSeville, Spain | Advisory: Wildfire risk"
+
+        loaded_sources = load_document_sources()
+        docs = find_matching_documents("What is the forecast high in Dubai?", [], loaded_sources, BASE_URL, 5, 0.2, 3000,
+                                       index=BM25Index.build(source["text"] for source in loaded_sources),
+                                       table_index=TableIndex.build(source["text"] for source in loaded_sources))
+        assert docs and all("Dubai, UAE |" in doc.passage for doc in docs)
+        assert sum(len(doc.passage) for doc in docs) < 200
+
+    def test_term_matcher_scores_match_per_pattern_scan(self):
+        rng = random.Random(3)
+        alphabet = ["fore", "cast", "forecast", "casting", "aaaa", "aa", " ", "high", "Dubai", "ubai", "x"]
+        texts = ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40))) for _ in range(300)]
+        queries = [["forecast high", "cast"], ["aaaa aaaaaa", "castingcast"], ["Forecasting", "", "ubai dubai"],
+                   ["What is the forecast high in Dubai?"], ["a", "aa aaaa", "fore cast forecast"]]
+        for query in queries:
+            matcher = TermMatcher(query)
+            for text in texts:
+                assert matcher.score(text) == reference_relevance(text, query)
+
+        for source in load_document_sources():
+            assert calculate_simple_relevance(source["text"], ["wind speed in Mombasa"]) == reference_relevance(source["text"], ["wind speed in Mombasa"])
+
+    def test_answer_questions_ranks_in_one_batch_and_bounds_llm_calls(self, monkeypatch):
+        questions = ["cyclone wind speed in Mombasa", "flooding in Berlin", "heatwave in Seville", "zzzz qqqq"]
+        loaded_sources = load_document_sources()
+        bm25 = BM25Index.build(source["text"] for source in loaded_sources)
+        vectors = VectorIndex.build(source["text"] for source in loaded_sources)
+        queries = [[question] for question in questions]
+        assert bm25.search_batch(queries, 5) == [bm25.search(query, 5) for query in queries]
+        for batched, query in zip(vectors.search_batch(queries, 5), queries):
+            assert [doc_id for doc_id, _ in batched] == [doc_id for doc_id, _ in vectors.search(query, 5)]
+
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        class FakeArUtils:
+            def get_llm_response(self, prompt):
+                with lock:
+                    active.append(prompt)
+                    peak.append(len(active))
+                time.sleep(0.05)
+                with lock:
+                    active.remove(prompt)
+                return "<title>Answer</title><content>From the sources.</content>"
+
+        monkeypatch.setitem(sys.modules, "ar_analytics", SimpleNamespace(ArUtils=FakeArUtils))
+        results = answer_questions(questions[:3] * 2 + questions[3:], base_url=BASE_URL, table_lookup=False, passage_context=0,
+                                   use_llm_cache=False, max_concurrent_llm_calls=2)
+
+        assert [result["question"] for result in results] == questions[:3] * 2 + questions[3:]
+        assert max(peak) == 2 and len(peak) == 6
+        for result, question in zip(results, questions[:3] * 2):
+            expected = _find(question, loaded_sources, index=bm25, max_characters=3000)
+            assert result["error"] is None and result["title"] == "Answer"
+            assert [source["url"] for source in result["sources"]] == [doc.url for doc in expected]
+        assert results[-1]["error"] == "No relevant documents found" and results[-1]["sources"] == []
+
+    def test_map_reduce_generation_runs_groups_concurrently_and_keeps_citations(self, monkeypatch):
+        cities = ["Berlin", "Seville", "Mombasa", "Dubai", "Lagos", "Oslo", "Lima", "Perth"]
+        docs = [SimpleNamespace(file_name=f"{city}.pdf", chunk_index=1, description=city, url=f"{BASE_URL}{city}.pdf#page=1",
+                                text=f"Background for {city}. The {city} flood gauge reads {i} metres. Unrelated notes.")
+                for i, city in enumerate(cities)]
+        monkeypatch.setenv(BACKEND_ENV, "local")
+        monkeypatch.setenv(LATENCY_ENV, "0.2")
+
+        start = time.perf_counter()
+        response = generate_rag_response("flood gauge in Lima", docs, use_llm_cache=False, generation_mode="map_reduce")
+        elapsed = time.perf_counter() - start
+        # three extraction calls in parallel, then the synthesis: two round trips instead of four
+        assert elapsed < 0.6
+        assert "<sup>[7]</sup>" in response["content"] and "reads 6 metres" in response["content"]
+        assert "### Facts" in response["raw_prompt"] and "- The Lima flood gauge reads 6 metres. [7]" in response["raw_prompt"]
+        assert [ref["number"] for ref in response["references"]] == list(range(1, 9))
+
+        single = generate_rag_response("flood gauge in Lima", docs, use_llm_cache=False)
+        assert "<sup>[7]</sup>" in single["content"] and "### Facts" not in single["raw_prompt"]
+        assert LocalLLM().get_llm_response("Question: snow\n### Sources\n====== Source 1 ====\nContent: Sunny.") == "NONE"
+
+    def test_templates_compile_once_and_load_from_bytecode_cache(self, tmp_path, monkeypatch):
+        import document_rag_explorer as module
+
+        references = [{"number": 1, "url": "u", "src": "a.pdf", "page": 2, "text": "t", "preview": "p", "thumbnail": "", "duplicates": []}]
+        assert TEMPLATES.render("sources", references=references) == Template(module.sources_template).render(references=references)
+        assert TEMPLATES.get_template("narrative_prompt") is TEMPLATES.get_template("narrative_prompt")
+
+        sources = {"answer": "<h1>{{ title }}</h1>{% for n in numbers %}<sup>[{{ n }}]</sup>{% endfor %}"}
+        TemplateRenderer(sources, bytecode_cache_dir=str(tmp_path)).render("answer", title="x", numbers=[1])
+        assert os.listdir(tmp_path)
+
+        def no_compile(*args, **kwargs):
+            raise AssertionError("expected the bytecode cache to be used")
+        monkeypatch.setattr(Environment, "compile", no_compile)
+        cold = TemplateRenderer(sources, bytecode_cache_dir=str(tmp_path))
+        assert cold.render("answer", title="Dubai", numbers=[1, 2]) == "<h1>Dubai</h1><sup>[1]</sup><sup>[2]</sup>"
+        cold.render("answer", title="Seville", numbers=[])
+        assert cold.stats()["answer"]["renders"] == 2 and cold.stats()["answer"]["max_ms"] > 0
+
+    def test_html_sanitizer_matches_multi_pass_cleanup(self):
+        rng = random.Random(11)
+        pieces = ["&", "amp;", "lt;", "#39;", "#x1F;", "#x;", "&#", ";", '"', "'", "\x00", "\x01", "\x1f", "\x7f",
+                  "\n", "\t", "\r", "\u2013", "\u2014", "\u2026", "\u201c", "\u2019", "<p>", "caf\u00e9", " ", "a"]
+        for _ in range(5000):
+            text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 16)))
+            assert force_ascii_replace(text) == reference_sanitize_html(text)
+        assert force_ascii_replace("&\x00amp; &\x01amp; \u2013 'x'") == "&amp; &amp;amp; &ndash; &#39;x&#39;"
+
+    def test_compact_html_mode_shrinks_both_tabs(self, monkeypatch):
+        monkeypatch.setenv(BACKEND_ENV, "local")
+        arguments = {"user_question": "Which cities have heat warnings and high temperatures?", "base_url": BASE_URL,
+                     "max_sources": 5, "match_threshold": 0.05, "max_characters": 4000, "llm_cache": "disabled"}
+        standard = self._run_rag(arguments)
+        compact = self._run_rag({**arguments, "html_mode": "compact"})
+        standard_bytes = [len(viz.layout.encode("utf-8")) for viz in standard.visualizations]
+        compact_bytes = [len(viz.layout.encode("utf-8")) for viz in compact.visualizations]
+        assert sum(compact_bytes) < 0.7 * sum(standard_bytes), (standard_bytes, compact_bytes)
+        assert compact.visualizations[0].title == standard.visualizations[0].title
+        assert compact.visualizations[0].layout.count("<style>") == compact.visualizations[1].layout.count("<style>") == 1
+        assert "style=" not in compact.visualizations[1].layout
+        for page in ("page=1", "page=3", "page=6"):
+            assert page in compact.visualizations[0].layout and page in compact.visualizations[1].layout
+
+        # per reference the markup is under a third of the inline-styled rows, so the style blocks pay off quickly
+        references = [{"number": i + 1, "url": f"{BASE_URL}report{i}.pdf#page={i}", "src": f"report{i}.pdf", "page": i,
+                       "text": f"Document: report{i}.pdf", "match_score": 0.5,
+                       "duplicates": [{"file_name": "copy.pdf", "chunk_index": i}] if i % 3 == 0 else []}
+                      for i in range(10)]
+        standard_rows = len(create_references_list(references)) + len(create_sources_table(references))
+        compact_rows = len(references_list(references)) + len(sources_table(references))
+        assert compact_rows < standard_rows / 3
+        assert compact_rows + len(RESPONSE_STYLE) + len(SOURCES_STYLE) < standard_rows / 2
+        assert sources_table(references).count("Also in: copy.pdf") == 4
+
+    def test_stage_timings_are_written_per_invocation(self, tmp_path, monkeypatch):
+        timings_file = tmp_path / "timings.jsonl"
+        monkeypatch.setenv(TIMINGS_PATH_ENV, str(timings_file))
+        monkeypatch.setenv(BACKEND_ENV, "local")
+        arguments = {"user_question": "What is the wind speed in Mombasa?", "base_url": BASE_URL}
+        RESULT_CACHE.clear()
+        self._run_rag(arguments)
+        self._run_rag(arguments)
+
+        first, second = [json.loads(line) for line in timings_file.read_text().splitlines()]
+        assert first["question"] == arguments["user_question"] and first["result_cache_hit"] is False
+        spans = {span["name"]: span for span in first["spans"]}
+        assert list(spans) == ["load_document_sources", "retrieval_index", "find_matching_documents",
+                               "generate_rag_response", "render_html", "wire_layout"]
+        assert spans["load_document_sources"]["chunks"] > spans["find_matching_documents"]["candidates"] > 0
+        assert spans["find_matching_documents"]["candidates"] >= spans["find_matching_documents"]["matches"]
+        stats = {}
+        loaded_sources = load_document_sources()
+        find_matching_documents(arguments["user_question"], [], loaded_sources, BASE_URL, 5, 0.2, 3000, stats=stats)
+        assert stats["scored"] == len(loaded_sources) and 0 < stats["candidates"] <= len(loaded_sources)
+        assert spans["find_matching_documents"]["matches"] == spans["generate_rag_response"]["sources"] > 0
+        assert spans["generate_rag_response"]["prompt_chars"] > 0 and spans["render_html"]["html_chars"] > 0
+        assert [span["tab"] for span in first["spans"] if span["name"] == "wire_layout"] == ["response", "sources"]
+        assert all(span["duration_ms"] >= 0 for span in first["spans"])
+        assert sum(span["duration_ms"] for span in first["spans"]) <= first["total_ms"]
+        # served from the result cache: no retrieval or generation stages
+        assert second["result_cache_hit"] is True
+        assert [span["name"] for span in second["spans"]] == ["load_document_sources", "wire_layout", "wire_layout"]
+
+        recorder = StageRecorder()
+        try:
+            with recorder.span("failing"):
+                raise ValueError("boom")
+        except ValueError:
+            pass
+        assert recorder.record()["spans"][0]["error"] == "ValueError"
+        monkeypatch.delenv(TIMINGS_PATH_ENV)
+        assert recorder.write() is None
+        assert recorder.write(tmp_path / "other.jsonl")["spans"][0]["name"] == "failing"
+        assert len(timings_file.read_text().splitlines()) == 2
+        # an unwritable path is logged, it does not fail the skill
+        assert recorder.write(tmp_path / "missing_dir" / "timings.jsonl") is None
+        monkeypatch.setenv(TIMINGS_PATH_ENV, str(tmp_path / "missing_dir" / "timings.jsonl"))
+        RESULT_CACHE.clear()
+        assert self._run_rag(arguments).visualizations[0].title != "Error"
+
+    def test_max_latency_returns_partial_passage_answer(self, monkeypatch):
+        monkeypatch.setenv(BACKEND_ENV, "local")
+        monkeypatch.setenv(LATENCY_ENV, "0.5")
+        RESULT_CACHE.clear()
+        arguments = {"user_question": "What is the wind speed in Mombasa?", "base_url": BASE_URL,
+                     "llm_cache": "disabled", "max_latency_ms": 100}
+
+        start = time.perf_counter()
+        out = self._run_rag(arguments)
+        assert time.perf_counter() - start < 0.4
+        assert PARTIAL_ANSWER_NOTE in out.visualizations[0].layout
+        assert "Mombasa" in out.visualizations[0].layout and "page=5" in out.visualizations[1].layout
+        # the fallback is not cached; without a deadline the LLM answer comes back
+        assert len(RESULT_CACHE) == 0
+        full = self._run_rag({**arguments, "max_latency_ms": 0})
+        assert PARTIAL_ANSWER_NOTE not in full.visualizations[0].layout
+        # parameter values can arrive as strings
+        RESULT_CACHE.clear()
+        from_string = self._run_rag({**arguments, "max_latency_ms": "100.0"})
+        assert PARTIAL_ANSWER_NOTE in from_string.visualizations[0].layout
+        # a value that is not a number means no deadline, not an error
+        RESULT_CACHE.clear()
+        not_a_number = self._run_rag({**arguments, "max_latency_ms": "abc"})
+        assert not_a_number.visualizations[0].title != "Error"
+        assert PARTIAL_ANSWER_NOTE not in not_a_number.visualizations[0].layout
+
+        docs = _find("wind speed in Mombasa", load_document_sources())
+        partial = generate_rag_response("wind speed in Mombasa", docs, use_llm_cache=False, timeout=0.05)
+        assert partial["partial"] and partial["content"].startswith(PARTIAL_ANSWER_NOTE)
+        assert [ref["number"] for ref in partial["references"]] == list(range(1, len(docs) + 1))
+        assert not generate_rag_response("wind speed in Mombasa", docs, use_llm_cache=False, timeout=2)["partial"]
+        [result] = answer_questions(["wind speed in Mombasa"], base_url=BASE_URL, use_llm_cache=False, max_latency_ms=50)
+        assert result["partial"] and result["error"] is None
+        [result] = answer_questions(["wind speed in Mombasa"], base_url=BASE_URL, use_llm_cache=False, max_latency_ms="50")
+        assert result["partial"] and result["error"] is None
+
+
+if __name__ == '__main__':
+    TestDocumentRagExplorer().test_document_rag_explorer_skill()